@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""Shard decompression benchmark
+
+Writes a synthetic csv shard, gzipped both as a single member and as
+many members, and times reading every row with the old
+`gzip.open(path, "rt")` path against zaius.export.decompress with one
+thread and with every cpu.
+
+    Example:
+        python benchmarks/decompress.py --rows 2000000 --runs 3
+"""
+
+import argparse
+import csv
+import gzip
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zaius.export import decompress  # pylint: disable=C0413
+
+# uncompressed bytes per member of the multi-member shard
+MEMBER_BYTES = 4 * 1024 * 1024
+
+
+def write_shards(directory, rows):
+    """Write the single and multi member shards, return their paths"""
+    rng = random.Random(0)
+    lines = ["zaius_id,ts,event_type,action,campaign_id\n"]
+    for idx in range(rows):
+        lines.append(
+            "{},{},email,{},{}\n".format(
+                rng.randrange(rows // 4 + 1),
+                1546300800 + idx,
+                rng.choice(["open", "click", "sent"]),
+                rng.randrange(300),
+            )
+        )
+    data = "".join(lines).encode("utf-8")
+
+    single = os.path.join(directory, "single.csv.gz")
+    with open(single, "wb") as shard:
+        shard.write(gzip.compress(data, compresslevel=6))
+
+    multi = os.path.join(directory, "multi.csv.gz")
+    with open(multi, "wb") as shard:
+        start = 0
+        while start < len(data):
+            # members end on a line so every member is a valid csv chunk
+            end = data.find(b"\n", start + MEMBER_BYTES)
+            end = len(data) if end < 0 else end + 1
+            shard.write(gzip.compress(data[start:end], compresslevel=6))
+            start = end
+    return single, multi
+
+
+def read_gzip_open(path):
+    """The previous path: gzip.open in text mode"""
+    with gzip.open(path, "rt") as csv_file:
+        return sum(1 for _ in csv.DictReader(csv_file))
+
+
+def read_decompress(path, threads):
+    """zaius.export.decompress"""
+    with decompress.open_text(path, threads) as csv_file:
+        return sum(1 for _ in csv.DictReader(csv_file))
+
+
+def read_bytes_gzip_open(path):
+    """Decompression alone, previous path"""
+    with gzip.open(path, "rb") as shard:
+        return sum(len(block) for block in iter(lambda: shard.read(1 << 20), b""))
+
+
+def read_bytes_decompress(path, threads):
+    """Decompression alone, zaius.export.decompress"""
+    return sum(len(chunk) for chunk in decompress.chunks(path, threads))
+
+
+def timed(runs, func, *args):
+    """Median seconds of func(*args) over runs"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="shard decompression benchmark")
+    parser.add_argument("--rows", type=int, default=1000000, help="rows per shard")
+    parser.add_argument("--runs", type=int, default=3, help="runs per variant")
+    parser.add_argument(
+        "--threads", type=int, default=os.cpu_count() or 1, help="threads to compare"
+    )
+    args = parser.parse_args()
+
+    threads = args.threads
+    print("backend: {}, threads: {}".format(decompress.backend().__name__, threads))
+    with tempfile.TemporaryDirectory() as directory:
+        for path in write_shards(directory, args.rows):
+            name = os.path.basename(path)
+            variants = [
+                ("bytes gzip.open", read_bytes_gzip_open, ()),
+                ("bytes decompress x1", read_bytes_decompress, (1,)),
+                (
+                    "bytes decompress x{}".format(threads),
+                    read_bytes_decompress,
+                    (threads,),
+                ),
+                ("rows gzip.open rt", read_gzip_open, ()),
+                ("rows decompress x1", read_decompress, (1,)),
+                ("rows decompress x{}".format(threads), read_decompress, (threads,)),
+            ]
+            baseline = {}
+            for label, func, extra in variants:
+                seconds = timed(args.runs, func, path, *extra)
+                kind = label.split()[0]
+                baseline.setdefault(kind, seconds)
+                print(
+                    "{:<16} {:<22} {:8.3f}s  x{:.2f}".format(
+                        name, label, seconds, baseline[kind] / seconds
+                    )
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""CLI startup benchmark
+
+Times `zaius-export --help` and `zaius-export demo` in fresh interpreters
+and fails if the median exceeds the budget, or if either command pulls
+in one of the heavy dependencies that should only load on first use.
+
+    Example:
+        python benchmarks/startup.py --runs 20 --budget-ms 250
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HEAVY_MODULES = ["boto3", "botocore", "requests", "parsy", "pyarrow", "multiprocessing"]
+
+# runs the cli in-process and reports any heavy module it imported
+PROBE = """
+import sys
+from zaius.cli.main import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+heavy = [name for name in {heavy!r} if name in sys.modules]
+sys.stderr.write("HEAVY:" + ",".join(heavy) + "\\n")
+"""
+
+
+def run(argv, env):
+    """Run the cli once, return (seconds, heavy modules imported)"""
+    start = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)] + argv,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=False,
+    )
+    elapsed = time.perf_counter() - start
+    heavy = []
+    for line in proc.stderr.splitlines():
+        if line.startswith("HEAVY:") and line[len("HEAVY:"):]:
+            heavy = line[len("HEAVY:"):].split(",")
+    return elapsed, heavy
+
+
+def main():
+    """Benchmark entry point"""
+    parser = argparse.ArgumentParser(description="zaius-export startup benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="runs per command")
+    parser.add_argument(
+        "--budget-ms", type=float, default=250, help="median startup budget"
+    )
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=root)
+    with tempfile.NamedTemporaryFile("wt", suffix=".ini") as auth_file:
+        auth_file.write(
+            "[auth]\naws_access_key_id: x\naws_secret_access_key: x\nzaius_secret_key: x\n"
+        )
+        auth_file.flush()
+
+        baseline = statistics.median(
+            run_python(["-c", "pass"], env) for _ in range(args.runs)
+        )
+        failed = False
+        for argv in (["--help"], ["--auth", auth_file.name, "demo"]):
+            results = [run(argv, env) for _ in range(args.runs)]
+            median_ms = statistics.median(elapsed for elapsed, _ in results) * 1000
+            heavy = sorted(set(name for _, names in results for name in names))
+            over = median_ms > args.budget_ms
+            failed = failed or over or bool(heavy)
+            print(
+                "{:<28} median {:7.1f}ms (interpreter {:5.1f}ms) budget {:.0f}ms{}{}".format(
+                    " ".join(argv[-1:]),
+                    median_ms,
+                    baseline * 1000,
+                    args.budget_ms,
+                    "  OVER BUDGET" if over else "",
+                    "  imported: " + ", ".join(heavy) if heavy else "",
+                )
+            )
+    sys.exit(1 if failed else 0)
+
+
+def run_python(argv, env):
+    """Time a bare interpreter run"""
+    start = time.perf_counter()
+    subprocess.run([sys.executable] + argv, env=env, check=False)
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
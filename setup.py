@@ -15,6 +15,12 @@ setup(
     license="Apache 2.0",
     packages=find_packages(),
     install_requires=["requests", "parsy", "boto3>=1.12", "python-dateutil==2.8.0"],
+    extras_require={
+        "parquet": ["pyarrow"],
+        "zstd": ["zstandard"],
+        "isal": ["isal"],
+        "roaring": ["pyroaring"],
+    },
     test_suite="nose.collector",
     tests_require=["nose"],
     classifiers=[
@@ -2,40 +2,338 @@
 """Zaius Export Command Line Interface
 
 Interface to run pre-baked reports from the command line.
+
+Several reports can be run in one invocation by separating them with
+"+". Reports whose queries are compatible then share a single export.
+
+--output and --output-dir also take s3://bucket/key urls, the output is
+then streamed to s3 as it is written.
+
+--dimensions keeps the customers, orders and products that reports join
+to in a local cache and joins their fields client side.
 """
 
+import io
+import os
 import sys
 import argparse
 
 import zaius.reports as reports
+import zaius.reports.output as report_output
+import zaius.reports.registry as registry
 import zaius.auth as auth
 import zaius.export as export
+import zaius.profiling as profiling
 
+# separates report invocations on the command line
+REPORT_SEPARATOR = "+"
+# runs the long lived service instead of a report, see zaius.cli.serve
+SERVE_COMMAND = "serve"
+S3_PREFIX = "s3://"
 
-def main():
+
+def main(argv=None):
     """CLI entry point"""
 
-    parser = argparse.ArgumentParser(description="zaius-export command line utility")
-    parser.add_argument("--auth", help="file containing zaius credentials")
-    parser.add_argument("--output", help="file to write the report into")
+    invocations = _split_invocations(sys.argv[1:] if argv is None else argv)
 
-    subparsers = parser.add_subparsers(dest="report", help="name of the report")
-    subparsers.required = True
-    for report in reports.SPECS:
-        report.register_args(subparsers)
-    args = parser.parse_args()
+    # a first pass only finds out which reports are requested, so that
+    # just those get imported and register their arguments
+    infos = registry.available()
+    probe = _build_parser(infos, {})
+    names = set(
+        probe.parse_known_args(invocation)[0].report for invocation in invocations
+    )
+    if SERVE_COMMAND in names:
+        # the service runs any report, load them all up front
+        names.update(info.name for info in infos)
+    loaded = {info.name: info.load() for info in infos if info.name in names}
+
+    parser = _build_parser(infos, loaded)
+    args = parser.parse_args(invocations[0])
+    extra = [parser.parse_args(invocation) for invocation in invocations[1:]]
+    for other in extra:
+        # output options apply to every report in the invocation
+        other.format = args.format
+        other.compression = args.compression
+        other.sample = args.sample
+    if args.sample is not None:
+        for report_args in [args] + extra:
+            # args.func is the bound execute method of the report's spec
+            if report_args.func.__self__.sample_key is None:
+                parser.error("{} does not support --sample".format(report_args.report))
+        sys.stderr.write(
+            "Sampling {:g}% of users, counts are estimates\n".format(args.sample * 100)
+        )
+
+    if args.report == SERVE_COMMAND:
+        for option in ("profile", "store", "dimensions"):
+            if getattr(args, option):
+                parser.error(
+                    "--{} is not supported by {}".format(option, SERVE_COMMAND)
+                )
+
+    if args.store and args.dimensions:
+        parser.error("--dimensions cannot be combined with --store")
+    if extra and any(report_args.processes > 1 for report_args in [args] + extra):
+        # the shared export is read by a single process
+        parser.error("--processes cannot be combined with several reports")
 
     if args.auth:
         auth_struct = auth.from_file(args.auth)
+    elif args.store:
+        # the local store needs no credentials
+        auth_struct = None
     else:
         auth_struct = auth.default()
 
+    if args.report == SERVE_COMMAND:
+        import zaius.cli.serve as serve  # pylint: disable=C0415
+
+        serve.serve(
+            lambda pool, scheduler: export.API(
+                auth_struct,
+                export_format=args.export_format,
+                pool=pool,
+                scheduler=scheduler,
+            ),
+            parser,
+            args,
+        )
+        return
+
+    if extra and not args.output_dir:
+        parser.error("--output-dir is required when running several reports")
+
+    profiler = None
+    if args.profile:
+        profiler = profiling.Profiler(args.profile_output)
+        profiler.start()
+    cache = None
+    try:
+        if args.store:
+            import zaius.export.store as store  # pylint: disable=C0415
+
+            api = store.EventStore(args.store)
+        else:
+            api = export.API(auth_struct, export_format=args.export_format)
+        if args.dimensions:
+            import zaius.export.dimensions as dimensions  # pylint: disable=C0415
+
+            cache = dimensions.DimensionCache(args.dimensions)
+            api = dimensions.LocalJoinAPI(api, cache)
+        if extra:
+            _run_many(api, args.output_dir, [args] + extra, auth_struct)
+        else:
+            _run_one(api, args, auth_struct)
+    finally:
+        if cache is not None:
+            cache.close()
+        if profiler is not None:
+            profiler.stop()
+
+
+def _run_one(api, args, auth_struct=None):
+    """Run a single report into --output or stdout"""
+
     if args.output:
-        output = open(args.output, "wt")
+        output = _open_output(args.output, auth_struct)
     else:
         output = sys.stdout
 
-    args.func(export.API(auth_struct), output, args)
+    try:
+        with profiling.stage("report"):
+            args.func(api, output, args)
+    except BaseException:
+        _discard_output(output)
+        raise
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def _open_output(path, auth_struct=None):
+    """
+    Text stream writing into a local file or, for s3://bucket/key paths,
+    into a multipart upload
+    """
+
+    if not path.startswith(S3_PREFIX):
+        return open(path, "wt", buffering=report_output.BUFFER_BYTES)
+
+    import zaius.s3 as s3  # pylint: disable=C0415
+
+    bucket, _, key = path[len(S3_PREFIX):].partition("/")
+    if not bucket or not key:
+        raise ValueError("{} is not an s3://bucket/key url".format(path))
+    upload = s3.S3MultipartWriter(auth_struct, bucket, key)
+    return io.TextIOWrapper(
+        io.BufferedWriter(upload, report_output.BUFFER_BYTES), encoding="utf-8"
+    )
+
+
+def _discard_output(output):
+    """
+    Abort the upload behind an s3 output, or remove a local output file,
+    so no partial report is left
+    """
+
+    raw = getattr(getattr(output, "buffer", None), "raw", None)
+    if hasattr(raw, "abort"):
+        raw.abort()
+    elif output is not sys.stdout and isinstance(getattr(output, "name", None), str):
+        output.close()
+        os.remove(output.name)
+
+
+def _build_parser(infos, loaded):
+    """
+    Build the command line parser. Reports in loaded register their own
+    arguments, the others are only listed by name.
+    """
+
+    parser = argparse.ArgumentParser(description="zaius-export command line utility")
+    parser.add_argument("--auth", help="file containing zaius credentials")
+    parser.add_argument(
+        "--output", help="file or s3://bucket/key url to write the report into"
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="directory or s3://bucket/prefix url to write one file per report "
+        "into when running several",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="split the report across this many processes by user",
+    )
+    parser.add_argument(
+        "--sample",
+        type=_sample_rate,
+        help="only read this fraction of users, e.g. 0.05, and scale the counts",
+    )
+    parser.add_argument(
+        "--format",
+        choices=report_output.FORMATS,
+        default="csv",
+        help="format of the report output",
+    )
+    parser.add_argument(
+        "--export-format",
+        choices=export.decode.FORMATS,
+        default="csv",
+        help="format to request exports in, parquet needs pyarrow",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=report_output.COMPRESSIONS,
+        help="compress the report output",
+    )
+    parser.add_argument(
+        "--store",
+        help="read events from this local event store instead of exporting them, "
+        "see zaius.export.store",
+    )
+    parser.add_argument(
+        "--dimensions",
+        help="sqlite file caching customers, orders and products, their fields "
+        "are joined locally instead of exported with every event, see "
+        "zaius.export.dimensions",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="profile the run and print where the time and memory went, "
+        "with --processes only the parent process is profiled",
+    )
+    parser.add_argument(
+        "--profile-output",
+        default="zaius-export-profile",
+        help="path prefix of the .pstats, .folded and .txt profile files",
+    )
+
+    subparsers = parser.add_subparsers(dest="report", help="name of the report")
+    subparsers.required = True
+    serve = subparsers.add_parser(
+        SERVE_COMMAND, help="run reports and queries for other processes over http"
+    )
+    serve.add_argument("--host", default="127.0.0.1", help="interface to listen on")
+    serve.add_argument("--port", type=int, default=8765, help="port to listen on")
+    serve.add_argument(
+        "--workers", type=int, default=4, help="jobs that may run at the same time"
+    )
+    serve.add_argument(
+        "--download-threads",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="threads shared by every job to download export files",
+    )
+    serve.add_argument(
+        "--cache-seconds",
+        type=float,
+        default=300,
+        help="how long results are cached, 0 disables the cache",
+    )
+    for info in infos:
+        if info.name in loaded:
+            loaded[info.name].register_args(subparsers)
+        else:
+            subparsers.add_parser(info.name, help=info.help, add_help=False)
+    return parser
+
+
+def _sample_rate(value):
+    """argparse type of --sample"""
+
+    rate = float(value)
+    if not 0 < rate <= 1:
+        raise argparse.ArgumentTypeError("sample rate must be in (0, 1]")
+    return rate
+
+
+def _split_invocations(argv):
+    """Split the command line into one argument list per report"""
+
+    invocations = [[]]
+    for arg in argv:
+        if arg == REPORT_SEPARATOR:
+            invocations.append([])
+        else:
+            invocations[-1].append(arg)
+    return invocations
+
+
+def _run_many(api, output_dir, all_args, auth_struct=None):
+    """Run several reports off shared exports, each into its own file"""
+
+    if output_dir.startswith(S3_PREFIX):
+        join = lambda name: "{}/{}".format(output_dir.rstrip("/"), name)
+    else:
+        os.makedirs(output_dir, exist_ok=True)
+        join = lambda name: os.path.join(output_dir, name)
+    names = {}
+    jobs = []
+    for args in all_args:
+        names[args.report] = names.get(args.report, 0) + 1
+        suffix = "" if names[args.report] == 1 else "-{}".format(names[args.report])
+        ext = report_output.extension(args.format, args.compression)
+        output = _open_output(
+            join("{}{}{}".format(args.report, suffix, ext)), auth_struct
+        )
+        # args.func is the bound execute method of the report's spec
+        jobs.append((args.func.__self__, output, args))
+
+    try:
+        with profiling.stage("report"):
+            reports.execute_many(api, jobs)
+    except BaseException:
+        for _, output, _ in jobs:
+            _discard_output(output)
+        raise
+    finally:
+        for _, output, _ in jobs:
+            output.close()
 
 
 if __name__ == "__main__":
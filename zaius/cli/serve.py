@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""Long running service mode
+
+`zaius-export serve` keeps one warm process around: credentials are read
+once, every report and the query parser are loaded up front, the export
+API reuses its http connections and s3 clients, and shards are downloaded
+by a pool that lives as long as the service. Other processes submit work
+over local http and get the results streamed back:
+
+    POST /query   {"query": "select zaius_id from events ..."}
+        rows of the query as json lines
+    POST /report  {"args": ["--format", "jsonl", "demo"]}
+        the report output, as the command line would have written it
+    GET /health
+        {"status": "ok"}
+
+Bodies are sent with chunked transfer encoding. A job that fails once
+its output has started ends the connection without the final chunk, so
+clients see an incomplete response instead of a truncated result that
+looks whole.
+
+At most --workers jobs run at a time, the others wait for a free worker.
+Results are cached for --cache-seconds, a request can opt out with
+"cache": false. Every job's api calls share one scheduler; a request can
+set a "priority" to have its calls go first.
+"""
+
+import collections
+import contextlib
+import copy
+import functools
+import io
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.pool import ThreadPool
+
+from zaius.export import parser as query_parser
+from zaius.export.scheduler import Scheduler
+
+# results larger than this are streamed but not cached
+CACHE_ENTRY_BYTES = 64 * 1024 * 1024
+CACHE_ENTRIES = 128
+# options that only make sense on the command line
+LOCAL_OPTIONS = (
+    "--output",
+    "--output-dir",
+    "--processes",
+    "--profile",
+    "--profile-output",
+    "--store",
+    "--dimensions",
+)
+
+CONTENT_TYPES = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+class ResultCache:
+    """Thread safe LRU of response bodies that expire after ttl_s"""
+
+    def __init__(self, ttl_s, max_entries=CACHE_ENTRIES):
+        """
+        Args:
+            ttl_s (float): seconds a result stays valid, 0 disables the cache
+            max_entries (int): results kept, least recently used are dropped
+        """
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Returns:
+            tuple: (content type, body) or None if not cached
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, content_type, body):
+        """Remember a result"""
+        if self.ttl_s <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl_s, (content_type, body))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class Service:
+    """Runs queries and reports against a shared api"""
+
+    def __init__(self, api, report_parser, workers, cache):
+        """
+        Args:
+            api (zaius.export.API): warm api shared by every job
+            report_parser (argparse.ArgumentParser): the command line parser
+                with every report loaded
+            workers (int): jobs that may run at the same time
+            cache (ResultCache): cache of finished results
+        """
+        self.api = api
+        self.report_parser = report_parser
+        self.workers = threading.BoundedSemaphore(workers)
+        self.cache = cache
+
+    def report_args(self, argv):
+        """
+        Parse the command line of a report
+
+        Returns:
+            argparse.Namespace: the parsed arguments
+        """
+        argv = [str(arg) for arg in argv]
+        for arg in argv:
+            if arg.split("=")[0] in LOCAL_OPTIONS or arg in ("serve", "+"):
+                raise ValueError("{} is not supported by the service".format(arg))
+        try:
+            args = self.report_parser.parse_args(argv)
+        except SystemExit:
+            # argparse has explained the problem on the service's stderr
+            raise ValueError("invalid report arguments {}".format(argv))
+        # reports run on the service's threads, not in forked processes
+        args.processes = 1
+        return args
+
+    def api_for(self, priority):
+        """
+        A copy of the shared api for one job, with its calls scheduled at
+        priority. The copy shares credentials, pool and scheduler with the
+        original but opens its own http session, as requests sessions are
+        not safe to use from several threads at once.
+        """
+        api = copy.copy(self.api)
+        api._session = None  # pylint: disable=W0212
+        api.priority = priority
+        return api
+
+    def run_query(self, request, stream):
+        """Write the rows of a query to stream as json lines"""
+        api = self.api_for(request.get("priority", 0))
+        with self.workers, _closing_session(api):
+            text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+            for row in api.query(request["query"]):
+                text.write(json.dumps(row, default=str))
+                text.write("\n")
+            text.flush()
+            text.detach()
+
+    def run_report(self, args, priority, stream):
+        """Write the output of a report to stream"""
+        api = self.api_for(priority)
+        with self.workers, _closing_session(api):
+            text = io.TextIOWrapper(stream, encoding="utf-8", newline="")
+            args.func(api, text, args)
+            text.flush()
+            text.detach()
+
+
+@contextlib.contextmanager
+def _closing_session(api):
+    """Close the http session a job's api opened, if any"""
+    try:
+        yield
+    finally:
+        session = getattr(api, "_session", None)
+        if session is not None:
+            session.close()
+
+
+class _ResponseStream(io.RawIOBase):
+    """
+    Chunked body of a streamed response. Headers are only sent with the
+    first bytes so that errors raised before any output can still become
+    an error response. Small bodies are kept so they can be cached.
+    """
+
+    def __init__(self, handler, content_type):
+        super().__init__()
+        self.handler = handler
+        self.content_type = content_type
+        self.started = False
+        self.body = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not data:
+            return 0
+        self.start()
+        self.handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), bytes(data)))
+        if self.body is not None:
+            self.body.write(data)
+            if self.body.tell() > CACHE_ENTRY_BYTES:
+                self.body = None
+        return len(data)
+
+    def start(self):
+        """Send the headers, if not sent yet"""
+        if not self.started:
+            self.started = True
+            self.handler.send_response(200)
+            self.handler.send_header("Content-Type", self.content_type)
+            self.handler.send_header("Transfer-Encoding", "chunked")
+            self.handler.send_header("Connection", "close")
+            self.handler.end_headers()
+
+    def finish(self):
+        """Send the last chunk, which tells the client the body is complete"""
+        self.start()
+        self.handler.wfile.write(b"0\r\n\r\n")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Routes requests to the service"""
+
+    # streamed bodies are chunked, which needs http/1.1
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Health check"""
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        self._send_json(200, {"status": "ok"})
+
+    def do_POST(self):  # pylint: disable=C0103
+        """Run a query or a report"""
+        service = self.server.service
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if self.path == "/query":
+                if "query" not in request:
+                    raise ValueError("missing query")
+                content_type = CONTENT_TYPES["jsonl"]
+                run = functools.partial(service.run_query, request)
+            elif self.path == "/report":
+                args = service.report_args(request.get("args", []))
+                content_type = CONTENT_TYPES[args.format]
+                run = functools.partial(
+                    service.run_report, args, request.get("priority", 0)
+                )
+            else:
+                self._send_json(404, {"error": "not found"})
+                return
+        except ValueError as err:
+            self._send_json(400, {"error": str(err)})
+            return
+
+        use_cache = request.get("cache", True)
+        cache_key = json.dumps([self.path, request], sort_keys=True)
+        cached = service.cache.get(cache_key) if use_cache else None
+        if cached is not None:
+            stream = _ResponseStream(self, cached[0])
+            stream.write(cached[1])
+            stream.finish()
+            return
+
+        stream = _ResponseStream(self, content_type)
+        try:
+            run(stream)
+        except Exception as err:  # pylint: disable=W0703
+            self.log_error("job failed: %r", err)
+            if not stream.started:
+                self._send_json(500, {"error": str(err)})
+            # otherwise the connection closes without the last chunk
+            return
+        stream.finish()
+        if use_cache and stream.body is not None:
+            service.cache.put(cache_key, content_type, stream.body.getvalue())
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(api, report_parser, host, port, workers, cache_seconds):
+    """
+    Build the http server, see the module documentation for its interface
+
+    Args:
+        api (zaius.export.API): api shared by every job
+        report_parser (argparse.ArgumentParser): the command line parser with
+            every report loaded
+        host (str): interface to listen on
+        port (int): port to listen on, 0 picks a free one
+        workers (int): jobs that may run at the same time
+        cache_seconds (float): how long results are cached, 0 disables it
+
+    Returns:
+        http.server.ThreadingHTTPServer: the server, not started yet
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.service = Service(api, report_parser, workers, ResultCache(cache_seconds))
+    return server
+
+
+def serve(api_factory, report_parser, args):
+    """
+    Run the service until interrupted
+
+    Args:
+        api_factory (callable): (pool, scheduler) -> zaius.export.API
+        report_parser (argparse.ArgumentParser): the command line parser with
+            every report loaded
+        args (argparse.Namespace): the serve command line
+    """
+    # build everything the first job would otherwise pay for
+    query_parser.query_parser()
+    with ThreadPool(args.download_threads) as pool:
+        server = make_server(
+            api_factory(pool, Scheduler()),
+            report_parser,
+            args.host,
+            args.port,
+            args.workers,
+            args.cache_seconds,
+        )
+        sys.stderr.write(
+            "Serving on http://{}:{}\n".format(*server.server_address[:2])
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -44,4 +44,25 @@ Authentication:
     default it will attempt to read what it needs out of $HOME/.zaius_api
 """
 
-from .api import *
+import importlib
+
+# the names `from zaius.export import *` brings in, which the lazy
+# __getattr__ below can't list on its own
+__all__ = ["API", "ExecutionError"]
+
+
+def __getattr__(name):
+    # submodules and the api module are loaded on first use to keep
+    # `import zaius.export` cheap
+    try:
+        return importlib.import_module("." + name, __name__)
+    except ModuleNotFoundError as err:
+        if err.name != "{}.{}".format(__name__, name):
+            raise
+    api = importlib.import_module(".api", __name__)
+    try:
+        return getattr(api, name)
+    except AttributeError:
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name)
+        ) from None
@@ -3,21 +3,34 @@
 Wrapper around the zaius export API
 """
 
+import collections
+import contextlib
 import time
 import tempfile
 import shutil
 import logging
+import itertools
 import re
 import os
-import gzip
-import csv
 import json
 
-import requests
 import zaius.auth as auth
-from zaius.s3 import list_objects, par_s3_download
+from zaius import profiling
+from zaius.retry import RetryPolicy, ThrottledError, TransientError
+from zaius.s3 import iter_s3_download, list_objects, read_object
 
-from .parser import QUERY_PARSER
+from . import decode, parser
+from .batch import QueryBatch
+from .follow import FollowState, window_query
+from .job import ExportJob
+from .manifest import Manifest, ManifestError, manifest_key
+from .manifest import loads as load_manifest
+
+
+# http statuses that are worth retrying
+TRANSIENT_STATUS = (429, 500, 502, 503, 504)
+# http statuses that mean we are sending too much
+THROTTLED_STATUS = (429, 503)
 
 
 class ExecutionError(Exception):
@@ -32,117 +45,688 @@ class API:
     """
 
     ENDPOINT = "https://api.zaius.com/v3/exports"
+    POLL_INTERVAL_S = 1
+    TIMEOUT_S = 60
 
-    def __init__(self, auth_struct=None, log=logging):
+    def __init__(
+        self,
+        auth_struct=None,
+        log=logging,
+        retry=None,
+        export_format="csv",
+        pool=None,
+        scheduler=None,
+        priority=0,
+    ):
         """
         Args:
             auth_struct (dict): authentication structure produced by pyzaius.auth
             log (logging.Logger): destination for log information
+            retry (zaius.retry.RetryPolicy): policy for transient api and s3
+                failures, defaults to RetryPolicy()
+            export_format (str): format the exports are requested in, one of
+                decode.FORMATS. Parquet exports are smaller and typed but need
+                pyarrow.
+            pool (multiprocessing.pool.Pool): long lived pool to download
+                shards with, by default a process pool is started per export
+            scheduler (zaius.export.scheduler.Scheduler): paces the api calls
+                and bounds the exports in flight of every api sharing it, by
+                default calls are made right away
+            priority (int): priority of this api's calls and exports in the
+                scheduler
         """
         if auth_struct is None:
             auth_struct = auth.default()
+        if export_format not in decode.FORMATS:
+            raise ValueError("unsupported export format {}".format(export_format))
 
         self.auth = auth_struct
         self.log = log
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.export_format = export_format
+        self.pool = pool
+        self.scheduler = scheduler
+        self.priority = priority
+        # created on first use, keeps connections to the api alive
+        self._session = None
 
-    def query(self, stmt):
+    def query(self, stmt, job_file=None, limit=None):
         """
         Execute an SQL like query and return a generator rows (represented as dicts)
 
         Args:
             stmt (string): sql-like query
+            job_file (str): optional file used to persist the export state so that
+                a rerun after a crash reattaches to the same export
+            limit (int): stop after this many rows, see query_raw
 
         Yields:
             (dict) representing each row of the response
         """
-        parsed = QUERY_PARSER.parse(stmt)
-        return self.query_raw(parsed)
+        parsed = parser.parse(stmt)
+        return self.query_raw(parsed, job_file=job_file, limit=limit)
 
-    def query_raw(self, query_dict):
+    def query_raw(self, query_dict, job_file=None, limit=None):
         """
         Execute a raw query of the form expected by the underlying API. See
         https://developers.zaius.com/v3/reference#export-api-overview for more
         details.
 
+        Shards are downloaded as the rows are read. Once limit rows have been
+        read, or the generator is closed, the remaining downloads are
+        cancelled, so previewing a large export costs about one shard.
+
         Args:
             query_dict (dict): query structure as defined by api documentation
+            job_file (str): optional file used to persist the export state. If it
+                already describes an export of the same query, that export is
+                reattached to and only the missing shards are downloaded.
+            limit (int): stop after this many rows, None to read every row
+
+        Yields:
+            (dict) representing each row of the response
+        """
+
+        query_dict, api_resp, job = self._submit(query_dict, job_file)
+        rows = self._rows(api_resp, job, query_dict["select"]["fields"])
+        try:
+            yield from itertools.islice(rows, limit)
+        finally:
+            rows.close()
+
+    def query_batches(self, stmt, job_file=None):
+        """
+        Execute an SQL like query and return a generator of pyarrow record
+        batches holding the selected columns. Requires the parquet export
+        format.
+
+        Args:
+            stmt (string): sql-like query
+            job_file (str): optional file used to persist the export state
+
+        Yields:
+            (pyarrow.RecordBatch) successive slices of the response
+        """
+        if self.export_format != "parquet":
+            raise ValueError("record batches require the parquet export format")
+        query_dict = parser.parse(stmt)
+        decoder = decode.decoder(self.export_format, query_dict["select"]["fields"])
+        query_dict, api_resp, job = self._submit(query_dict, job_file)
+        shards = self._shards(api_resp, job)
+        try:
+            for path in shards:
+                yield from profiling.iterate("decode", decoder.batches(path))
+        finally:
+            shards.close()
+
+    @contextlib.contextmanager
+    def query_shards(self, stmt, job_file=None):
+        """
+        Execute an SQL like query and hand over the local paths of its files,
+        for callers that decode them elsewhere, e.g. in other processes, with
+        decode.decoder(api.export_format, fields). The files are kept until
+        the with block exits, even once every path has been read:
+
+            with api.query_shards(stmt) as shards:
+                for path in shards:
+                    ...
+
+        Args:
+            stmt (string): sql-like query
+            job_file (str): optional file used to persist the export state
+
+        Yields:
+            (generator) of the local path of each file, in the export's order
+        """
+        temporary = None
+        if job_file is None:
+            temporary = tempfile.mkdtemp()
+            job_file = os.path.join(temporary, "job")
+        try:
+            _, api_resp, job = self._submit(parser.parse(stmt), job_file)
+            shards = self._shards(api_resp, job, keep=True)
+            try:
+                yield shards
+            finally:
+                shards.close()
+            job.remove()
+        finally:
+            if temporary is not None:
+                shutil.rmtree(temporary)
+
+    def query_grouped(self, stmt, key="zaius_id", job_file=None):
+        """
+        Execute an SQL like query ordered by key and return a generator of
+        the rows grouped by key. Each group is released once the caller
+        moves on to the next one.
+
+        Args:
+            stmt (string): sql-like query, its first sort field must be key
+            key (str): field to group the rows on
+            job_file (str): optional file used to persist the export state
+
+        Yields:
+            tuple: (key value, batch) where batch is a pyarrow.RecordBatch of
+                the key's rows for parquet exports and a list of row dicts
+                for csv exports
+        """
+        query_dict = parser.parse(stmt)
+        select = query_dict["select"]
+        if key not in select["fields"]:
+            raise ValueError("{} must be one of the selected fields".format(key))
+        if not select.get("sorts") or select["sorts"][0]["field"] != key:
+            raise ValueError("query must be ordered by {} first".format(key))
+
+        decoder = decode.decoder(self.export_format, select["fields"])
+        query_dict, api_resp, job = self._submit(query_dict, job_file)
+        shards = self._shards(api_resp, job)
+        try:
+            if self.export_format == "parquet":
+                batches = (
+                    batch
+                    for path in shards
+                    for batch in profiling.iterate("decode", decoder.batches(path))
+                )
+                yield from decode.group_batches(batches, key)
+            else:
+                rows = (
+                    row
+                    for path in shards
+                    for row in profiling.iterate("decode", decoder.rows(path))
+                )
+                yield from decode.group_rows(rows, key)
+        finally:
+            shards.close()
+
+    def follow(
+        self,
+        stmt,
+        start_ts,
+        state_file=None,
+        interval_s=300,
+        overlap_s=900,
+        rounds=None,
+    ):
+        """
+        Follow a feed of rows: run the query over successive, overlapping
+        ts windows and yield every new row once. The next round's export is
+        submitted before the current one is downloaded so that it runs on
+        the server in the meantime.
+
+        Args:
+            stmt (string): sql-like query, must select ts
+            start_ts (int): ts to start from, unless state_file has a watermark
+            state_file (str): optional file the watermark, the hashes of
+                recent rows and the exports not yet consumed are persisted to.
+                A follower started on it reads the exports a stopped one left
+                pending instead of leaving them behind.
+            interval_s (float): seconds between the start of two rounds
+            overlap_s (int): seconds each window reaches back before the
+                watermark, to catch rows that arrive late
+            rounds (int): stop after this many rounds, None to run forever
+
+        Yields:
+            (dict) each new row
+        """
+        query_dict = parser.parse(stmt)
+        fields = query_dict["select"]["fields"]
+        if "ts" not in fields:
+            raise ValueError("followed queries must select ts")
+        state = FollowState(start_ts, state_file)
+
+        # export id -> holder of its slot of the scheduler's window
+        held = {}
+
+        def submit(low, high=None):
+            high = int(time.time()) if high is None else high
+            windowed = window_query(query_dict, low, high)
+            holder = self._begin_export()
+            try:
+                api_resp = self._api_request(
+                    {**windowed, "format": self.export_format}
+                )
+            except Exception:
+                self._end_export(False, holder)
+                raise
+            held[api_resp["id"]] = holder
+            state.submitted(api_resp["id"], low, high)
+            return api_resp, low, high
+
+        def finish(api_resp):
+            if api_resp["id"] not in held:
+                held[api_resp["id"]] = self._begin_export()
+            completed = False
+            try:
+                api_resp = self._await_export(api_resp)
+                completed = True
+            finally:
+                self._end_export(completed, held.pop(api_resp["id"]))
+            return api_resp
+
+        queue = collections.deque()
+        try:
+            # exports a stopped follower submitted but did not consume are
+            # read first, any window they leave uncovered is exported again.
+            # Those are submitted once their turn comes, so that the follower
+            # never holds more than one slot of the window at a time.
+            low = state.watermark - overlap_s
+            for export_id, export_low, export_high in sorted(
+                state.pending, key=lambda entry: entry[1]
+            ):
+                if export_low > low:
+                    queue.append((None, low, export_low))
+                queue.append(({"id": export_id}, export_low, export_high))
+                low = export_high - overlap_s
+            if not queue:
+                queue.append(submit(low))
+
+            done = 0
+            submitted_at = time.monotonic()
+            while queue:
+                api_resp, low, high = queue.popleft()
+                if api_resp is None:
+                    api_resp = submit(low, high)[0]
+                try:
+                    api_resp = finish(api_resp)
+                except ExecutionError:
+                    if api_resp.get("state") is not None:
+                        raise
+                    # a reattached export may have expired, export its
+                    # window again
+                    self.log.warning(
+                        "export {} is gone, exporting again".format(api_resp["id"])
+                    )
+                    state.discard(api_resp["id"])
+                    api_resp = finish(submit(low, high)[0])
+                done += 1
+                last = rounds is not None and done >= rounds
+                due = time.monotonic() - submitted_at >= interval_s
+                if not last and not queue and due:
+                    submitted_at = time.monotonic()
+                    queue.append(submit(high - overlap_s))
+
+                for row in self._rows(api_resp, None, fields):
+                    if state.is_new(row):
+                        yield row
+                state.advance(api_resp["id"], high, overlap_s)
+                if last:
+                    break
+
+                if not queue:
+                    time.sleep(max(0, submitted_at + interval_s - time.monotonic()))
+                    submitted_at = time.monotonic()
+                    queue.append(submit(high - overlap_s))
+        finally:
+            # the rows yielded so far and the exports left pending are kept,
+            # the next follower reads the pending exports and skips the rows
+            state.save()
+            for holder in held.values():
+                self._end_export(False, holder)
+
+    def _submit(self, query_dict, job_file=None):
+        """
+        Submit a query, or reattach to the export recorded in job_file, and
+        wait for it to complete.
+
+        Returns:
+            tuple: (query as submitted, final api response, ExportJob or None)
+        """
+        query_dict = {**query_dict, "format": self.export_format}
+
+        job = ExportJob(job_file) if job_file else None
+        if job is not None and job.export_id is not None:
+            if job.query != query_dict:
+                raise ValueError(
+                    "{} belongs to a different query, remove it to start over".format(
+                        job_file
+                    )
+                )
+            with self._export_slot():
+                api_resp = self._await_export(job.state, job)
+        else:
+            if job is not None:
+                job.record_query(query_dict)
+            with self._export_slot():
+                api_resp = self._await_export(self._api_request(query_dict), job)
+        return query_dict, api_resp, job
+
+    def resume(self, export_id, job_file=None):
+        """
+        Reattach to an export that was submitted earlier, wait for it to complete
+        and return a generator of its rows.
+
+        Args:
+            export_id (str): id of a previously submitted export
+            job_file (str): optional file used to persist the export state
 
         Yields:
             (dict) representing each row of the response
         """
+        job = ExportJob(job_file) if job_file else None
+        if job is not None and job.export_id not in (None, export_id):
+            raise ValueError(
+                "{} belongs to export {}".format(job_file, job.export_id)
+            )
+        req = job.state if job is not None and job.export_id else {"id": export_id}
+        columns = None
+        if job is not None and job.query is not None:
+            columns = job.query["select"]["fields"]
+        with self._export_slot():
+            api_resp = self._await_export(req, job)
+        yield from self._rows(api_resp, job, columns)
+
+    def batch(self):
+        """
+        Collect several queries and run them as shared exports, see
+        zaius.export.batch.QueryBatch.
+
+        Returns:
+            QueryBatch: context manager that collects queries
+        """
+        return QueryBatch(self)
+
+    @contextlib.contextmanager
+    def _export_slot(self):
+        """
+        Hold a slot of the scheduler's concurrency window, if there is a
+        scheduler, from the submission of an export until it completes
+        """
+        holder = self._begin_export()
+        completed = False
+        try:
+            yield
+            completed = True
+        finally:
+            self._end_export(completed, holder)
+
+    def _begin_export(self):
+        """
+        Wait for a slot of the scheduler's window, if any, and return its
+        holder for _end_export
+        """
+        if self.scheduler is None:
+            return None
+        return self.scheduler.begin_export(priority=self.priority)
+
+    def _end_export(self, completed, holder=None):
+        """Free a slot taken by _begin_export"""
+        if self.scheduler is not None:
+            self.scheduler.end_export(completed, holder)
+
+    def _await_export(self, api_resp, job=None):
+        """
+        Poll an export until it leaves the pending/running states and return the
+        final response. Exports that a job already knows to be completed are not
+        polled again.
+        """
+        if job is not None and job.completed:
+            return job.state
 
-        # we only support csv responses
-        query_dict = {**query_dict, "format": "csv"}
+        with profiling.stage("wait"):
+            return self._poll_export(api_resp, job)
 
-        # execute query and await completion
-        api_resp = self._api_request(query_dict)
+    def _poll_export(self, api_resp, job):
+        """Poll an export until it is no longer pending or running"""
+        if job is not None:
+            job.record_status(api_resp)
+        if api_resp.get("state") is None:
+            # reattaching by id alone, fetch the current state first
+            api_resp = self._api_status(api_resp)
+            if job is not None:
+                job.record_status(api_resp)
         while api_resp.get("state") in ("pending", "running"):
-            time.sleep(1)
+            time.sleep(self.POLL_INTERVAL_S)
             api_resp = self._api_status(api_resp)
+            if job is not None:
+                job.record_status(api_resp)
         if api_resp.get("state") != "completed":
             raise ExecutionError(
                 "query did not complete. response=`{}`".format(api_resp)
             )
+        return api_resp
 
-        # download the files and yield the rows
+    def _rows(self, api_resp, job=None, columns=None):
+        """
+        Download the files of a completed export and yield the decoded rows
+        """
+        decoder = decode.decoder(self.export_format, columns)
+        shards = self._shards(api_resp, job)
         try:
+            for path in shards:
+                yield from profiling.iterate("decode", decoder.rows(path))
+        finally:
+            shards.close()
+
+    def _shards(self, api_resp, job=None, keep=False):
+        """
+        Download the files of a completed export and yield their local paths,
+        each as soon as it is there. Closing the generator cancels the
+        downloads still running. Without a job the files are removed as soon
+        as the generator finishes; with a job they are kept until every shard
+        has been read, or for the caller to remove when keep is set.
+        """
+        if job is None:
             local = tempfile.mkdtemp()
-            for path in self._s3_download(api_resp["path"], local):
-                with gzip.open(path, "rt") as csv_file:
-                    for row in csv.DictReader(csv_file):
-                        yield row
+            downloads = self._s3_download(api_resp["path"], local)
+            try:
+                yield from profiling.iterate("download", downloads)
+            finally:
+                _close(downloads)
+                shutil.rmtree(local)
+            return
 
+        os.makedirs(job.download_dir, exist_ok=True)
+        downloads = self._s3_download(
+            api_resp["path"],
+            job.download_dir,
+            skip=job.local_shards(),
+            on_complete=job.record_shard,
+        )
+        try:
+            yield from profiling.iterate("download", downloads)
         finally:
-            shutil.rmtree(local)
+            _close(downloads)
+        if not keep:
+            job.remove()
 
     def _api_request(self, query_dict):
         """
         Issue a raw request to the export API and return the raw response
         """
         self.log.info("query:\n{}".format(json.dumps(query_dict, indent=2)))
-        resp = requests.post(
-            API.ENDPOINT, json=query_dict, headers=self._headers()
-        ).json()
+        with profiling.stage("submit"):
+            resp = self.retry.call(
+                self._scheduled_call,
+                "post",
+                API.ENDPOINT,
+                log=self.log,
+                json=query_dict,
+            )
         self.log.info("api_request response:\n{}".format(json.dumps(resp, indent=2)))
-        if resp.get("status", 200) != 200:
-            raise ExecutionError(resp.get("detail", {}).get("message", "unknown error"))
-
         return resp
 
     def _api_status(self, req):
         """
         Request the status for a previous raw request and return the raw response
         """
-        resp = requests.get(
-            "{}/{}".format(API.ENDPOINT, req["id"]), headers=self._headers()
-        ).json()
+        resp = self.retry.call(
+            self._scheduled_call,
+            "get",
+            "{}/{}".format(API.ENDPOINT, req["id"]),
+            log=self.log,
+        )
         self.log.info("api_status response:\n{}".format(json.dumps(resp, indent=2)))
         return resp
 
+    def _scheduled_call(self, method, url, **kwargs):
+        """
+        Make a single call to the export API once the scheduler, if any,
+        gives it a turn
+        """
+        if self.scheduler is None:
+            return self._api_call(method, url, **kwargs)
+        return self.scheduler.call(
+            self._api_call, method, url, priority=self.priority, **kwargs
+        )
+
+    def _api_call(self, method, url, **kwargs):
+        """
+        Make a single call to the export API and return the decoded body.
+        Dropped connections, throttling and server errors raise TransientError
+        so the retry policy can try again; anything else that is not a
+        successful response raises ExecutionError.
+
+        Submitting an export is not idempotent: a submission whose response
+        is lost may still have started an export, and retrying it would start
+        a second one. Posts are therefore only retried when they were
+        throttled or could not connect, other failures raise ExecutionError.
+        """
+        import requests  # pylint: disable=C0415
+
+        idempotent = method.lower() != "post"
+        try:
+            http_resp = self._http().request(
+                method, url, headers=self._headers(), timeout=self.TIMEOUT_S, **kwargs
+            )
+        except requests.RequestException as err:
+            message = "{} {} failed: {}".format(method, url, err)
+            if idempotent or _unsent(err):
+                raise TransientError(message) from err
+            raise ExecutionError(
+                "{}, the export may have been submitted".format(message)
+            ) from err
+
+        try:
+            resp = http_resp.json()
+        except ValueError:
+            resp = {}
+        if not isinstance(resp, dict):
+            resp = {"body": resp}
+
+        # the body's status, when it has one, overrides a successful http code
+        status = resp.get("status", http_resp.status_code)
+        if status in THROTTLED_STATUS or http_resp.status_code in THROTTLED_STATUS:
+            raise ThrottledError(
+                "{} {} returned {}".format(method, url, http_resp.status_code)
+            )
+        if status in TRANSIENT_STATUS or http_resp.status_code in TRANSIENT_STATUS:
+            message = "{} {} returned {}".format(method, url, http_resp.status_code)
+            if idempotent:
+                raise TransientError(message)
+            raise ExecutionError(
+                "{}, the export may have been submitted".format(message)
+            )
+        if not 200 <= http_resp.status_code < 300 or resp.get("status", 200) != 200:
+            raise ExecutionError(resp.get("detail", {}).get("message", "unknown error"))
+        return resp
+
+    def _http(self):
+        """
+        requests.Session shared by the calls of this api so that connections
+        are reused
+        """
+        if self._session is None:
+            import requests  # pylint: disable=C0415
+
+            self._session = requests.Session()
+        return self._session
+
     def _headers(self):
         """
         Header structure with authentication key
         """
         return {"x-api-key": self.auth["zaius_secret_key"]}
 
-    def _s3_download(self, s3_url, local_path):
+    def _s3_download(self, s3_url, local_path, skip=(), on_complete=None):
         """
-        Download everything at s3_url to a local path. Remove metdata file and
-        return set of local paths to downloaded content.
+        Download the data files of the export at s3_url to a local path and
+        yield their local paths, sorted, each as soon as it is there. The
+        export's complete.json manifest drives the download; the prefix is only
+        listed if the manifest does not describe the files. Keys in skip are
+        assumed to already be present in local_path and are not downloaded
+        again. Downloads run a few shards ahead of the caller, closing the
+        generator cancels them, see zaius.s3.iter_s3_download.
+        """
+        bucket, prefix = self._parse_s3_url(s3_url)
+        manifest = self._manifest(bucket, prefix)
+
+        skip = set(skip)
+        downloads = iter_s3_download(
+            self.auth,
+            bucket,
+            [key for key in manifest.keys if key not in skip],
+            local_path,
+            sizes=manifest.sizes,
+            retry=self.retry,
+            pool=self.pool,
+        )
+        try:
+            for key in manifest.keys:
+                if key not in skip:
+                    # downloads come back in the order of the manifest
+                    next(downloads)
+                    if on_complete is not None:
+                        on_complete(key)
+                try:
+                    path = manifest.verify_shard(local_path, key)
+                except ManifestError as err:
+                    raise ExecutionError(str(err))
+                yield path
+        finally:
+            downloads.close()
+
+    # pylint: disable=R0201
+    def _parse_s3_url(self, s3_url):
+        """
+        Split an s3 url into bucket and key prefix
         """
         path_parts = re.match(r"s3:\/\/([^/]+)\/(.*)", s3_url)
-        bucket = path_parts.group(1)
-        prefix = path_parts.group(2)
+        return path_parts.group(1), path_parts.group(2)
 
-        kwargs = {"bucket": bucket, "prefix": prefix}
-        keys = []
+    def _manifest(self, bucket, prefix):
+        """
+        Load the export manifest, falling back to listing the prefix if the
+        manifest is missing or does not list the files
+        """
+        body = self.retry.call(
+            read_object, self.auth, bucket, manifest_key(prefix), log=self.log
+        )
+        result = load_manifest(body, bucket, prefix) if body is not None else None
+        if result is not None:
+            return result
+
+        self.log.info("no usable manifest under {}, listing files".format(prefix))
+        objects = []
+        token = None
         while True:
-            objs = list_objects(self.auth, **kwargs)
-            keys.extend([obj["Key"] for obj in objs["Contents"]])
-            if "NextContinuationToken" in objs:
-                kwargs["ContinuationToken"] = objs["NextContinuationToken"]
-            else:
+            objs = self.retry.call(
+                list_objects,
+                self.auth,
+                bucket,
+                prefix,
+                continuation_token=token,
+                log=self.log,
+            )
+            objects.extend(objs.get("Contents", []))
+            token = objs.get("NextContinuationToken")
+            if token is None:
                 break
-        par_s3_download(self.auth, bucket, keys, local_path)
-        os.remove(os.path.join(local_path, "complete.json"))
-        return [os.path.join(local_path, p) for p in sorted(os.listdir(local_path))]
+        return Manifest.from_listing(objects)
+
+
+def _close(iterable):
+    """Close a generator early, other iterables hold nothing to release"""
+    close = getattr(iterable, "close", None)
+    if close is not None:
+        close()
+
+
+def _unsent(err):
+    """True if a request failed before it could reach the server"""
+    import requests  # pylint: disable=C0415
+    import urllib3  # pylint: disable=C0415
+
+    if isinstance(err, requests.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], "reason", None) if err.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
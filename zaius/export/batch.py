@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Batching many small queries into shared exports.
+
+Every export pays a fixed cost for submission, polling and the s3 round
+trip. A QueryBatch collects queries, runs the fewest exports that can
+answer all of them (see fusion) and hands each query back only the rows
+that match its own filter.
+"""
+
+from .fusion import fuse, groups
+from . import parser
+
+
+class QueryBatch:
+    """
+    Collects queries and runs them as fused exports. Use through
+    API.batch():
+
+        with api.batch() as batch:
+            clicks = batch.query("select zaius_id from events where action = 'click'")
+            opens = batch.query("select zaius_id from events where action = 'open'")
+        len(list(clicks)), len(list(opens))
+
+    The exports run when the with block exits, or as soon as one of the
+    results is iterated. Results are buffered in memory, so batches are
+    meant for many small queries rather than a few large ones.
+    """
+
+    def __init__(self, api):
+        """
+        Args:
+            api (zaius.export.API): api used to run the fused exports
+        """
+        self.api = api
+        self.queries = []
+        self.results = None
+
+    def query(self, stmt):
+        """
+        Add an SQL like query to the batch
+
+        Args:
+            stmt (string): sql-like query
+
+        Returns:
+            BatchResult: iterable over the rows of this query
+        """
+        return self.query_raw(parser.parse(stmt))
+
+    def query_raw(self, query_dict):
+        """
+        Add a raw query to the batch
+
+        Args:
+            query_dict (dict): query structure as defined by api documentation
+
+        Returns:
+            BatchResult: iterable over the rows of this query
+        """
+        if self.results is not None:
+            raise ValueError("batch has already been executed")
+        self.queries.append(query_dict)
+        return BatchResult(self, len(self.queries) - 1)
+
+    def execute(self):
+        """
+        Run the exports for every query added so far. Called automatically,
+        running it again is a no-op.
+        """
+        if self.results is not None:
+            return
+        results = [[] for _ in self.queries]
+        for group in groups(self.queries):
+            merged, predicates = fuse([self.queries[idx] for idx in group])
+            targets = [
+                (
+                    results[idx],
+                    predicate,
+                    self.queries[idx]["select"]["fields"],
+                    self.queries[idx]["select"].get("limit"),
+                )
+                for idx, predicate in zip(group, predicates)
+            ]
+            for row in self.api.query_raw(merged):
+                for rows, predicate, fields, limit in targets:
+                    if (limit is None or len(rows) < limit) and predicate(row):
+                        rows.append({field: row[field] for field in fields})
+        self.results = results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+
+class BatchResult:
+    """
+    The rows of one query in a QueryBatch
+    """
+
+    def __init__(self, batch, idx):
+        self.batch = batch
+        self.idx = idx
+
+    def __iter__(self):
+        self.batch.execute()
+        return iter(self.batch.results[self.idx])
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Compressed bitmaps of 32 bit integers.
+
+Bitmap follows the roaring layout: values are split on their high 16
+bits into containers, sparse containers hold a sorted array of the low
+16 bits and dense ones a 65536 bit bitset (a python int, so set
+operations run in C). Its serialize and deserialize use the portable
+roaring format, so blobs can be shared with pyroaring, which backend()
+prefers when it is installed (`pip install zaius_export[roaring]`).
+"""
+
+import bisect
+import functools
+import importlib
+import itertools
+import operator
+import struct
+import sys
+from array import array
+
+# a container holding more values than this is a bitset
+ARRAY_MAX = 4096
+BITSET_BYTES = 8192
+# portable roaring format cookies
+SERIAL_COOKIE_NO_RUN = 12346
+SERIAL_COOKIE = 12347
+# with run containers, offsets are only written from this many containers
+NO_OFFSET_THRESHOLD = 4
+
+_BACKEND = None
+
+
+def backend():
+    """
+    The bitmap class used for cohorts
+
+    Returns:
+        type: pyroaring.BitMap if installed, else Bitmap
+    """
+    global _BACKEND  # pylint: disable=W0603
+    if _BACKEND is None:
+        try:
+            _BACKEND = importlib.import_module("pyroaring").BitMap
+        except ImportError:
+            _BACKEND = Bitmap
+    return _BACKEND
+
+
+def union(bitmaps, bitmap_class=None):
+    """
+    Union of bitmaps
+
+    Args:
+        bitmaps (iterable): bitmaps to combine
+        bitmap_class (type): type of the empty result, defaults to backend()
+
+    Returns:
+        bitmap: values in any of bitmaps
+    """
+    empty = (bitmap_class or backend())()
+    return functools.reduce(operator.or_, bitmaps, empty)
+
+
+if hasattr(int, "bit_count"):
+    _popcount = int.bit_count
+else:
+
+    def _popcount(bits):
+        return bin(bits).count("1")
+
+
+class Bitmap:
+    """
+    Set of integers in [0, 2**32) with the interface of pyroaring.BitMap
+    used by cohorts: add, update, in, len, iteration in order, the &, |,
+    - and ^ operators, serialize and deserialize.
+    """
+
+    def __init__(self, values=()):
+        """
+        Args:
+            values (iterable): initial values
+        """
+        # high 16 bits -> array("H") of sorted low bits, or int bitset
+        self.containers = {}
+        self.update(values)
+
+    def add(self, value):
+        """Add one value"""
+        self.update((value,))
+
+    def update(self, values):
+        """Add every value of an iterable"""
+        for key, group in itertools.groupby(sorted(values), lambda value: value >> 16):
+            if not 0 <= key <= 0xFFFF:
+                raise ValueError("bitmap values must be in [0, 2**32)")
+            # sorted without duplicates
+            lows = list(dict.fromkeys(value & 0xFFFF for value in group))
+            current = self.containers.get(key)
+            if isinstance(current, int):
+                self.containers[key] = current | _to_bitset(lows)
+            else:
+                if current is not None:
+                    lows = sorted(set(current).union(lows))
+                self.containers[key] = _from_sorted(lows)
+
+    def __contains__(self, value):
+        container = self.containers.get(value >> 16)
+        if container is None:
+            return False
+        low = value & 0xFFFF
+        if isinstance(container, int):
+            return bool(container >> low & 1)
+        idx = bisect.bisect_left(container, low)
+        return idx < len(container) and container[idx] == low
+
+    def __len__(self):
+        return sum(_cardinality(container) for container in self.containers.values())
+
+    def __iter__(self):
+        for key in sorted(self.containers):
+            high = key << 16
+            for low in _values(self.containers[key]):
+                yield high | low
+
+    def __eq__(self, other):
+        if isinstance(other, Bitmap):
+            return self.containers == other.containers
+        return NotImplemented
+
+    def __repr__(self):
+        return "Bitmap(<{} values>)".format(len(self))
+
+    def __and__(self, other):
+        return self._combine(other, operator.and_, set.__and__, set.__and__)
+
+    def __or__(self, other):
+        return self._combine(other, operator.or_, set.__or__, set.__or__)
+
+    def __xor__(self, other):
+        return self._combine(other, operator.xor, set.__xor__, set.__or__)
+
+    def __sub__(self, other):
+        return self._combine(
+            other,
+            lambda left, right: left & ~right,
+            set.__sub__,
+            lambda left, right: left,
+        )
+
+    def _combine(self, other, bitset_op, set_op, keys_op):
+        """
+        Apply a set operation container by container
+
+        Args:
+            other (Bitmap): right hand side
+            bitset_op (callable): the operation on two int bitsets
+            set_op (callable): the operation on two sets of low bits
+            keys_op (callable): the containers keys the result can have,
+                from the sets of keys of both sides
+        """
+        if not isinstance(other, Bitmap):
+            other = Bitmap(other)
+        result = Bitmap()
+        for key in keys_op(set(self.containers), set(other.containers)):
+            left = self.containers.get(key, array("H"))
+            right = other.containers.get(key, array("H"))
+            if isinstance(left, int) or isinstance(right, int):
+                container = _normalize(bitset_op(_as_bitset(left), _as_bitset(right)))
+            else:
+                container = _from_sorted(sorted(set_op(set(left), set(right))))
+            if _cardinality(container):
+                result.containers[key] = container
+        return result
+
+    def serialize(self):
+        """
+        Returns:
+            bytes: the bitmap in the portable roaring format
+        """
+        keys = sorted(self.containers)
+        header = [struct.pack("<II", SERIAL_COOKIE_NO_RUN, len(keys))]
+        payloads = []
+        for key in keys:
+            container = self.containers[key]
+            header.append(struct.pack("<HH", key, _cardinality(container) - 1))
+            if isinstance(container, int):
+                payloads.append(container.to_bytes(BITSET_BYTES, "little"))
+            else:
+                payloads.append(_little_endian(container).tobytes())
+        offset = 8 + 8 * len(keys)
+        for payload in payloads:
+            header.append(struct.pack("<I", offset))
+            offset += len(payload)
+        return b"".join(header + payloads)
+
+    @classmethod
+    def deserialize(cls, data):
+        """
+        Read a bitmap in the portable roaring format, as written by
+        serialize or by pyroaring and the other roaring libraries
+
+        Args:
+            data (bytes): the serialized bitmap
+
+        Returns:
+            Bitmap: the bitmap
+        """
+        (cookie,) = struct.unpack_from("<I", data, 0)
+        if cookie == SERIAL_COOKIE_NO_RUN:
+            (count,) = struct.unpack_from("<I", data, 4)
+            runs = bytes((count + 7) // 8)
+            pos = 8
+        elif cookie & 0xFFFF == SERIAL_COOKIE:
+            count = (cookie >> 16) + 1
+            runs = data[4:4 + (count + 7) // 8]
+            pos = 4 + len(runs)
+        else:
+            raise ValueError("not a serialized roaring bitmap")
+        descriptions = struct.unpack_from("<{}H".format(2 * count), data, pos)
+        pos += 4 * count
+        if cookie == SERIAL_COOKIE_NO_RUN or count >= NO_OFFSET_THRESHOLD:
+            pos += 4 * count
+
+        bitmap = cls()
+        for idx in range(count):
+            key, cardinality = descriptions[2 * idx], descriptions[2 * idx + 1] + 1
+            if runs[idx // 8] >> (idx % 8) & 1:
+                (run_count,) = struct.unpack_from("<H", data, pos)
+                pairs = struct.unpack_from("<{}H".format(2 * run_count), data, pos + 2)
+                pos += 2 + 4 * run_count
+                lows = [
+                    low
+                    for start, length in zip(pairs[::2], pairs[1::2])
+                    for low in range(start, start + length + 1)
+                ]
+                container = _from_sorted(lows)
+            elif cardinality > ARRAY_MAX:
+                container = int.from_bytes(data[pos:pos + BITSET_BYTES], "little")
+                pos += BITSET_BYTES
+            else:
+                container = array("H")
+                container.frombytes(data[pos:pos + 2 * cardinality])
+                container = _little_endian(container)
+                pos += 2 * cardinality
+            bitmap.containers[key] = container
+        return bitmap
+
+
+def _cardinality(container):
+    if isinstance(container, int):
+        return _popcount(container)
+    return len(container)
+
+
+def _to_bitset(lows):
+    """Bitset of a list of low bits"""
+    bits = bytearray(BITSET_BYTES)
+    for low in lows:
+        bits[low >> 3] |= 1 << (low & 7)
+    return int.from_bytes(bits, "little")
+
+
+def _as_bitset(container):
+    if isinstance(container, int):
+        return container
+    return _to_bitset(container)
+
+
+def _values(container):
+    """Sorted low bits of a container"""
+    if not isinstance(container, int):
+        return container
+    return [
+        idx * 8 + bit
+        for idx, byte in enumerate(container.to_bytes(BITSET_BYTES, "little"))
+        if byte
+        for bit in range(8)
+        if byte >> bit & 1
+    ]
+
+
+def _normalize(bits):
+    """The canonical container of a bitset: an array when it is sparse"""
+    if _popcount(bits) > ARRAY_MAX:
+        return bits
+    return array("H", _values(bits))
+
+
+def _from_sorted(lows):
+    """The canonical container of sorted, distinct low bits"""
+    if len(lows) > ARRAY_MAX:
+        return _to_bitset(lows)
+    return array("H", lows)
+
+
+def _little_endian(values):
+    """The array itself on little endian machines, a swapped copy otherwise"""
+    if sys.byteorder == "little":
+        return values
+    swapped = array("H", values)
+    swapped.byteswap()
+    return swapped
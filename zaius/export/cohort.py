@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+User cohorts as compressed bitmaps.
+
+Set algebra over users ("opened campaign A but not B and purchased that
+week") used to mean several exports and python sets of zaius_id strings.
+A CohortStore instead gives every user a stable, dense integer id from a
+dictionary persisted in sqlite and keeps one bitmap of those ids per
+(event_type, action, campaign_id, day) of the events it ingests. Cohorts
+are unions of these bitmaps, combined with the bitmap operators & | - ^,
+and len() is their cardinality.
+
+    Example:
+        with CohortStore("cohorts.db") as store:
+            store.ingest_export(api, start_ts, end_ts, event_type="email")
+            opened_a = store.cohort(action="open", campaign_id="9097")
+            opened_b = store.cohort(action="open", campaign_id="9098")
+            cohort = opened_a - opened_b
+            rows = store.query(api, "select zaius_id, ts from events", cohort)
+
+Bitmaps are pyroaring BitMaps when it is installed, zaius.export.bitmap
+Bitmaps otherwise; both read and write the same portable format.
+"""
+
+import datetime
+import sqlite3
+
+from . import bitmap as bitmaps
+from . import parser
+
+# rows resolved against the id dictionary at a time
+BATCH_ROWS = 10000
+# ids of users kept in memory, the dictionary is emptied beyond this
+CACHE_IDS = 1000000
+# sqlite host parameters per statement, below the historical limit of 999
+SQL_VARIABLES = 900
+# cohorts up to this size are also sent to the export api as a filter
+PUSHDOWN_IDS = 64
+# fields of the events a cohort store is built from
+FIELDS = ["zaius_id", "ts", "event_type", "action", "campaign_id"]
+# bitmap key columns
+KEYS = ["event_type", "action", "campaign_id", "day"]
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+class IdDictionary:
+    """Stable dense integer ids for zaius_ids, persisted in sqlite"""
+
+    def __init__(self, connection):
+        """
+        Args:
+            connection (sqlite3.Connection): database holding the ids
+        """
+        self.db = connection
+        self.db.execute(
+            "create table if not exists ids "
+            "(id integer primary key, zaius_id text unique not null)"
+        )
+        self.cache = {}
+
+    def ids(self, zaius_ids, assign=True):
+        """
+        Ids of zaius_ids
+
+        Args:
+            zaius_ids (list): zaius_id strings, may repeat
+            assign (bool): give unknown zaius_ids a new id, otherwise their
+                id is None
+
+        Returns:
+            list: the id of each zaius_id
+        """
+        if len(self.cache) > CACHE_IDS:
+            self.cache = {}
+        missing = list(
+            dict.fromkeys(key for key in zaius_ids if key not in self.cache)
+        )
+        if missing:
+            if assign:
+                self.db.executemany(
+                    "insert or ignore into ids (zaius_id) values (?)",
+                    ((key,) for key in missing),
+                )
+            for chunk in _chunks(missing):
+                self.cache.update(
+                    self.db.execute(
+                        "select zaius_id, id from ids where zaius_id in ({})".format(
+                            ",".join("?" * len(chunk))
+                        ),
+                        chunk,
+                    )
+                )
+        return [self.cache.get(key) for key in zaius_ids]
+
+    def zaius_ids(self, ids):
+        """
+        zaius_ids of ids, the inverse of ids()
+
+        Args:
+            ids (iterable): ids given out by this dictionary
+
+        Returns:
+            list: zaius_id strings, in the order of ids
+        """
+        ids = list(ids)
+        found = {}
+        for chunk in _chunks(ids):
+            found.update(
+                self.db.execute(
+                    "select id, zaius_id from ids where id in ({})".format(
+                        ",".join("?" * len(chunk))
+                    ),
+                    chunk,
+                )
+            )
+        return [found[idx] for idx in ids]
+
+
+class CohortStore:
+    """
+    Id dictionary and per event key bitmaps in a sqlite database, see the
+    module documentation
+    """
+
+    def __init__(self, path, bitmap_class=None):
+        """
+        Args:
+            path (str): sqlite database, created if missing
+            bitmap_class (type): bitmap implementation, defaults to
+                zaius.export.bitmap.backend()
+        """
+        self.bitmap_class = bitmap_class or bitmaps.backend()
+        self.db = sqlite3.connect(path)
+        self.ids = IdDictionary(self.db)
+        self.db.execute(
+            "create table if not exists bitmaps ("
+            "event_type text, action text, campaign_id text, day text, data blob, "
+            "primary key (event_type, action, campaign_id, day))"
+        )
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the database"""
+        self.db.close()
+
+    def ingest(self, rows):
+        """
+        Add events to the bitmaps
+
+        Args:
+            rows (iterable): dicts with zaius_id and ts, and optionally
+                event_type, action and campaign_id
+
+        Returns:
+            int: number of rows added
+        """
+        pending = {}
+        days = {}
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= BATCH_ROWS:
+                count += self._add_batch(batch, pending, days)
+                batch = []
+        count += self._add_batch(batch, pending, days)
+
+        for key, values in pending.items():
+            current = self._load(key)
+            if current is not None:
+                values = values | current
+            self.db.execute(
+                "insert or replace into bitmaps values (?, ?, ?, ?, ?)",
+                key + (values.serialize(),),
+            )
+        self.db.commit()
+        return count
+
+    def ingest_export(self, api, start_ts, end_ts, event_type=None):
+        """
+        Export the events between two timestamps and add them
+
+        Args:
+            api (zaius.export.API): the export api
+            start_ts (int): inclusive lower bound on ts
+            end_ts (int): exclusive upper bound on ts
+            event_type (str): only add events of this type
+
+        Returns:
+            int: number of events added
+        """
+        stmt = "select {} from events where ts >= {} and ts < {}".format(
+            ", ".join(FIELDS), int(start_ts), int(end_ts)
+        )
+        if event_type is not None:
+            stmt += " and event_type = '{}'".format(event_type)
+        return self.ingest(api.query(stmt))
+
+    def cohort(
+        self,
+        event_type=None,
+        action=None,
+        campaign_id=None,
+        start_day=None,
+        end_day=None,
+    ):
+        """
+        Users with at least one matching event. Arguments left to None match
+        anything.
+
+        Args:
+            event_type (str): event type
+            action (str): event action
+            campaign_id (str): campaign
+            start_day (datetime.date or str): first day, inclusive
+            end_day (datetime.date or str): last day, inclusive
+
+        Returns:
+            bitmap: the users' ids
+        """
+        terms = []
+        values = []
+        for column, value in zip(KEYS[:3], (event_type, action, campaign_id)):
+            if value is not None:
+                terms.append("{} = ?".format(column))
+                values.append(str(value))
+        if start_day is not None:
+            terms.append("day >= ?")
+            values.append(str(start_day))
+        if end_day is not None:
+            terms.append("day <= ?")
+            values.append(str(end_day))
+        sql = "select data from bitmaps"
+        if terms:
+            sql += " where " + " and ".join(terms)
+        found = self.db.execute(sql, values)
+        return bitmaps.union(
+            (self.bitmap_class.deserialize(data) for (data,) in found),
+            self.bitmap_class,
+        )
+
+    def keys(self):
+        """
+        Returns:
+            list: (event_type, action, campaign_id, day) of every bitmap
+        """
+        sql = "select {} from bitmaps order by 1, 2, 3, 4".format(", ".join(KEYS))
+        return list(self.db.execute(sql))
+
+    def members(self, cohort):
+        """
+        Returns:
+            list: zaius_ids of the users of cohort, in id order
+        """
+        return self.ids.zaius_ids(list(cohort))
+
+    def filter(self, rows, cohort):
+        """
+        Pass through the rows of users in cohort
+
+        Args:
+            rows (iterable): dicts with a zaius_id
+            cohort (bitmap): the users to keep
+        """
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= BATCH_ROWS:
+                yield from self._filter_batch(batch, cohort)
+                batch = []
+        yield from self._filter_batch(batch, cohort)
+
+    def query(self, api, stmt, cohort):
+        """
+        Run a query restricted to the users of a cohort. The export api has
+        no set membership filter, so small cohorts are sent as a filter on
+        zaius_id and larger ones are filtered as the rows are read.
+
+        Args:
+            api (zaius.export.API): the export api
+            stmt (str): sql-like query selecting zaius_id
+            cohort (bitmap): the users to keep
+
+        Yields:
+            (dict) rows of the users of cohort
+        """
+        query_dict = parser.parse(stmt)
+        select = query_dict["select"]
+        if "zaius_id" not in select["fields"]:
+            raise ValueError("cohort queries must select zaius_id")
+        if not cohort:
+            return
+        if len(cohort) <= PUSHDOWN_IDS:
+            members = _any_of("zaius_id", self.members(cohort))
+            if select.get("filter") is not None:
+                members = {"and": [select["filter"], members]}
+            query_dict = {**query_dict, "select": {**select, "filter": members}}
+        yield from self.filter(api.query_raw(query_dict), cohort)
+
+    def _add_batch(self, batch, pending, days):
+        """Resolve the ids of a batch of rows and add them to pending"""
+        ids = self.ids.ids([row["zaius_id"] for row in batch])
+        keys = {}
+        for row, idx in zip(batch, ids):
+            day_number = int(float(row["ts"])) // 86400
+            day = days.get(day_number)
+            if day is None:
+                day = days[day_number] = datetime.date.fromordinal(
+                    EPOCH_ORDINAL + day_number
+                ).isoformat()
+            key = (
+                row.get("event_type") or "",
+                row.get("action") or "",
+                str(row.get("campaign_id") or ""),
+                day,
+            )
+            keys.setdefault(key, []).append(idx)
+        for key, values in keys.items():
+            if key in pending:
+                pending[key].update(values)
+            else:
+                pending[key] = self.bitmap_class(values)
+        return len(batch)
+
+    def _filter_batch(self, batch, cohort):
+        ids = self.ids.ids([row["zaius_id"] for row in batch], assign=False)
+        return [
+            row for row, idx in zip(batch, ids) if idx is not None and idx in cohort
+        ]
+
+    def _load(self, key):
+        found = self.db.execute(
+            "select data from bitmaps where {}".format(
+                " and ".join("{} = ?".format(column) for column in KEYS)
+            ),
+            key,
+        ).fetchone()
+        return None if found is None else self.bitmap_class.deserialize(found[0])
+
+
+def _any_of(field, values):
+    """Balanced filter tree matching field = any of values"""
+    if len(values) == 1:
+        return {"field": field, "operator": "=", "value": values[0]}
+    middle = len(values) // 2
+    return {"or": [_any_of(field, values[:middle]), _any_of(field, values[middle:])]}
+
+
+def _chunks(values):
+    for start in range(0, len(values), SQL_VARIABLES):
+        yield values[start:start + SQL_VARIABLES]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Decoding downloaded export shards into rows.
+
+CSV shards are gzipped text (see decompress) and every value comes back
+as a string.
+Parquet shards are typed and columnar; only the selected columns are
+read, and they can be consumed either as rows (dicts, like csv) or as
+pyarrow record batches. Parquet support needs pyarrow, an optional
+dependency.
+
+Results ordered by a key can also be consumed one key at a time. For
+parquet the group boundaries are found with vectorized comparisons over
+each record batch rather than row by row.
+"""
+
+import csv
+import itertools
+
+from . import decompress
+
+FORMATS = ("csv", "parquet")
+
+
+def decoder(fmt, columns=None):
+    """
+    Build the decoder for an export format
+
+    Args:
+        fmt (str): one of FORMATS
+        columns (list): fields selected by the query. Columnar formats only
+            read these.
+
+    Returns:
+        CsvDecoder or ParquetDecoder
+    """
+    if fmt == "csv":
+        return CsvDecoder()
+    if fmt == "parquet":
+        return ParquetDecoder(columns)
+    raise ValueError("unsupported export format {}".format(fmt))
+
+
+class CsvDecoder:
+    """Rows of gzipped csv shards, every value a string"""
+
+    # pylint: disable=R0201
+    def rows(self, path):
+        """
+        Yield the rows of a shard as dicts
+        """
+        with decompress.open_text(path) as csv_file:
+            for row in csv.DictReader(csv_file):
+                yield row
+
+
+class ParquetDecoder:
+    """Typed rows or record batches of parquet shards"""
+
+    # rows decoded at a time
+    BATCH_ROWS = 65536
+
+    def __init__(self, columns=None):
+        """
+        Args:
+            columns (list): columns to read, None for all of them
+        """
+        try:
+            import pyarrow.parquet  # pylint: disable=C0415
+        except ImportError:
+            raise ValueError("parquet exports require pyarrow to be installed")
+        self.parquet = pyarrow.parquet
+        self.columns = columns
+
+    def batches(self, path):
+        """
+        Yield the shard as pyarrow.RecordBatch objects holding only the
+        selected columns
+        """
+        parquet_file = self.parquet.ParquetFile(path)
+        columns = self.columns
+        if columns is not None:
+            names = set(parquet_file.schema_arrow.names)
+            columns = [column for column in columns if column in names] or None
+        for batch in parquet_file.iter_batches(
+            batch_size=self.BATCH_ROWS, columns=columns
+        ):
+            yield batch
+
+    def rows(self, path):
+        """
+        Yield the rows of a shard as dicts of typed values
+        """
+        for batch in self.batches(path):
+            yield from batch.to_pylist()
+
+
+def group_rows(rows, key):
+    """
+    Group consecutive rows sharing the same key
+
+    Args:
+        rows (iterable): rows (dicts) ordered by key
+        key (str): field to group on
+
+    Yields:
+        tuple: (key value, list of the rows with that value)
+    """
+    for value, group in itertools.groupby(rows, lambda row: row[key]):
+        yield value, list(group)
+
+
+def group_batches(batches, key):
+    """
+    Regroup record batches ordered by key into one record batch per key.
+    A key whose rows span several batches is combined into one.
+
+    Args:
+        batches (iterable): pyarrow.RecordBatch objects ordered by key
+        key (str): column to group on
+
+    Yields:
+        tuple: (key value, pyarrow.RecordBatch holding the rows of that key)
+    """
+    import pyarrow.compute  # pylint: disable=C0415
+
+    # slices of the last key seen, it may continue in the next batch
+    pending = []
+    pending_key = None
+    for batch in batches:
+        num_rows = batch.num_rows
+        if num_rows == 0:
+            continue
+        column = batch.column(key)
+        changed = pyarrow.compute.not_equal(
+            column.slice(1), column.slice(0, num_rows - 1)
+        )
+        # null keys never compare equal, each forms its own group
+        changed = pyarrow.compute.fill_null(changed, True)
+        starts = [0] + [
+            idx + 1 for idx in pyarrow.compute.indices_nonzero(changed).to_pylist()
+        ]
+        ends = starts[1:] + [num_rows]
+
+        for start, end in zip(starts, ends):
+            value = column[start].as_py()
+            if pending and (value != pending_key or start > 0):
+                yield pending_key, _combine(pending)
+                pending = []
+            pending.append(batch.slice(start, end - start))
+            pending_key = value
+    if pending:
+        yield pending_key, _combine(pending)
+
+
+def _combine(batches):
+    """
+    Concatenate record batches into a single contiguous one
+    """
+    if len(batches) == 1:
+        return batches[0]
+    import pyarrow  # pylint: disable=C0415
+
+    return pyarrow.Table.from_batches(batches).combine_chunks().to_batches()[0]
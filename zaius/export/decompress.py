@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+Decompression of gzipped export shards.
+
+Shards are inflated with the fastest zlib compatible module installed
+(python-isal, then zlib-ng, then the standard library zlib) straight
+from a memory map of the file, in large chunks, instead of through
+gzip.open's small reads.
+
+Shards made of several gzip members are inflated on parallel threads,
+zlib releases the GIL while it works. Member boundaries are not known
+up front, so the file is cut into segments at gzip headers found every
+SEGMENT_BYTES and each segment is inflated speculatively. A segment's
+result is only used if the previous one ended exactly on a member
+boundary at its start; otherwise (a single large member, or a header
+look-alike inside compressed data) the data is inflated in order as
+usual, so the output is always that of a sequential pass.
+"""
+
+import collections
+import importlib
+import io
+import mmap
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+# zlib compatible modules, fastest first
+BACKENDS = ("isal.isal_zlib", "zlib_ng.zlib_ng")
+# gzip magic and the deflate compression method
+GZIP_HEADER = b"\x1f\x8b\x08"
+# wbits for gzip framing
+GZIP_WBITS = 31
+# compressed bytes handed to the decompressor at a time
+CHUNK_BYTES = 1024 * 1024
+# compressed bytes inflated by one thread
+SEGMENT_BYTES = 8 * 1024 * 1024
+# buffer between the decompressor and text decoding
+READ_BUFFER_BYTES = 1024 * 1024
+
+_BACKEND = None
+
+
+def backend():
+    """
+    The zlib compatible module used to inflate shards
+
+    Returns:
+        module: exposes decompressobj and error like zlib
+    """
+    global _BACKEND  # pylint: disable=W0603
+    if _BACKEND is None:
+        for name in BACKENDS:
+            try:
+                _BACKEND = importlib.import_module(name)
+                break
+            except ImportError:
+                continue
+        else:
+            _BACKEND = zlib
+    return _BACKEND
+
+
+def open_text(path, threads=None):
+    """
+    Open a gzipped shard for reading text
+
+    Args:
+        path (str): the shard
+        threads (int): threads inflating the members of the shard, defaults
+            to the number of cpus
+
+    Returns:
+        io.TextIOWrapper: utf-8 text stream, newlines untranslated as the
+            csv module expects
+    """
+    raw = _ChunkReader(chunks(path, threads))
+    return io.TextIOWrapper(
+        io.BufferedReader(raw, READ_BUFFER_BYTES), encoding="utf-8", newline=""
+    )
+
+
+def chunks(path, threads=None):
+    """
+    Inflate a gzipped shard
+
+    Args:
+        path (str): the shard
+        threads (int): threads inflating the members of the shard, defaults
+            to the number of cpus
+
+    Yields:
+        (bytes) successive pieces of the decompressed content
+    """
+    threads = threads or os.cpu_count() or 1
+    with open(path, "rb") as compressed:
+        size = os.fstat(compressed.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(compressed.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            with memoryview(mapped) as data:
+                bounds = _segment_bounds(mapped, size)
+                if threads == 1 or len(bounds) <= 2:
+                    inflater = _Inflater(backend())
+                    yield from inflater.feed(data, 0, size)
+                    inflater.finish()
+                else:
+                    yield from _parallel_chunks(data, bounds, threads)
+
+
+def _segment_bounds(mapped, size):
+    """
+    Offsets that split the file into segments of about SEGMENT_BYTES, each
+    but the first starting at something that looks like a gzip header
+    """
+    bounds = [0]
+    while True:
+        candidate = mapped.find(GZIP_HEADER, bounds[-1] + SEGMENT_BYTES)
+        if candidate < 0 or size - candidate < SEGMENT_BYTES // 4:
+            break
+        bounds.append(candidate)
+    bounds.append(size)
+    return bounds
+
+
+def _parallel_chunks(data, bounds, threads):
+    """
+    Inflate the segments between bounds speculatively on a thread pool and
+    stitch the results back together in order
+    """
+    zlib_module = backend()
+    segments = iter(zip(bounds, bounds[1:]))
+    pending = collections.deque()
+    with ThreadPoolExecutor(threads) as pool:
+
+        def submit():
+            # a few segments ahead of the consumer bound the memory held
+            while len(pending) < 2 * threads:
+                segment = next(segments, None)
+                if segment is None:
+                    return
+                future = pool.submit(_inflate_segment, zlib_module, data, *segment)
+                pending.append((segment, future))
+
+        # compressed bytes accounted for so far, and the inflater of a member
+        # that continues past pos (None when pos is on a member boundary)
+        pos = 0
+        inflater = None
+        submit()
+        while pending:
+            (start, end), future = pending.popleft()
+            submit()
+            if inflater is None and start == pos:
+                outputs, result = future.result()
+                if outputs is None:
+                    raise result
+                yield from outputs
+                inflater = None if result.at_boundary else result
+            else:
+                # the segment did not start on a boundary, inflate in order
+                future.cancel()
+                if inflater is None:
+                    inflater = _Inflater(zlib_module)
+                yield from inflater.feed(data, pos, end)
+                if inflater.at_boundary:
+                    inflater = None
+            pos = end
+        if inflater is not None:
+            inflater.finish()
+
+
+def _inflate_segment(zlib_module, data, start, end):
+    """
+    Inflate data[start:end] as if it started with a gzip member
+
+    Returns:
+        tuple: (list of output chunks, _Inflater) or (None, error) if the
+            segment does not start with a valid member
+    """
+    inflater = _Inflater(zlib_module)
+    try:
+        return list(inflater.feed(data, start, end)), inflater
+    except (zlib_module.error, EOFError) as err:
+        return None, err
+
+
+class _Inflater:
+    """Inflates consecutive gzip members fed in pieces"""
+
+    def __init__(self, zlib_module):
+        self.zlib = zlib_module
+        self.obj = zlib_module.decompressobj(GZIP_WBITS)
+        # True when no byte of the current member has been fed yet
+        self.at_boundary = True
+        # only zero padding was found after the last member
+        self.padded = False
+
+    def feed(self, data, start, end):
+        """
+        Inflate data[start:end]
+
+        Yields:
+            (bytes) decompressed output
+        """
+        for offset in range(start, end, CHUNK_BYTES):
+            view = data[offset:min(offset + CHUNK_BYTES, end)]
+            try:
+                while len(view) and not self.padded:
+                    output = self.obj.decompress(view)
+                    if output:
+                        yield output
+                    if not self.obj.eof:
+                        self.at_boundary = False
+                        break
+                    # the member ended, the rest of view belongs to the next one
+                    rest = view[len(view) - len(self.obj.unused_data):]
+                    view.release()
+                    view = rest
+                    self.obj = self.zlib.decompressobj(GZIP_WBITS)
+                    self.at_boundary = True
+                    if len(view) and view[0] == 0 and not bytes(view).strip(b"\0"):
+                        self.padded = True
+            finally:
+                # a view left to the traceback of an error would keep the
+                # memory map from closing and hide the error
+                view.release()
+
+    def finish(self):
+        """Raise if the data ended in the middle of a member"""
+        if not self.at_boundary:
+            raise EOFError(
+                "Compressed file ended before the end-of-stream marker was reached"
+            )
+
+
+class _ChunkReader(io.RawIOBase):
+    """Raw stream over an iterator of bytes"""
+
+    def __init__(self, pieces):
+        super().__init__()
+        self.pieces = pieces
+        self.current = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self.current):
+            piece = next(self.pieces, None)
+            if piece is None:
+                return 0
+            self.current = memoryview(piece)
+        size = min(len(buffer), len(self.current))
+        buffer[:size] = self.current[:size]
+        self.current = self.current[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.pieces.close()
+        super().close()
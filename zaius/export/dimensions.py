@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Client side dimension cache and local joins.
+
+Event queries can select fields of related objects through implicit
+joins (`customer.email`, `order.status`). The export API joins them on
+the server and repeats them on every event row, which makes exports of
+many events per customer much larger than they need to be.
+
+A DimensionCache keeps the related objects (customers, orders, products)
+in sqlite, keyed by their primary key. Queries through it have the
+dimension fields of their select list replaced by the relation's key,
+and the dimension values are joined back in as the rows are read, with
+a hash join against an in memory index of the cached rows. Filters are
+left to the server, so `order.status = 'purchased'` still only exports
+purchases, and the fields a filter or sort refers to stay in the export:
+callers that check the filter again on the rows (fused and batched
+queries do) see the values the server filtered on, not a cached value
+that may be stale or missing.
+
+Dimensions are exported when a query first needs them and exported
+again in full once they are older than max_age_s. The built-in
+RELATIONS have no field that tracks changes to their objects in the
+default schema. An account whose objects carry one (a custom
+`last_modified` timestamp, say) can name it as the since_field of its
+own Relations, which are then refreshed incrementally with only the
+objects changed since the last refresh:
+
+    relations = [
+        Relation("customer", "customers", "zaius_id", "zaius_id", "last_modified")
+    ]
+    cache = DimensionCache("dimensions.db", relations)
+
+    Example:
+        with DimensionCache("dimensions.db") as cache:
+            api = LocalJoinAPI(export.API(), cache)
+            rows = api.query("select ts, customer.email from events")
+"""
+
+import json
+import logging
+import sqlite3
+import time
+
+from . import parser
+from .filters import filter_fields
+
+# seconds a cached dimension is used before it is refreshed
+MAX_AGE_S = 24 * 3600
+# rows written to sqlite at a time
+BATCH_ROWS = 10000
+
+
+class Relation:
+    """An implicit join from events to another object"""
+
+    def __init__(self, name, object_name, key, foreign_key, since_field=None):
+        """
+        Args:
+            name (str): prefix of the relation's fields in event queries
+            object_name (str): object the relation joins to
+            key (str): primary key of the object
+            foreign_key (str): event field holding the key
+            since_field (str): numeric field of the object that grows when
+                it changes, None if refreshes must export every object
+        """
+        self.name = name
+        self.object_name = object_name
+        self.key = key
+        self.foreign_key = foreign_key
+        self.since_field = since_field
+
+
+# relations of the default schema, refreshed in full, see the module
+# documentation for incremental refreshes
+RELATIONS = [
+    Relation("customer", "customers", "zaius_id", "zaius_id"),
+    Relation("order", "orders", "order_id", "order_id"),
+    Relation("product", "products", "product_id", "product_id"),
+]
+
+
+class DimensionCache:
+    """Related objects in a sqlite database, see the module documentation"""
+
+    def __init__(self, path, relations=None, max_age_s=MAX_AGE_S, log=logging):
+        """
+        Args:
+            path (str): sqlite database, created if missing
+            relations (list): Relations that are joined locally, defaults to
+                RELATIONS
+            max_age_s (float): seconds after which a dimension is refreshed
+            log (logging.Logger): destination for log information
+        """
+        self.relations = {
+            relation.name: relation for relation in relations or RELATIONS
+        }
+        self.max_age_s = max_age_s
+        self.log = log
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "create table if not exists dimensions ("
+            "relation text primary key, fields text, watermark real, refreshed real)"
+        )
+        self.db.execute(
+            "create table if not exists objects ("
+            "relation text, key text, data text, primary key (relation, key))"
+        )
+        self.db.commit()
+        # (relation, fields, refreshed) -> index, see index()
+        self.indexes = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the database"""
+        self.db.close()
+
+    def fields(self, relation):
+        """
+        Returns:
+            list: the cached fields of a relation, empty if it is not cached
+        """
+        found = self._meta(relation)
+        return [] if found is None else found[0]
+
+    def refresh(self, api, relation, fields=()):
+        """
+        Export a relation's objects into the cache. Only the objects changed
+        since the last refresh are exported if the relation has a
+        since_field and the cache already holds every field asked for,
+        otherwise the relation is exported again in full.
+
+        Args:
+            api (zaius.export.API): the export api
+            relation (str): name of the relation
+            fields (iterable): fields to cache on top of those already cached
+
+        Returns:
+            int: number of objects exported
+        """
+        spec = self.relations[relation]
+        found = self._meta(relation)
+        cached, watermark = (found[0], found[1]) if found else ([], None)
+        wanted = list(cached)
+        for field in fields:
+            if field not in wanted:
+                wanted.append(field)
+        incremental = (
+            spec.since_field is not None
+            and watermark is not None
+            and wanted == cached
+        )
+
+        select = {"fields": [spec.key], "object": spec.object_name}
+        for field in wanted + [spec.since_field]:
+            if field is not None and field not in select["fields"]:
+                select["fields"].append(field)
+        if incremental:
+            select["filter"] = {
+                "field": spec.since_field,
+                "operator": ">=",
+                "value": watermark,
+            }
+        self.log.info(
+            "{} refresh of {} ({} fields)".format(
+                "incremental" if incremental else "full", relation, len(wanted)
+            )
+        )
+
+        started = time.time()
+        if not incremental:
+            self.db.execute("delete from objects where relation = ?", (relation,))
+        count = 0
+        batch = []
+        for row in api.query_raw({"select": select}):
+            if spec.since_field is not None:
+                since = _number(row.get(spec.since_field))
+                if since is not None and (watermark is None or since > watermark):
+                    watermark = since
+            data = json.dumps([row.get(field) for field in wanted], default=str)
+            batch.append((relation, str(row[spec.key]), data))
+            if len(batch) >= BATCH_ROWS:
+                count += self._write(batch)
+                batch = []
+        count += self._write(batch)
+        self.db.execute(
+            "insert or replace into dimensions values (?, ?, ?, ?)",
+            (relation, json.dumps(wanted), watermark, started),
+        )
+        self.db.commit()
+        return count
+
+    def ensure(self, api, relation, fields):
+        """
+        Refresh a relation if it lacks some of fields or is too old
+
+        Args:
+            api (zaius.export.API): the export api
+            relation (str): name of the relation
+            fields (iterable): fields the caller needs
+        """
+        found = self._meta(relation)
+        if (
+            found is None
+            or any(field not in found[0] for field in fields)
+            or time.time() - found[2] > self.max_age_s
+        ):
+            self.refresh(api, relation, fields)
+
+    def index(self, relation, fields):
+        """
+        Hash index of a relation's cached objects, the build side of the
+        local join. Indexes are kept until the relation is refreshed.
+
+        Args:
+            relation (str): name of the relation
+            fields (list): cached fields to index
+
+        Returns:
+            dict: tuple of the values of fields per key
+        """
+        cached, _, refreshed = self._meta(relation)
+        cache_key = (relation, tuple(fields), refreshed)
+        index = self.indexes.get(cache_key)
+        if index is not None:
+            return index
+        positions = [cached.index(field) for field in fields]
+        index = {}
+        found = self.db.execute(
+            "select key, data from objects where relation = ?", (relation,)
+        )
+        for key, data in found:
+            values = json.loads(data)
+            index[key] = tuple(values[position] for position in positions)
+        self.indexes = {
+            other: value
+            for other, value in self.indexes.items()
+            if other[0] != relation
+        }
+        self.indexes[cache_key] = index
+        return index
+
+    def plan(self, query_dict):
+        """
+        Split the dimension fields off an event query
+
+        Args:
+            query_dict (dict): parsed query
+
+        Returns:
+            (dict, dict): the query to export, with each relation's fields
+                replaced by its foreign key, and the fields to join per
+                relation as (query field, dimension field) pairs. Fields
+                that are filtered or sorted on are left in the export.
+        """
+        select = query_dict["select"]
+        if select["object"] != "events":
+            return query_dict, {}
+        exported = set(sort["field"] for sort in select.get("sorts") or [])
+        exported.update(filter_fields(select.get("filter")))
+        fields = []
+        joins = {}
+        for field in select["fields"]:
+            name, _, dimension_field = field.partition(".")
+            if name in self.relations and dimension_field and field not in exported:
+                joins.setdefault(name, []).append((field, dimension_field))
+            else:
+                fields.append(field)
+        if not joins:
+            return query_dict, {}
+        for name in joins:
+            foreign_key = self.relations[name].foreign_key
+            if foreign_key not in fields:
+                fields.append(foreign_key)
+        return {**query_dict, "select": {**select, "fields": fields}}, joins
+
+    def query(self, api, stmt, job_file=None):
+        """
+        Run an sql-like query, joining dimension fields locally
+
+        Args:
+            api (zaius.export.API): the export api
+            stmt (string): sql-like query
+            job_file (str): optional file used to persist the export state
+
+        Yields:
+            (dict) representing each row of the response
+        """
+        return self.query_raw(api, parser.parse(stmt), job_file=job_file)
+
+    def query_raw(self, api, query_dict, job_file=None):
+        """
+        Run a parsed query, joining dimension fields locally. Rows whose
+        key is not in the cache get empty dimension fields.
+
+        Args:
+            api (zaius.export.API): the export api
+            query_dict (dict): parsed query
+            job_file (str): optional file used to persist the export state
+
+        Yields:
+            (dict) representing each row of the response
+        """
+        exported, joins = self.plan(query_dict)
+        if not joins:
+            yield from api.query_raw(query_dict, job_file=job_file)
+            return
+
+        probes = []
+        for name, pairs in joins.items():
+            dimension_fields = [dimension_field for _, dimension_field in pairs]
+            self.ensure(api, name, dimension_fields)
+            probes.append(
+                (
+                    self.relations[name].foreign_key,
+                    [field for field, _ in pairs],
+                    self.index(name, dimension_fields),
+                    ("",) * len(pairs),
+                )
+            )
+        fields = query_dict["select"]["fields"]
+        misses = 0
+        for row in api.query_raw(exported, job_file=job_file):
+            joined = dict(row)
+            for foreign_key, names, index, empty in probes:
+                key = joined[foreign_key]
+                values = index.get(str(key))
+                if values is None:
+                    values = empty
+                    # events without a related object are expected
+                    misses += key not in (None, "")
+                joined.update(zip(names, values))
+            yield {field: joined[field] for field in fields}
+        if misses:
+            self.log.warning(
+                "{} joins found no cached object, the cache may be stale".format(
+                    misses
+                )
+            )
+
+    def _meta(self, relation):
+        """(fields, watermark, refreshed) of a cached relation, or None"""
+        found = self.db.execute(
+            "select fields, watermark, refreshed from dimensions where relation = ?",
+            (relation,),
+        ).fetchone()
+        if found is None:
+            return None
+        return json.loads(found[0]), found[1], found[2]
+
+    def _write(self, batch):
+        self.db.executemany("insert or replace into objects values (?, ?, ?)", batch)
+        return len(batch)
+
+
+class LocalJoinAPI:
+    """
+    The query methods of an export API, with dimension fields joined from
+    a DimensionCache. Reports can run against it in place of the API.
+    """
+
+    def __init__(self, api, cache):
+        """
+        Args:
+            api (zaius.export.API): the export api
+            cache (DimensionCache): the dimensions to join
+        """
+        self.api = api
+        self.cache = cache
+
+    def query(self, stmt, job_file=None):
+        """See DimensionCache.query"""
+        return self.cache.query(self.api, stmt, job_file=job_file)
+
+    def query_raw(self, query_dict, job_file=None):
+        """See DimensionCache.query_raw"""
+        return self.cache.query_raw(self.api, query_dict, job_file=job_file)
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Client-side evaluation of the filter trees produced by the query parser.
+
+Rows returned by the export API are csv strings, so values are coerced
+to the type of the literal they are compared with. Empty values behave
+like SQL NULL and never match.
+"""
+
+import operator
+
+OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def compile_filter(filter_struct):
+    """
+    Compile a filter tree into a predicate over rows
+
+    Args:
+        filter_struct (dict): the "filter" of a parsed query, or None
+
+    Returns:
+        callable: row (dict) -> bool
+    """
+    if filter_struct is None:
+        return lambda row: True
+    if "field" in filter_struct:
+        return _compile_term(filter_struct)
+    if "and" in filter_struct:
+        left, right = [compile_filter(part) for part in filter_struct["and"]]
+        return lambda row: left(row) and right(row)
+    if "or" in filter_struct:
+        left, right = [compile_filter(part) for part in filter_struct["or"]]
+        return lambda row: left(row) or right(row)
+    if "not" in filter_struct:
+        # `a not b` reads as `a and not b`
+        left, right = [compile_filter(part) for part in filter_struct["not"]]
+        return lambda row: left(row) and not right(row)
+    raise ValueError("cannot compile {}".format(filter_struct))
+
+
+def filter_fields(filter_struct):
+    """
+    Fields referenced by a filter tree
+
+    Args:
+        filter_struct (dict): the "filter" of a parsed query, or None
+
+    Returns:
+        list: field names in order of first appearance
+    """
+    if filter_struct is None:
+        return []
+    if "field" in filter_struct:
+        return [filter_struct["field"]]
+    fields = []
+    for parts in filter_struct.values():
+        for part in parts:
+            for field in filter_fields(part):
+                if field not in fields:
+                    fields.append(field)
+    return fields
+
+
+def _compile_term(filter_struct):
+    """
+    Compile a single `field op value` comparison
+    """
+    field = filter_struct["field"]
+    compare = OPERATORS[filter_struct["operator"]]
+    value = filter_struct["value"]
+
+    if isinstance(value, str):
+        def predicate(row):
+            actual = row.get(field)
+            if actual is None or actual == "":
+                return False
+            return compare(str(actual), value)
+
+        return predicate
+
+    def numeric_predicate(row):
+        actual = row.get(field)
+        if actual is None or actual == "":
+            return False
+        try:
+            return compare(float(actual), value)
+        except (TypeError, ValueError):
+            return False
+
+    return numeric_predicate
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental exports for following a live event feed.
+
+Each round exports the rows with `ts` in [watermark - overlap, now). The
+overlap picks up events that reached the export API late; the rows it
+brings back a second time are dropped by counting the hashes of the rows
+of the last overlap window. A row is new when a round returns its hash
+more often than the rounds before it did, so distinct events whose
+selected fields are identical are each yielded once. The watermark, those
+counts and the exports submitted but not yet consumed are small and can be
+persisted, so a follower that is restarted continues where it left off.
+"""
+
+import hashlib
+import json
+import os
+
+HASH_BYTES = 8
+
+
+class FollowState:
+    """
+    Watermark, recently seen row hashes and pending exports of a
+    follower. Persisted as json to `path` when one is given.
+    """
+
+    def __init__(self, watermark, path=None):
+        """
+        Args:
+            watermark (int): ts to start from if path holds no state
+            path (str): optional file used to persist the state
+        """
+        self.path = path
+        self.watermark = int(watermark)
+        # row hash -> [ts, rows yielded], for rows inside the overlap of
+        # the next round
+        self.recent = {}
+        # row hash -> rows returned by the current round
+        self.round = {}
+        # [export id, low, high] of exports submitted but not yet consumed
+        self.pending = []
+        if path is not None and os.path.exists(path):
+            with open(path, "rt") as state_file:
+                state = json.load(state_file)
+            self.watermark = state["watermark"]
+            # states written before rows were counted hold [hash, ts]
+            self.recent = {
+                int(entry[0]): [entry[1], entry[2] if len(entry) > 2 else 1]
+                for entry in state["recent"]
+            }
+            self.pending = state.get("pending", [])
+
+    def is_new(self, row):
+        """
+        True if the current round returned a row more often than the rounds
+        before it, rows must include ts
+
+        Args:
+            row (dict): a row of the feed
+        """
+        key = row_hash(row)
+        returned = self.round.get(key, 0) + 1
+        self.round[key] = returned
+        seen = self.recent.get(key)
+        if seen is None:
+            self.recent[key] = [int(row["ts"]), 1]
+            return True
+        if returned <= seen[1]:
+            return False
+        seen[1] = returned
+        return True
+
+    def submitted(self, export_id, low, high):
+        """Record and persist an export that was submitted for [low, high)"""
+        self.pending.append([export_id, low, high])
+        self.save()
+
+    def discard(self, export_id):
+        """Forget a pending export, without consuming it"""
+        self.pending = [entry for entry in self.pending if entry[0] != export_id]
+        self.save()
+
+    def advance(self, export_id, watermark, overlap_s):
+        """
+        Move the watermark after the round of export_id has been consumed
+        and forget rows that the next round can no longer return
+        """
+        self.pending = [entry for entry in self.pending if entry[0] != export_id]
+        self.watermark = watermark
+        self.round = {}
+        low = watermark - overlap_s
+        self.recent = {
+            key: seen for key, seen in self.recent.items() if seen[0] >= low
+        }
+        self.save()
+
+    def save(self):
+        """Atomically write the state, if it has a path"""
+        if self.path is None:
+            return
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "wt") as state_file:
+            json.dump(
+                {
+                    "watermark": self.watermark,
+                    "recent": [
+                        [key, ts, count]
+                        for key, (ts, count) in sorted(self.recent.items())
+                    ],
+                    "pending": self.pending,
+                },
+                state_file,
+            )
+        os.replace(tmp_path, self.path)
+
+
+def row_hash(row):
+    """
+    Compact, stable identity of a row
+
+    Returns:
+        int: 64 bit hash of the row's fields and values
+    """
+    data = json.dumps(row, sort_keys=True, default=str).encode("utf-8")
+    return int.from_bytes(
+        hashlib.blake2b(data, digest_size=HASH_BYTES).digest(), "big"
+    )
+
+
+def window_query(query_dict, low, high):
+    """
+    Restrict a query to rows with low <= ts < high
+
+    Args:
+        query_dict (dict): parsed query
+        low (int): inclusive lower bound on ts
+        high (int): exclusive upper bound on ts
+
+    Returns:
+        dict: a new query structure
+    """
+    select = dict(query_dict["select"])
+    window = {
+        "and": [
+            {"field": "ts", "operator": ">=", "value": low},
+            {"field": "ts", "operator": "<", "value": high},
+        ]
+    }
+    if select.get("filter") is not None:
+        window = {"and": [select["filter"], window]}
+    select["filter"] = window
+    return {**query_dict, "select": select}
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Fusing several parsed queries into a single export.
+
+The fused query selects the union of every query's fields (plus the
+fields their filters reference), ORs their filters together and keeps a
+sort order that satisfies all of them. Each row of the fused export can
+then be routed back to the queries whose filter it matches.
+"""
+
+from .filters import compile_filter, filter_fields
+
+
+def sorts_compatible(left, right):
+    """
+    True if one sort order is a prefix of the other, in which case the
+    longer one satisfies both.
+    """
+    left = left or []
+    right = right or []
+    shorter = min(len(left), len(right))
+    return left[:shorter] == right[:shorter]
+
+
+def groups(query_dicts):
+    """
+    Partition queries into groups that can share a single export: same
+    object and compatible sort orders.
+
+    Args:
+        query_dicts (list): parsed queries
+
+    Returns:
+        list: lists of indexes into query_dicts
+    """
+    result = []
+    for idx, query_dict in enumerate(query_dicts):
+        select = query_dict["select"]
+        for group in result:
+            first = query_dicts[group[0]]["select"]
+            if first["object"] == select["object"] and all(
+                sorts_compatible(
+                    query_dicts[other]["select"].get("sorts"), select.get("sorts")
+                )
+                for other in group
+            ):
+                group.append(idx)
+                break
+        else:
+            result.append([idx])
+    return result
+
+
+def fuse(query_dicts):
+    """
+    Merge queries into one export
+
+    Args:
+        query_dicts (list): parsed queries, all against the same object and
+            with compatible sort orders (see groups)
+
+    Returns:
+        (dict, list): the fused query and one row predicate per input query
+    """
+    selects = [query_dict["select"] for query_dict in query_dicts]
+    objects = set(select["object"] for select in selects)
+    if len(objects) != 1:
+        raise ValueError("cannot fuse queries on {}".format(sorted(objects)))
+
+    fields = []
+    for select in selects:
+        for field in select["fields"] + filter_fields(select.get("filter")):
+            if field not in fields:
+                fields.append(field)
+
+    merged = {"fields": fields, "object": objects.pop()}
+
+    if all("filter" in select for select in selects):
+        merged_filter = None
+        for select in reversed(selects):
+            if merged_filter is None:
+                merged_filter = select["filter"]
+            else:
+                merged_filter = {"or": [select["filter"], merged_filter]}
+        merged["filter"] = merged_filter
+
+    sorts = []
+    for select in selects:
+        if not sorts_compatible(sorts, select.get("sorts")):
+            raise ValueError("cannot fuse queries with incompatible sorts")
+        if len(select.get("sorts") or []) > len(sorts):
+            sorts = select["sorts"]
+    if sorts:
+        merged["sorts"] = sorts
+
+    predicates = [compile_filter(select.get("filter")) for select in selects]
+    return {"select": merged}, predicates
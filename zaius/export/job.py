@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Durable state for a single export so that an interrupted query can
+reattach to the server-side export and only fetch missing shards.
+"""
+
+import json
+import os
+import shutil
+
+
+class ExportJob:
+    """
+    Tracks the export id, the last known server state and the shards
+    that have already been downloaded. State is persisted as json to
+    `path` and shards are kept next to it in `<path>.shards`.
+    """
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): file used to persist the job state
+        """
+        self.path = path
+        self.download_dir = "{}.shards".format(path)
+        self.state = {}
+        if os.path.exists(path):
+            with open(path, "rt") as job_file:
+                self.state = json.load(job_file)
+
+    @property
+    def export_id(self):
+        """id of the server-side export, or None if not yet submitted"""
+        return self.state.get("id")
+
+    @property
+    def query(self):
+        """query structure the export was submitted with"""
+        return self.state.get("query")
+
+    @property
+    def completed(self):
+        """True once the server reported the export as completed"""
+        return self.state.get("state") == "completed" and "path" in self.state
+
+    @property
+    def shards(self):
+        """keys of shards that have been fully downloaded"""
+        return set(self.state.get("shards", []))
+
+    def local_shards(self):
+        """
+        Keys of shards that are recorded as downloaded and still exist in
+        the download directory.
+        """
+        return set(
+            key
+            for key in self.shards
+            if os.path.exists(os.path.join(self.download_dir, os.path.basename(key)))
+        )
+
+    def record_query(self, query_dict):
+        """Remember the query so a resumed job can be checked against it"""
+        self.state["query"] = query_dict
+        self.save()
+
+    def record_status(self, api_resp):
+        """Remember the id, state and result path of an api response"""
+        for field in ("id", "state", "path"):
+            if field in api_resp:
+                self.state[field] = api_resp[field]
+        self.save()
+
+    def record_shard(self, key):
+        """Mark a shard as fully downloaded"""
+        shards = self.state.setdefault("shards", [])
+        if key not in shards:
+            shards.append(key)
+        self.save()
+
+    def save(self):
+        """Atomically write the job state"""
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "wt") as job_file:
+            json.dump(self.state, job_file, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """Delete the job state and any downloaded shards"""
+        shutil.rmtree(self.download_dir, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Reading the complete.json manifest that the export API writes next to
+the data files of a finished export.
+"""
+
+import json
+import os
+
+MANIFEST_NAME = "complete.json"
+
+
+class ManifestError(Exception):
+    """
+    Thrown if downloaded files do not agree with the export manifest
+    """
+
+
+class Manifest:
+    """
+    The set of data files (and their sizes, when known) that make up an
+    export.
+    """
+
+    def __init__(self, shards):
+        """
+        Args:
+            shards (list): (key, size) tuples. size may be None if unknown.
+        """
+        self.shards = sorted(shards)
+        self._sizes = dict(self.shards)
+
+    @property
+    def keys(self):
+        """s3 keys of the data files"""
+        return [key for key, _ in self.shards]
+
+    @property
+    def sizes(self):
+        """mapping of key to expected size in bytes (None if unknown)"""
+        return self._sizes
+
+    @property
+    def total_bytes(self):
+        """sum of all known shard sizes"""
+        return sum(size for _, size in self.shards if size is not None)
+
+    @classmethod
+    def parse(cls, data, bucket, prefix):
+        """
+        Build a manifest from the decoded contents of complete.json. Files may
+        be listed as plain keys or as objects carrying a key and a size, and
+        keys may be absolute s3 urls or relative to the export prefix.
+
+        Args:
+            data (dict): decoded complete.json
+            bucket (str): bucket holding the export
+            prefix (str): key prefix of the export
+
+        Returns:
+            Manifest: the manifest, or None if data does not list any files
+        """
+        if isinstance(data, dict):
+            files = data.get("files")
+        else:
+            files = data
+        if not isinstance(files, list) or not files:
+            return None
+
+        shards = []
+        for entry in files:
+            size = None
+            if isinstance(entry, dict):
+                key = None
+                for field in ("key", "path", "name", "file"):
+                    if field in entry:
+                        key = entry[field]
+                        break
+                for field in ("size", "bytes", "content_length"):
+                    if entry.get(field) is not None:
+                        size = int(entry[field])
+                        break
+            else:
+                key = entry
+            if not isinstance(key, str):
+                return None
+            shards.append((_normalize_key(key, bucket, prefix), size))
+        return cls(shards)
+
+    @classmethod
+    def from_listing(cls, objects):
+        """
+        Build a manifest from list_objects_v2 entries, ignoring the manifest
+        file itself.
+
+        Args:
+            objects (list): "Contents" entries returned by s3
+
+        Returns:
+            Manifest: the manifest
+        """
+        return cls(
+            [
+                (obj["Key"], obj.get("Size"))
+                for obj in objects
+                if os.path.basename(obj["Key"]) != MANIFEST_NAME
+            ]
+        )
+
+    def verify(self, local_path):
+        """
+        Check that every shard was downloaded to local_path with the expected
+        size.
+
+        Args:
+            local_path (str): directory the shards were downloaded to
+
+        Raises:
+            ManifestError: if a shard is missing or truncated
+        """
+        for key, _ in self.shards:
+            self.verify_shard(local_path, key)
+
+    def verify_shard(self, local_path, key):
+        """
+        Check that one shard was downloaded to local_path with the expected
+        size.
+
+        Args:
+            local_path (str): directory the shard was downloaded to
+            key (str): s3 key of the shard
+
+        Returns:
+            str: local path of the shard
+
+        Raises:
+            ManifestError: if the shard is missing or truncated
+        """
+        path = os.path.join(local_path, os.path.basename(key))
+        if not os.path.exists(path):
+            raise ManifestError("{} is missing from {}".format(key, local_path))
+        actual = os.path.getsize(path)
+        size = self._sizes.get(key)
+        if size is not None and actual != size:
+            raise ManifestError(
+                "{} is {} bytes, manifest expects {}".format(key, actual, size)
+            )
+        return path
+
+
+def manifest_key(prefix):
+    """
+    Key of the manifest file for an export prefix
+    """
+    if not prefix or prefix.endswith("/"):
+        return prefix + MANIFEST_NAME
+    return "{}/{}".format(prefix, MANIFEST_NAME)
+
+
+def _normalize_key(key, bucket, prefix):
+    """
+    Turn a manifest entry into a key within bucket
+    """
+    s3_prefix = "s3://{}/".format(bucket)
+    if key.startswith(s3_prefix):
+        return key[len(s3_prefix):]
+    if key.startswith(prefix):
+        return key
+    base = os.path.dirname(manifest_key(prefix))
+    return "{}/{}".format(base, key.lstrip("/")) if base else key.lstrip("/")
+
+
+def loads(body, bucket, prefix):
+    """
+    Parse the raw bytes of complete.json
+
+    Returns:
+        Manifest: the manifest, or None if body is not a usable manifest
+    """
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return Manifest.parse(data, bucket, prefix)
@@ -2,15 +2,50 @@
 """
 Parser for SQL subset that maps to operations supported by the
 zaius export API.
+
+The parser is built (and parsy imported) the first time it is needed,
+either through parse() or by accessing QUERY_PARSER.
 """
 
-import parsy
+_PARSER = None
+
+
+def query_parser():
+    """
+    The parser for the sql-like query dialect, built on first use
+    """
+    global _PARSER  # pylint: disable=W0603
+    if _PARSER is None:
+        _PARSER = _query_parser()
+    return _PARSER
+
+
+def parse(stmt):
+    """
+    Parse an sql-like statement into the structure expected by the export API
+
+    Args:
+        stmt (string): sql-like query
+
+    Returns:
+        dict: the parsed query
+    """
+    return query_parser().parse(stmt)
+
+
+def __getattr__(name):
+    # QUERY_PARSER is kept as a lazily built module attribute
+    if name == "QUERY_PARSER":
+        return query_parser()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 
 # pylint: disable=R0914
 def _query_parser():
     """
     Construct a parser for the subset of SQL that is applicable to the export API
     """
+    import parsy  # pylint: disable=C0415
 
     whitespace = parsy.regex(r"\s*")
     lower = lambda x: x.lower()
@@ -115,6 +150,3 @@ def _query_parser():
         parsy.seq(limit_kw, whitespace, intnum).optional(),
     ).map(query_result)
     return query
-
-
-QUERY_PARSER = _query_parser()
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduling of export API calls shared by many concurrent jobs.
+
+Two limits are shared by every job using a Scheduler. Each call
+(submission, status poll) waits for a token of the token bucket, which
+paces the requests. Each export holds a slot of the concurrency window
+from its submission until it completes or fails, which bounds the
+exports running on the server; polls of exports that already hold a slot
+only need a token, so they are never stuck behind exports waiting for one.
+
+Both waits are ordered by priority, then by start-time fair queuing
+across callers: each caller's turns get increasing virtual start times,
+so a job that queues many exports at once does not starve the others.
+
+Rate and window adapt AIMD style: when the API throttles us (429/503)
+both are halved, every successful call grows the rate and every
+completed export the window additively. The scheduler only shapes
+traffic, retrying the throttled call is left to the RetryPolicy around
+it.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from zaius.retry import ThrottledError
+
+
+class _FairQueue:
+    """Waiters ordered by priority, then by virtual start time per caller"""
+
+    def __init__(self):
+        # heap of (-priority, virtual start, sequence)
+        self.heap = []
+        self.sequence = itertools.count()
+        # virtual time of the last granted turn and next start per caller
+        self.virtual_time = 0
+        self.finish_times = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, priority, caller):
+        """Queue a turn for caller and return its entry"""
+        start = max(self.virtual_time, self.finish_times.get(caller, 0))
+        self.finish_times[caller] = start + 1
+        entry = (-priority, start, next(self.sequence))
+        heapq.heappush(self.heap, entry)
+        return entry
+
+    def pop(self):
+        """Grant the turn at the head of the queue"""
+        entry = heapq.heappop(self.heap)
+        self.virtual_time = max(self.virtual_time, entry[1])
+        if len(self.finish_times) > 4 * len(self.heap) + 64:
+            # forget callers that are behind the virtual clock anyway
+            self.finish_times = {
+                key: value
+                for key, value in self.finish_times.items()
+                if value > self.virtual_time
+            }
+
+
+class Scheduler:
+    """Token bucket, AIMD concurrency window and fair priority queues"""
+
+    def __init__(
+        self,
+        rate_per_s=5.0,
+        burst=10,
+        concurrency=4,
+        max_rate_per_s=50.0,
+        max_concurrency=32,
+        min_rate_per_s=0.2,
+        backoff=0.5,
+        clock=time.monotonic,
+    ):
+        """
+        Args:
+            rate_per_s (float): calls per second to start with
+            burst (int): calls that can be made at once after an idle period
+            concurrency (int): exports in flight to start with
+            max_rate_per_s (float): the rate never grows beyond this
+            max_concurrency (int): the window never grows beyond this
+            min_rate_per_s (float): the rate never shrinks below this
+            backoff (float): factor rate and window are multiplied by when
+                throttled
+            clock (callable): monotonic time in seconds
+        """
+        self.rate_per_s = float(rate_per_s)
+        self.burst = burst
+        self.window = float(concurrency)
+        self.max_rate_per_s = max_rate_per_s
+        self.max_concurrency = max_concurrency
+        self.min_rate_per_s = min_rate_per_s
+        self.backoff = backoff
+        self.clock = clock
+
+        self.cond = threading.Condition()
+        self.tokens = float(burst)
+        self.refilled = clock()
+        # exports holding a slot of the window
+        self.in_flight = 0
+        # thread -> slots it holds
+        self.holders = {}
+        self.calls = _FairQueue()
+        self.exports = _FairQueue()
+
+    def call(self, func, *args, priority=0, caller=None, **kwargs):
+        """
+        Wait for a token, then call func
+
+        Args:
+            func (callable): the api call
+            priority (int): calls with a higher priority go first
+            caller (hashable): identifies whose call this is for fair
+                sharing, defaults to the current thread
+
+        Returns:
+            whatever func returns
+        """
+        with self.cond:
+            entry = self.calls.push(priority, _caller(caller))
+            while True:
+                self._refill()
+                if self.calls.heap[0] == entry and self.tokens >= 1:
+                    break
+                timeout = None
+                if self.tokens < 1:
+                    timeout = (1 - self.tokens) / self.rate_per_s
+                self.cond.wait(timeout)
+            self.calls.pop()
+            self.tokens -= 1
+            self.cond.notify_all()
+        try:
+            result = func(*args, **kwargs)
+        except ThrottledError:
+            self._throttled()
+            raise
+        with self.cond:
+            self.rate_per_s = min(
+                self.max_rate_per_s, self.rate_per_s + 1 / self.rate_per_s
+            )
+        return result
+
+    def begin_export(self, priority=0, caller=None):
+        """
+        Wait for a slot of the concurrency window before submitting an
+        export. Every begin_export must be followed by an end_export once
+        the export completes or fails. Slots are re-entrant per thread: a
+        thread that already holds one gets another right away, so a thread
+        that starts an export while its last one is still running cannot
+        wait on itself.
+
+        Args:
+            priority (int): exports with a higher priority go first
+            caller (hashable): identifies whose export this is for fair
+                sharing, defaults to the current thread
+
+        Returns:
+            int: the thread holding the slot, to hand to end_export
+        """
+        holder = threading.get_ident()
+        with self.cond:
+            if not self.holders.get(holder):
+                entry = self.exports.push(priority, _caller(caller))
+                while (
+                    self.exports.heap[0] != entry
+                    or self.in_flight >= int(self.window)
+                ):
+                    self.cond.wait()
+                self.exports.pop()
+            self.holders[holder] = self.holders.get(holder, 0) + 1
+            self.in_flight += 1
+            self.cond.notify_all()
+        return holder
+
+    def end_export(self, completed=True, holder=None):
+        """
+        Free the slot of an export
+
+        Args:
+            completed (bool): True if the export completed, which grows the
+                window
+            holder (int): what begin_export returned, defaults to the
+                current thread
+        """
+        holder = threading.get_ident() if holder is None else holder
+        with self.cond:
+            self.holders[holder] -= 1
+            if not self.holders[holder]:
+                del self.holders[holder]
+            self.in_flight -= 1
+            if completed:
+                self.window = min(self.max_concurrency, self.window + 1 / self.window)
+            self.cond.notify_all()
+
+    def _throttled(self):
+        """Halve rate and window"""
+        with self.cond:
+            self._refill()
+            self.rate_per_s = max(self.min_rate_per_s, self.rate_per_s * self.backoff)
+            self.window = max(1.0, self.window * self.backoff)
+            # spend what is left of the burst, the server is full
+            self.tokens = min(self.tokens, 0.0)
+            self.cond.notify_all()
+
+    def _refill(self):
+        """Add the tokens earned since the last refill"""
+        now = self.clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.refilled) * self.rate_per_s
+        )
+        self.refilled = now
+
+
+def _caller(caller):
+    return caller if caller is not None else threading.get_ident()
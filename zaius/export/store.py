@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+"""
+Local, day partitioned store of exported events.
+
+Events are kept under a directory, one subdirectory per UTC day of their
+ts, in segments of up to SEGMENT_ROWS rows. A segment stores each column
+separately, json encoded and zlib compressed, so a query only inflates
+the columns it reads. A catalog lists every segment with its columns and
+a zone map (min and max) of ZONE_FIELDS, and queries in the export
+dialect skip the segments whose zone maps rule out their filter before
+reading anything.
+
+Events are deduplicated on their identity, a hash of the identity fields
+(IDENTITY_FIELDS by default) stored with each segment, so overlapping
+exports can be ingested again and again, through any select list that
+includes the identity fields. The identity includes the fields that tell
+apart events of one customer in the same second, the line items of an
+order or the opens of two campaigns; missing and empty values hash alike.
+
+Sorted queries sort the matching rows of each segment, spill them to a
+temporary file and merge the sorted runs, so memory grows with the size
+of a segment rather than of the result.
+
+    Example:
+        store = EventStore("events")
+        store.ingest_query(api, parser.parse(
+            "select zaius_id, ts, event_type, action, product_id, order_id, "
+            "campaign_id, campaign_schedule_run_ts from events "
+            "where ts >= 1546300800"
+        ))
+        rows = store.query("select zaius_id from events where ts >= 1548979200")
+
+EventStore has the query methods of the export API, so reports can run
+against it in place of an API.
+"""
+
+import datetime
+import functools
+import heapq
+import itertools
+import json
+import logging
+import os
+import struct
+import tempfile
+import zlib
+
+from . import parser
+from .filters import compile_filter, filter_fields
+from .follow import row_hash
+
+# rows per segment
+SEGMENT_ROWS = 65536
+# fields with a zone map
+ZONE_FIELDS = ("ts", "campaign_schedule_run_ts", "campaign_id")
+# fields identifying an event, unless the store is created with others
+IDENTITY_FIELDS = (
+    "zaius_id",
+    "ts",
+    "event_type",
+    "action",
+    "product_id",
+    "order_id",
+    "campaign_id",
+    "campaign_schedule_run_ts",
+)
+# column holding the identity hash of each row
+IDENTITY_COLUMN = "_identity"
+CATALOG = "catalog.json"
+MAGIC = b"ZSEG\x01"
+COMPRESSION_LEVEL = 6
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+class EventStore:
+    """Day partitioned, column compressed segments of events"""
+
+    def __init__(self, directory, identity_fields=None, log=logging):
+        """
+        Args:
+            directory (str): where the store lives, created if missing
+            identity_fields (list): fields identifying an event, every
+                ingested row must have them. Defaults to IDENTITY_FIELDS,
+                fixed when the store is created.
+            log (logging.Logger): destination for log information
+        """
+        self.directory = directory
+        self.log = log
+        os.makedirs(directory, exist_ok=True)
+        self.catalog_path = os.path.join(directory, CATALOG)
+        if os.path.exists(self.catalog_path):
+            with open(self.catalog_path, "rt") as catalog:
+                self.catalog = json.load(catalog)
+        else:
+            self.catalog = {
+                "identity_fields": list(identity_fields or IDENTITY_FIELDS),
+                "segments": [],
+            }
+        # stores written before identities were fixed hash every field
+        self.identity_fields = self.catalog["identity_fields"]
+        # (segments in the store, segments read) by the last query
+        self.last_scan = (0, 0)
+
+    def ingest(self, rows):
+        """
+        Add events that are not in the store yet
+
+        Args:
+            rows (iterable): dicts, each with the identity fields
+
+        Returns:
+            int: number of new events
+        """
+        buffers = {}
+        seen = {}
+        days = {}
+        added = 0
+        for row in rows:
+            day_number = int(float(row["ts"])) // 86400
+            day = days.get(day_number)
+            if day is None:
+                day = days[day_number] = datetime.date.fromordinal(
+                    EPOCH_ORDINAL + day_number
+                ).isoformat()
+                seen[day] = self._identities(day)
+                buffers[day] = ([], [])
+            identity = self._identity(row)
+            if identity in seen[day]:
+                continue
+            seen[day].add(identity)
+            day_rows, identities = buffers[day]
+            day_rows.append(row)
+            identities.append(identity)
+            added += 1
+            if len(day_rows) >= SEGMENT_ROWS:
+                self._write_segment(day, day_rows, identities)
+                buffers[day] = ([], [])
+        for day, (day_rows, identities) in buffers.items():
+            if day_rows:
+                self._write_segment(day, day_rows, identities)
+        return added
+
+    def ingest_query(self, api, query_dict):
+        """
+        Export a query and add its events
+
+        Args:
+            api (zaius.export.API): the export api
+            query_dict (dict): parsed query against events, must select ts
+                and the identity fields
+
+        Returns:
+            int: number of new events
+        """
+        fields = query_dict["select"]["fields"]
+        missing = [
+            field
+            for field in ["ts"] + list(self.identity_fields or [])
+            if field not in fields
+        ]
+        if missing:
+            raise ValueError("stored queries must select {}".format(", ".join(missing)))
+        return self.ingest(api.query_raw(query_dict))
+
+    def query(self, stmt, job_file=None):
+        """
+        Run an sql-like query against the store
+
+        Args:
+            stmt (string): sql-like query against events
+            job_file (str): unused, for compatibility with the export API
+
+        Yields:
+            (dict) representing each row of the response
+        """
+        return self.query_raw(parser.parse(stmt), job_file=job_file)
+
+    def query_raw(self, query_dict, job_file=None):  # pylint: disable=W0613
+        """
+        Run a parsed query against the store. Segments whose zone maps
+        rule out the filter are not read. Sorted queries are sorted one
+        segment at a time and merged.
+
+        Args:
+            query_dict (dict): parsed query against events
+            job_file (str): unused, for compatibility with the export API
+
+        Yields:
+            (dict) representing each row of the response
+        """
+        select = query_dict["select"]
+        if select["object"] != "events":
+            raise ValueError("the event store cannot query {}".format(select["object"]))
+        fields = select["fields"]
+        filter_struct = select.get("filter")
+        predicate = compile_filter(filter_struct)
+        columns = list(fields)
+        for field in filter_fields(filter_struct):
+            if field not in columns:
+                columns.append(field)
+
+        segments = [
+            segment
+            for segment in self.catalog["segments"]
+            if _may_match(filter_struct, segment)
+        ]
+        self.last_scan = (len(self.catalog["segments"]), len(segments))
+        self.log.info(
+            "reading {} of {} segments".format(len(segments), self.last_scan[0])
+        )
+
+        def matching(segment):
+            return (
+                {field: row[field] for field in fields}
+                for row in self._scan(segment, columns)
+                if predicate(row)
+            )
+
+        limit = select.get("limit")
+        if not select.get("sorts"):
+            rows = (row for segment in segments for row in matching(segment))
+            yield from itertools.islice(rows, limit)
+            return
+        sorts = select["sorts"]
+        if len(segments) == 1:
+            yield from itertools.islice(_sorted(matching(segments[0]), sorts), limit)
+            return
+        with tempfile.TemporaryDirectory() as spill:
+            runs = []
+            for idx, segment in enumerate(segments):
+                path = os.path.join(spill, "{}.jsonl".format(idx))
+                with open(path, "wt") as run:
+                    for row in _sorted(matching(segment), sorts):
+                        run.write(json.dumps(row, default=str) + "\n")
+                runs.append(path)
+            files = [open(path, "rt") for path in runs]
+            try:
+                rows = heapq.merge(
+                    *((json.loads(line) for line in run) for run in files),
+                    key=functools.cmp_to_key(_comparator(sorts)),
+                )
+                yield from itertools.islice(rows, limit)
+            finally:
+                for run in files:
+                    run.close()
+
+    def _identity(self, row):
+        if self.identity_fields is None:
+            return row_hash(row)
+        return row_hash(
+            {field: _identity_value(row.get(field)) for field in self.identity_fields}
+        )
+
+    def _identities(self, day):
+        """Identities of the events already stored for a day"""
+        identities = set()
+        for segment in self.catalog["segments"]:
+            if segment["day"] == day:
+                (stored,) = _read_columns(self._path(segment), [IDENTITY_COLUMN])
+                identities.update(stored)
+        return identities
+
+    def _scan(self, segment, columns):
+        """Rows of a segment holding columns"""
+        present = [column for column in columns if column in segment["columns"]]
+        values = _read_columns(self._path(segment), present)
+        missing = [None] * segment["rows"]
+        by_column = dict(zip(present, values))
+        ordered = [by_column.get(column, missing) for column in columns]
+        for row in zip(*ordered):
+            yield dict(zip(columns, row))
+
+    def _write_segment(self, day, rows, identities):
+        """Write rows as a new segment of day and add it to the catalog"""
+        columns = []
+        for row in rows:
+            for field in row:
+                if field not in columns:
+                    columns.append(field)
+        values = {column: [row.get(column) for row in rows] for column in columns}
+        values[IDENTITY_COLUMN] = identities
+
+        relative = os.path.join(day, "{:08d}.seg".format(len(self.catalog["segments"])))
+        path = os.path.join(self.directory, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_columns(path, values)
+        self.catalog["segments"].append(
+            {
+                "path": relative,
+                "day": day,
+                "rows": len(rows),
+                "columns": columns,
+                "zones": {
+                    field: _zone(values[field])
+                    for field in ZONE_FIELDS
+                    if field in values
+                },
+            }
+        )
+        self._save_catalog()
+
+    def _save_catalog(self):
+        """Atomically rewrite the catalog"""
+        tmp_path = "{}.tmp".format(self.catalog_path)
+        with open(tmp_path, "wt") as catalog:
+            json.dump(self.catalog, catalog)
+        os.replace(tmp_path, self.catalog_path)
+
+    def _path(self, segment):
+        return os.path.join(self.directory, segment["path"])
+
+
+def _write_columns(path, values):
+    """
+    Write a segment: magic, header length, json header locating each
+    column, then the compressed columns
+    """
+    blobs = []
+    header = {}
+    offset = 0
+    for column, column_values in values.items():
+        blob = zlib.compress(
+            json.dumps(column_values, default=str).encode("utf-8"), COMPRESSION_LEVEL
+        )
+        header[column] = [offset, len(blob)]
+        offset += len(blob)
+        blobs.append(blob)
+    header = json.dumps(header).encode("utf-8")
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "wb") as segment:
+        segment.write(MAGIC)
+        segment.write(struct.pack("<I", len(header)))
+        segment.write(header)
+        for blob in blobs:
+            segment.write(blob)
+    os.replace(tmp_path, path)
+
+
+def _read_columns(path, columns):
+    """
+    Returns:
+        list: the values of each of columns, read from a segment
+    """
+    with open(path, "rb") as segment:
+        if segment.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a segment".format(path))
+        (length,) = struct.unpack("<I", segment.read(4))
+        header = json.loads(segment.read(length))
+        start = len(MAGIC) + 4 + length
+        result = []
+        for column in columns:
+            offset, size = header[column]
+            segment.seek(start + offset)
+            result.append(json.loads(zlib.decompress(segment.read(size))))
+        return result
+
+
+def _zone(values):
+    """
+    Zone map of a column: min and max of its values compared as numbers
+    and as strings, None where no value qualifies. Empty values never
+    match a filter and are left out.
+    """
+    numbers = []
+    strings = []
+    for value in values:
+        if value is None or value == "":
+            continue
+        strings.append(str(value))
+        try:
+            numbers.append(float(value))
+        except (TypeError, ValueError):
+            pass
+    return {
+        "num": [min(numbers), max(numbers)] if numbers else None,
+        "str": [min(strings), max(strings)] if strings else None,
+    }
+
+
+def _may_match(filter_struct, segment):
+    """
+    False if no row of the segment can match the filter, judging by its
+    columns and zone maps
+    """
+    if filter_struct is None:
+        return True
+    if "field" in filter_struct:
+        field = filter_struct["field"]
+        if field not in segment["columns"]:
+            # every value is null, comparisons are false
+            return False
+        zone = segment["zones"].get(field)
+        if zone is None:
+            return True
+        value = filter_struct["value"]
+        if isinstance(value, str):
+            bounds = zone["str"]
+        else:
+            bounds = zone["num"]
+            value = float(value)
+        if bounds is None:
+            return False
+        return _range_may_match(filter_struct["operator"], bounds[0], bounds[1], value)
+    if "and" in filter_struct:
+        return all(_may_match(part, segment) for part in filter_struct["and"])
+    if "or" in filter_struct:
+        return any(_may_match(part, segment) for part in filter_struct["or"])
+    if "not" in filter_struct:
+        # `a not b` reads as `a and not b`, only a can rule the segment out
+        return _may_match(filter_struct["not"][0], segment)
+    return True
+
+
+def _range_may_match(operator, low, high, value):
+    """True if some x with low <= x <= high satisfies `x operator value`"""
+    if operator == "=":
+        return low <= value <= high
+    if operator == "!=":
+        return not low == high == value
+    if operator == "<":
+        return low < value
+    if operator == "<=":
+        return low <= value
+    if operator == ">":
+        return high > value
+    if operator == ">=":
+        return high >= value
+    return True
+
+
+def _sort_key(field):
+    """
+    Sort key of a field like the export api: numbers numerically, then
+    strings, empty values last
+    """
+
+    def key(row):
+        value = row.get(field)
+        if value is None or value == "":
+            return (2, 0, "")
+        try:
+            return (0, float(value), "")
+        except (TypeError, ValueError):
+            return (1, 0, str(value))
+
+    return key
+
+
+def _sorted(rows, sorts):
+    """Sort rows in memory, see _sort_key"""
+    rows = list(rows)
+    # stable sorts, least significant field first
+    for sort in reversed(sorts):
+        rows.sort(key=_sort_key(sort["field"]), reverse=sort["order"] == "desc")
+    return rows
+
+
+def _comparator(sorts):
+    """Comparison of two rows in the order _sorted puts them in"""
+    keys = [(_sort_key(sort["field"]), sort["order"] == "desc") for sort in sorts]
+
+    def compare(left, right):
+        for key, desc in keys:
+            left_key, right_key = key(left), key(right)
+            if left_key != right_key:
+                before = left_key < right_key
+                return -1 if before != desc else 1
+        return 0
+
+    return compare
+
+
+def _identity_value(value):
+    """Identity of a field's value, the same for csv and parquet exports"""
+    return "" if value is None else str(value)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling of a report run, used by `zaius-export --profile`.
+
+While a Profiler is active the export API marks the stages of a query
+(submit, wait, download, decode) and the command line marks the report
+itself. For each stage the profiler records calls, total and exclusive
+wall time and the peak memory traced by tracemalloc. It also collects a
+cProfile profile and samples the stacks of the profiled thread for
+flamegraphs.
+
+Stopping it writes three files named after the given prefix:
+
+    PREFIX.pstats   cProfile dump, for pstats or snakeviz
+    PREFIX.folded   sampled stacks in the collapsed format read by
+                    flamegraph.pl and speedscope, rooted at the stage
+    PREFIX.txt      the stage summary, also written to stderr
+
+Only the thread that started the profiler is profiled; stages entered
+from other threads are ignored.
+"""
+
+import collections
+import contextlib
+import sys
+import threading
+import time
+import tracemalloc
+
+# seconds between two stack samples
+SAMPLE_INTERVAL_S = 0.005
+# frames kept per sampled stack, counted from the innermost one: the outermost
+# frames are dropped beyond this, so the hot code is always kept
+MAX_STACK_DEPTH = 128
+
+_ACTIVE = None
+_NO_STAGE = contextlib.nullcontext()
+
+
+def stage(name):
+    """
+    Context manager marking a stage of the active profiler, a no-op when
+    not profiling
+
+    Args:
+        name (str): the stage
+    """
+    if _ACTIVE is None:
+        return _NO_STAGE
+    return _ACTIVE.stage(name)
+
+
+def iterate(name, iterable):
+    """
+    Count the time spent producing each item of iterable toward a stage
+    of the active profiler
+
+    Args:
+        name (str): the stage
+        iterable (iterable): the items
+
+    Returns:
+        iterable: iterable itself when not profiling
+    """
+    if _ACTIVE is None:
+        return iterable
+    return _ACTIVE.iterate(name, iterable)
+
+
+class StageStats:
+    """What was measured of a stage"""
+
+    def __init__(self):
+        self.calls = 0
+        self.total_s = 0.0
+        self.self_s = 0.0
+        self.peak_bytes = 0
+
+
+class Profiler:
+    """Stage timings, cProfile, sampled stacks and traced memory"""
+
+    def __init__(self, prefix, sample_interval_s=SAMPLE_INTERVAL_S):
+        """
+        Args:
+            prefix (str): path prefix of the files written by stop
+            sample_interval_s (float): seconds between two stack samples
+        """
+        # not imported at module level, the cli imports this module on startup
+        import cProfile  # pylint: disable=C0415
+
+        self.prefix = prefix
+        self.sample_interval_s = sample_interval_s
+        self.stats = collections.OrderedDict()
+        # folded stack -> samples
+        self.stacks = collections.Counter()
+        # entered stages: [name, entered, resumed, peak bytes]
+        self.running = []
+        self.thread_id = None
+        self.profile = cProfile.Profile()
+        self.sampler = None
+        self.stopped = threading.Event()
+        self.started = None
+
+    def start(self):
+        """Start profiling the current thread"""
+        global _ACTIVE  # pylint: disable=W0603
+        if _ACTIVE is not None:
+            raise ValueError("a profiler is already running")
+        _ACTIVE = self
+        self.thread_id = threading.get_ident()
+        tracemalloc.start()
+        self.started = time.perf_counter()
+        self.sampler = threading.Thread(
+            target=self._sample, name="zaius-profile-sampler", daemon=True
+        )
+        self.sampler.start()
+        self.profile.enable()
+
+    def stop(self, summary=None):
+        """
+        Stop profiling, write the profile files and the summary
+
+        Args:
+            summary (file): where the summary table is written, defaults to
+                stderr
+
+        Returns:
+            list: paths of the files written
+        """
+        global _ACTIVE  # pylint: disable=W0603
+        self.profile.disable()
+        elapsed = time.perf_counter() - self.started
+        self.stopped.set()
+        self.sampler.join()
+        while self.running:
+            self._exit()
+        tracemalloc.stop()
+        _ACTIVE = None
+
+        paths = [
+            "{}.{}".format(self.prefix, ext) for ext in ("pstats", "folded", "txt")
+        ]
+        self.profile.dump_stats(paths[0])
+        with open(paths[1], "wt") as folded:
+            for stack, count in sorted(self.stacks.items()):
+                folded.write("{} {}\n".format(stack, count))
+        table = self.summary(elapsed)
+        with open(paths[2], "wt") as text:
+            text.write(table)
+        summary = summary if summary is not None else sys.stderr
+        summary.write(table)
+        summary.write("profile written to {}\n".format(", ".join(paths)))
+        return paths
+
+    def summary(self, elapsed_s):
+        """
+        Returns:
+            str: table of the stages, slowest exclusive time first
+        """
+        lines = [
+            "{:<12} {:>10} {:>10} {:>10} {:>7} {:>10}".format(
+                "stage", "calls", "total s", "self s", "self %", "peak MB"
+            )
+        ]
+        ordered = sorted(self.stats.items(), key=lambda item: -item[1].self_s)
+        for name, stats in ordered:
+            lines.append(
+                "{:<12} {:>10} {:>10.3f} {:>10.3f} {:>7.1f} {:>10.1f}".format(
+                    name,
+                    stats.calls,
+                    stats.total_s,
+                    stats.self_s,
+                    100 * stats.self_s / elapsed_s if elapsed_s else 0,
+                    stats.peak_bytes / 1e6,
+                )
+            )
+        lines.append("{:<12} {:>10} {:>10.3f}".format("elapsed", "", elapsed_s))
+        return "\n".join(lines) + "\n"
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager that counts its body toward stage name"""
+        if threading.get_ident() != self.thread_id:
+            yield
+            return
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def iterate(self, name, iterable):
+        """Yield the items of iterable, counting the time spent producing
+        them toward stage name"""
+        if threading.get_ident() != self.thread_id:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            yield item
+
+    def _enter(self, name):
+        now = time.perf_counter()
+        if self.running:
+            parent = self.running[-1]
+            self.stats[parent[0]].self_s += now - parent[2]
+            parent[3] = max(parent[3], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        if name not in self.stats:
+            self.stats[name] = StageStats()
+        self.running.append([name, now, now, 0])
+
+    def _exit(self):
+        now = time.perf_counter()
+        name, entered, resumed, peak = self.running.pop()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        stats = self.stats[name]
+        stats.calls += 1
+        stats.total_s += now - entered
+        stats.self_s += now - resumed
+        stats.peak_bytes = max(stats.peak_bytes, peak)
+        if self.running:
+            parent = self.running[-1]
+            parent[2] = now
+            # the parent's memory includes what the child held
+            parent[3] = max(parent[3], peak)
+
+    def _sample(self):
+        """Sampler thread: record the profiled thread's stack periodically"""
+        while not self.stopped.wait(self.sample_interval_s):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=W0212
+            if frame is None:
+                continue
+            names = []
+            while frame is not None and len(names) < MAX_STACK_DEPTH:
+                code = frame.f_code
+                names.append(
+                    "{}:{}".format(code.co_filename.rsplit("/", 1)[-1], code.co_name)
+                )
+                frame = frame.f_back
+            # a list read from another thread is a consistent snapshot
+            running = list(self.running)
+            root = running[-1][0] if running else "-"
+            names.append("stage:{}".format(root))
+            self.stacks[";".join(reversed(names))] += 1
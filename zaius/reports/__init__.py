@@ -7,11 +7,30 @@ the zaius-export command line utility.
     Example:
         zaius-export demo
 
+Several reports can share one export by separating them with "+":
+
+    Example:
+        zaius-export --output-dir out lifecycle-progress 2018-1 2019-1 + \
+            product-attribution 2019-1-1 2019-1-31
+
 """
+import importlib
+
 from .spec import ReportSpec
-from . import demo
-from . import product_attribution
-from . import lifecycle_progress
-from . import email_metrics
+from .fanout import execute_many
+from . import registry
+
 
-SPECS = ReportSpec.specs
+def __getattr__(name):
+    # reports are only imported when needed, see registry
+    if name == "SPECS":
+        registry.load_all()
+        return ReportSpec.specs
+    try:
+        return importlib.import_module("." + name, __name__)
+    except ModuleNotFoundError as err:
+        if err.name != "{}.{}".format(__name__, name):
+            raise
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name)
+        ) from None
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Multi-touch attribution
+
+Attributes conversions to the engagements (touches) that preceded them
+within a window. The engine is fed one user's engagements and conversions
+merged in time order, as they come out of an export ordered by
+zaius_id, ts, and keeps only the touches that are still inside the
+largest window. Every conversion is then credited under each model and
+window at once, so comparing attribution variants costs a single pass.
+
+Models:
+    last: all credit to the most recent touch, none if that touch has the
+        same ts as the conversion
+    first: all credit to the earliest touch
+    linear: credit split evenly between the touches
+    time-decay: credit halves for every half life a touch is older
+    position: 40% to the first and last touches, the remaining 20% split
+        between the ones in between
+
+Touches can be weighted by action, e.g. clicks counting for more than
+opens. The model and action weights are multiplied and normalized so the
+credits of a conversion add up to 1. Touches with a weight of 0 are
+ignored.
+"""
+
+import collections
+
+MODELS = ["last", "first", "linear", "time-decay", "position"]
+
+DAY_S = 24 * 3600
+# touches kept per user, the oldest are dropped beyond this
+MAX_TOUCHES = 1000
+# share of the credit of the first and of the last touch in the position model
+POSITION_ENDS = 0.4
+
+
+class AttributionEngine:
+    """Credits conversions to the touches of one user at a time"""
+
+    def __init__(
+        self,
+        models,
+        windows_days,
+        action_weights=None,
+        half_life_days=7,
+        max_touches=MAX_TOUCHES,
+    ):
+        """
+        Args:
+            models (list): names of the models to evaluate, see MODELS
+            windows_days (list): how many days before a conversion a touch
+                can be credited, one result per window
+            action_weights (dict): weight of a touch by its action, actions
+                that are not listed weigh 1
+            half_life_days (float): half life of the time-decay model
+            max_touches (int): touches kept per user
+        """
+        for model in models:
+            if model not in MODELS:
+                raise ValueError("unknown attribution model {}".format(model))
+        if half_life_days <= 0:
+            raise ValueError("the half life must be positive")
+        self.models = list(models)
+        self.windows_days = list(windows_days)
+        self.windows_s = [days * DAY_S for days in self.windows_days]
+        self.horizon_s = max(self.windows_s)
+        self.action_weights = action_weights or {}
+        self.half_life_s = half_life_days * DAY_S
+        self.touches = collections.deque(maxlen=max_touches)
+
+    def reset(self):
+        """Forget the touches of the previous user"""
+        self.touches.clear()
+
+    def engage(self, ts_s, action, touch):
+        """
+        Record a touch
+
+        Args:
+            ts_s (int): time of the touch
+            action (str): action of the touch, looked up in action_weights
+            touch: payload handed back with the credits
+        """
+        weight = self.action_weights.get(action, 1)
+        if weight > 0:
+            self._evict(ts_s)
+            self.touches.append((ts_s, weight, touch))
+
+    def convert(self, ts_s):
+        """
+        Credit a conversion to the touches before it
+
+        Args:
+            ts_s (int): time of the conversion
+
+        Returns:
+            list: (model, window_days, touch, credit) tuples, in the order of
+                windows, then models, then touches
+        """
+        self._evict(ts_s)
+        credits = []
+        for window_days, window_s in zip(self.windows_days, self.windows_s):
+            in_window = [
+                (ts_s - touch_ts_s, weight, touch)
+                for touch_ts_s, weight, touch in self.touches
+                if ts_s - touch_ts_s < window_s
+            ]
+            touches = [entry for entry in in_window if entry[0] > 0]
+            if not touches:
+                continue
+            # a touch at the time of the conversion is the last touch, and
+            # like in the classic report it is not credited
+            simultaneous = in_window[-1][0] == 0
+            for model in self.models:
+                if model == "last" and simultaneous:
+                    continue
+                weights = [
+                    model_weight * weight
+                    for model_weight, (_, weight, _) in zip(
+                        self._model_weights(model, touches), touches
+                    )
+                ]
+                total = sum(weights)
+                for weight, (_, _, touch) in zip(weights, touches):
+                    if weight > 0:
+                        credits.append((model, window_days, touch, weight / total))
+        return credits
+
+    def _evict(self, ts_s):
+        """Drop touches too old to be credited at ts_s"""
+        while self.touches and ts_s - self.touches[0][0] >= self.horizon_s:
+            self.touches.popleft()
+
+    def _model_weights(self, model, touches):
+        """
+        Unnormalized weight of each touch under a model, touches are
+        (age_s, weight, touch) tuples from oldest to newest
+        """
+        count = len(touches)
+        if model == "last":
+            return [0] * (count - 1) + [1]
+        if model == "first":
+            return [1] + [0] * (count - 1)
+        if model == "linear":
+            return [1] * count
+        if model == "time-decay":
+            return [0.5 ** (age_s / self.half_life_s) for age_s, _, _ in touches]
+        # position
+        if count <= 2:
+            return [1] * count
+        middle = (1 - 2 * POSITION_ENDS) / (count - 2)
+        return [POSITION_ENDS] + [middle] * (count - 2) + [POSITION_ENDS]
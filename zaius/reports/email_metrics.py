@@ -2,54 +2,117 @@
 """Email Metrics Report
 
 Aggregates email metrics for specified campaign_schedule_run_ts period.
+Metrics for several campaigns, or all of them, come from a single export
+and are written one row per campaign.
+
+With --rollups the metrics are answered from daily rollups (see
+zaius.reports.rollup) that are brought up to date first, which only
+exports the days that are missing and the last few days again, for late
+events. Email metrics share exports with other reports unless they are
+answered from rollups. Unique counts are then estimates,
+--exact counts them from raw events as usual.
 """
 
-import csv
 import datetime
 
-from .spec import ReportSpec
+from . import output
+from .sampling import estimate, margin_column
+from .spec import Accumulator, ReportSpec
+
+# campaign_id argument selecting every campaign
+ALL_CAMPAIGNS = "all"
+
 
 class EmailMetrics(ReportSpec):
     """Email Metrics Report"""
 
+    partition_key = "zaius_id"
+    sample_key = "zaius_id"
+
     def register_args(self, parser):
         parser = parser.add_parser(
             "email-metrics",
-            help="individual purchases attributed to the 3-day last touched campaign"
+            help="open, click, unsubscribe and spam report metrics per email campaign"
         )
         parser.add_argument("campaign_id",
-                            help="the ID of the campaign to get metrics for",
+                            help="comma separated IDs of the campaigns to get metrics "
+                                 "for, or 'all'",
                             default='9097')
         parser.add_argument("start_date", help="earlist date, YYYY-MM-DD, inclusive")
         parser.add_argument("end_date", help="latest date, YYYY-MM-DD, exclusive")
+        parser.add_argument(
+            "--rollups",
+            help="sqlite file of daily rollups to answer from, updated as needed",
+        )
+        parser.add_argument(
+            "--exact",
+            action="store_true",
+            help="count from raw events even if --rollups is given",
+        )
+        parser.add_argument(
+            "--rollup-lateness",
+            type=int,
+            default=None,
+            help="days before today that are rolled up again to pick up late "
+            "events, 2 by default",
+        )
+        parser.add_argument(
+            "--rollup-export-days",
+            type=int,
+            default=None,
+            help="most days rolled up from a single export, so a first run over "
+            "a long range is split into bounded exports, 31 by default",
+        )
         parser.set_defaults(func=self.execute)
 
-    # pylint: disable=R0914
+    def shares_export(self, args):
+        return self._raw_events(args)
+
     def execute(self, api, destination, args):
-        columns = [
-            "total sends",
-            "unique opens",
-            "unique clicks",
-            "unique unsubscribes",
-            "unique spam reports",
-            "open rate (%)",
-            "click through rate (%)",
-            "unsubscribe rate (%)"
-        ]
-        writer = csv.DictWriter(destination, columns)
-        writer.writeheader()
-
-        campaign_id = str(args.campaign_id)
+        if self._raw_events(args):
+            super().execute(api, destination, args)
+            return
+        if self.sample_rate(args) is not None:
+            raise ValueError("--sample cannot be combined with --rollups")
+
+        # imported here, only needed with --rollups
+        from .rollup import RollupStore  # pylint: disable=C0415
+
+        start = self._parse_date(args.start_date).date()
+        end = self._parse_date(args.end_date).date()
+        # events of the runs in the window keep coming in after it, every
+        # complete day up to today is needed. Today is left out until it is
+        # over, so rollups lag behind by up to a day.
+        today = datetime.datetime.now(datetime.timezone.utc).date()
+        options = {}
+        if getattr(args, "rollup_lateness", None) is not None:
+            options["lateness_days"] = args.rollup_lateness
+        if getattr(args, "rollup_export_days", None) is not None:
+            options["export_days"] = args.rollup_export_days
+        with RollupStore(args.rollups) as store:
+            store.update(api, start, today, **options)
+            counts = store.unique_counts(
+                start, end, self._parse_campaigns(args.campaign_id)
+            )
+        accumulator = self.accumulator(destination, args)
+        accumulator.merge((counts, {}))
+        accumulator.finish()
+
+    def query(self, args):
+        campaign_ids = self._parse_campaigns(args.campaign_id)
         start_date = self._parse_date(args.start_date)
         end_date = self._parse_date(args.end_date)
 
-        # build our query
+        # build our query. uniques are counted per
+        # (zaius_id, campaign_id, campaign_schedule_run_ts) but only the zaius_id
+        # order matters, which lets this report share an export with others that
+        # are ordered by zaius_id, ts
         params = {
-            "campaign_id_s": str(campaign_id),
+            "campaign_filter": self._campaign_filter(campaign_ids),
             "start_date_s": int(start_date.timestamp()),
             "end_date_s": int(end_date.timestamp()),
         }
-        stmt = """
+        return """
         select
             zaius_id,
             action,
@@ -68,59 +131,52 @@ class EmailMetrics(ReportSpec):
             )
             and campaign_schedule_run_ts >= {start_date_s}
             and campaign_schedule_run_ts < {end_date_s}
-            and campaign_id = {campaign_id_s}
+            {campaign_filter}
           )
           or (
             event_type = 'list'
             and action = 'unsubscribe'
             and ts >= {start_date_s}
             and ts < {end_date_s}
-            and campaign_id= {campaign_id_s}
+            {campaign_filter}
           )
-        order by zaius_id, campaign_schedule_run_ts, action
+        order by zaius_id
         """.format(
             **params
         )
 
-        # issue the query
-        rows = api.query(stmt)
+    def accumulator(self, destination, args):
+        sample = self.sample_rate(args)
+        return EmailMetricsAccumulator(
+            output.writer_for(
+                destination, EmailMetricsAccumulator.output_columns(sample), args
+            ),
+            sample,
+            self._parse_campaigns(args.campaign_id),
+        )
 
-        last_user_id_csrt = None
+    # pylint: disable=R0201
+    def _raw_events(self, args):
+        """True if the report counts raw events rather than rollups"""
+        return getattr(args, "rollups", None) is None or args.exact
 
+    # pylint: disable=R0201
+    def _parse_campaigns(self, campaign_ids):
+        """List of campaign ids, None for all campaigns"""
+        campaign_ids = str(campaign_ids)
+        if campaign_ids == ALL_CAMPAIGNS:
+            return None
+        return [campaign_id.strip() for campaign_id in campaign_ids.split(",")]
 
-        seen_actions = {}
-        unique_counts = {}
-        for row in rows:
-            current_user_id_csrt = (row['zaius_id'], row['campaign_schedule_run_ts'])
-            if current_user_id_csrt != last_user_id_csrt:
-            # accumulate
-                for action in seen_actions.keys():
-                    unique_counts[action] = unique_counts.get(action, 0) + 1
-            # reset
-                seen_actions = {}
-        # mark
-            seen_actions[row['action']] = True
-            last_user_id_csrt = current_user_id_csrt
-        # final accumulate to catch whatever user we were processing last
-        for action in seen_actions.keys():
-            unique_counts[action] = unique_counts.get(action, 0) + 1
-
-        # now index into unique counts by action to write the row
-        writer.writerow(
-            {
-                "total sends": unique_counts['sent'],
-                "unique opens": unique_counts['open'],
-                "unique clicks": unique_counts['click'],
-                "unique unsubscribes": unique_counts['unsubscribe'],
-                "unique spam reports": unique_counts['spamreport'],
-                "open rate (%)":
-                    unique_counts['open'] / unique_counts['sent'] * 100,
-                "click through rate (%)":
-                    unique_counts['click'] / unique_counts['sent'] * 100,
-                "unsubscribe rate (%)":
-                    unique_counts['unsubscribe'] / unique_counts['sent'] * 100
-            }
+    # pylint: disable=R0201
+    def _campaign_filter(self, campaign_ids):
+        """`and campaign_id = ...` clause of the query, empty for all campaigns"""
+        if campaign_ids is None:
+            return ""
+        terms = " or ".join(
+            "campaign_id = {}".format(campaign_id) for campaign_id in campaign_ids
         )
+        return "and ({})".format(terms)
 
     # pylint: disable=R0201
     def _parse_date(self, date_str):
@@ -129,4 +185,155 @@ class EmailMetrics(ReportSpec):
         )
 
 
+class EmailMetricsAccumulator(Accumulator):
+    """Counts unique actions per (zaius_id, campaign_id, campaign_schedule_run_ts)
+
+    Only the current user's actions are held in memory, the totals grow
+    with the number of campaigns, not users or events.
+    """
+
+    columns = [
+        "campaign_id",
+        "total sends",
+        "unique opens",
+        "unique clicks",
+        "unique unsubscribes",
+        "unique spam reports",
+        "open rate (%)",
+        "click through rate (%)",
+        "unsubscribe rate (%)"
+    ]
+
+    # the counts among columns, these are scaled when sampling
+    count_columns = {
+        "total sends": "sent",
+        "unique opens": "open",
+        "unique clicks": "click",
+        "unique unsubscribes": "unsubscribe",
+        "unique spam reports": "spamreport",
+    }
+
+    # rates as (column, numerator action), all relative to sends
+    rate_columns = [
+        ("open rate (%)", "open"),
+        ("click through rate (%)", "click"),
+        ("unsubscribe rate (%)", "unsubscribe"),
+    ]
+
+    def __init__(self, writer, sample=None, campaign_ids=None):
+        """
+        Args:
+            writer (output.RowWriter): destination for the report rows
+            sample (float): fraction of users the rows were sampled to, the
+                counts are then scaled up and reported with their confidence
+                intervals
+            campaign_ids (list): campaigns to write a row for even if they had
+                no events, None to only write the campaigns that were seen
+        """
+        self.writer = writer
+        self.sample = sample
+        self.campaign_ids = campaign_ids
+        self.last_user_id = None
+        # (campaign_id, campaign_schedule_run_ts, action) seen for the current user
+        self.seen_actions = set()
+        # per (campaign_id, action), the unique count and the sum of the
+        # squared per-user counts
+        self.unique_counts = {}
+        self.squares = {}
+
+    @classmethod
+    def output_columns(cls, sample=None):
+        """Output columns, with a confidence interval per count if sampled"""
+        if sample is None:
+            return cls.columns
+        columns = []
+        for column in cls.columns:
+            columns.append(column)
+            if column in cls.count_columns:
+                columns.append(margin_column(column))
+        return columns
+
+    def _accumulate(self):
+        user_counts = {}
+        for campaign_id, _, action in self.seen_actions:
+            key = (campaign_id, action)
+            user_counts[key] = user_counts.get(key, 0) + 1
+        for key, count in user_counts.items():
+            self.unique_counts[key] = self.unique_counts.get(key, 0) + count
+            self.squares[key] = self.squares.get(key, 0) + count * count
+
+    def add(self, row):
+        if row["zaius_id"] != self.last_user_id:
+            # accumulate
+            self._accumulate()
+            # reset
+            self.seen_actions = set()
+        # mark
+        self.seen_actions.add(
+            (str(row["campaign_id"]), row["campaign_schedule_run_ts"], row["action"])
+        )
+        self.last_user_id = row["zaius_id"]
+
+    def state(self):
+        self._accumulate()
+        self.seen_actions = set()
+        return self.unique_counts, self.squares
+
+    def merge(self, state):
+        unique_counts, squares = state
+        for key, count in unique_counts.items():
+            self.unique_counts[key] = self.unique_counts.get(key, 0) + count
+        for key, square in squares.items():
+            self.squares[key] = self.squares.get(key, 0) + square
+
+    def finish(self):
+        # final accumulate to catch whatever user we were processing last
+        self._accumulate()
+        self.seen_actions = set()
+
+        campaign_ids = self.campaign_ids
+        if campaign_ids is None:
+            campaign_ids = sorted(
+                set(campaign_id for campaign_id, _ in self.unique_counts),
+                key=_campaign_order,
+            )
+
+        self.writer.writeheader()
+        self.writer.writerows(self._row(campaign_id) for campaign_id in campaign_ids)
+        self.writer.close()
+
+    def _row(self, campaign_id):
+        """The metrics of one campaign, actions that never happened count 0"""
+        counts = {
+            action: self.unique_counts.get((campaign_id, action), 0)
+            for action in self.count_columns.values()
+        }
+        row = {"campaign_id": campaign_id}
+        for column, action in self.rate_columns:
+            # the rates are ratios of counts over the same users and need no
+            # scaling when sampling
+            row[column] = (
+                counts[action] / counts["sent"] * 100 if counts["sent"] else None
+            )
+        for column, action in self.count_columns.items():
+            if self.sample is None:
+                row[column] = counts[action]
+            else:
+                count, margin = estimate(
+                    counts[action],
+                    self.squares.get((campaign_id, action), 0),
+                    self.sample,
+                )
+                row[column] = count
+                row[margin_column(column)] = margin
+        return row
+
+
+def _campaign_order(campaign_id):
+    """Sort numeric campaign ids by value, before any other ids"""
+    if campaign_id.isdigit():
+        return 0, int(campaign_id), campaign_id
+    return 1, 0, campaign_id
+
+
 ReportSpec.register(EmailMetrics())
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Running several reports off shared exports
+
+Reports declare the query they need. Queries against the same object with
+compatible sort orders are fused into a single export and each row of
+that export is handed to every report whose filter it matches, so a set
+of reports over the same window costs one export and one pass. Reports
+that cannot share an export (see ReportSpec.shares_export) run through
+their own execute.
+"""
+
+import sys
+
+from zaius.export.fusion import fuse, groups
+from zaius.export import parser
+
+from .sampling import Sampler
+from .spec import progress
+
+
+def execute_many(api, jobs, log=sys.stderr):
+    """
+    Evaluate several reports, sharing exports where possible
+
+    Args:
+        api (zaius.export.API): api used to run the exports
+        jobs (list): (report_spec, destination, args) tuples
+        log (file): destination for progress information
+    """
+    alone = [job for job in jobs if not job[0].shares_export(job[2])]
+    jobs = [job for job in jobs if job[0].shares_export(job[2])]
+    parsed = [parser.parse(spec.query(args)) for spec, _, args in jobs]
+
+    for group in groups(parsed):
+        merged, predicates = fuse([parsed[idx] for idx in group])
+        consumers = [
+            (
+                _sampled(predicate, jobs[idx][0], jobs[idx][2]),
+                jobs[idx][0].accumulator(jobs[idx][1], jobs[idx][2]),
+            )
+            for idx, predicate in zip(group, predicates)
+        ]
+        log.write(
+            "Running {} report(s) off one export\n".format(len(consumers))
+        )
+
+        for row in progress(api.query_raw(merged), log):
+            for predicate, accumulator in consumers:
+                if predicate(row):
+                    accumulator.add(row)
+        for _, accumulator in consumers:
+            accumulator.finish()
+
+    for spec, destination, args in alone:
+        spec.execute(api, destination, args)
+
+
+def _sampled(predicate, spec, args):
+    """
+    Restrict a report's predicate to the users in its sample, if any
+    """
+    rate = spec.sample_rate(args)
+    if rate is None:
+        return predicate
+    sampler = Sampler(rate)
+    key = spec.sample_key
+    return lambda row: sampler(row[key]) and predicate(row)
@@ -5,40 +5,49 @@ Attribute product purchases to the last email engagement (open or click)
 that happened within a 3-day window of the purchase.
 """
 
-import csv
-import sys
+import bisect
 import datetime
 
-from .spec import ReportSpec
+from . import output
+from .sampling import estimate, margin_column
+from .spec import Accumulator, ReportSpec
+
+# width of the fixed size buckets, months are looked up by their start
+BUCKET_SECONDS = {"week": 7 * 24 * 3600, "day": 24 * 3600}
 
 
 class LifecycleProgress(ReportSpec):
     """Product Attribution Report"""
 
+    partition_key = "zaius_id"
+    sample_key = "zaius_id"
+
     def register_args(self, parser):
         parser = parser.add_parser(
             "lifecycle-progress",
             help="track how your mix of customers by lifecycle stage has evolved over time",
         )
 
-        parser.add_argument("start_month", help="earlist date, YYYY-MM, inclusive")
-        parser.add_argument("end_month", help="latest date, YYYY-MM, exclusive")
-        parser.set_defaults(func=self.execute)
-
-    # pylint: disable=R0914
-    def execute(self, api, destination, args):
-        writer = csv.DictWriter(
-            destination,
-            ["month", "no_purchase", "one_purchase", "repeat_purchase", "loyal"],
+        parser.add_argument(
+            "start_month", help="earlist date, YYYY-MM or YYYY-MM-DD, inclusive"
+        )
+        parser.add_argument(
+            "end_month", help="latest date, YYYY-MM or YYYY-MM-DD, exclusive"
         )
-        writer.writeheader()
+        parser.add_argument(
+            "--granularity",
+            choices=["month", "week", "day"],
+            default="month",
+            help="size of the time buckets to report on",
+        )
+        parser.set_defaults(func=self.execute)
 
-        start_date = self._parse_month(args.start_month)
-        end_date = self._parse_month(args.end_month)
+    def query(self, args):
+        end_date = self._parse_bucket_date(args.end_month)
 
         # build our query
         params = {"end_date_s": int(end_date.timestamp())}
-        stmt = """
+        return """
         select
             ts,
             zaius_id,
@@ -60,67 +69,42 @@ class LifecycleProgress(ReportSpec):
             **params
         )
 
-        # issue the query
-        rows = api.query(stmt)
-
-        # our result
-        month_counts = []
-        for idx in range(self._months_between(start_date, end_date)):
-            month_counts.append(
-                {
-                    "month": str(self._month_add(start_date, idx)),
-                    "no_purchase": 0,
-                    "one_purchase": 0,
-                    "repeat_purchase": 0,
-                    "loyal": 0,
-                }
-            )
-
-        def _stage(count):
-            if count == 0:
-                return "no_purchase"
-            if count == 1:
-                return "one_purchase"
-            if count == 2:
-                return "repeat_purchase"
-            return "loyal"
+    def accumulator(self, destination, args):
+        granularity = getattr(args, "granularity", "month")
+        start_date = self._parse_bucket_date(args.start_month)
+        end_date = self._parse_bucket_date(args.end_month)
+        sample = self.sample_rate(args)
+        columns = LifecycleProgressAccumulator.columns(granularity, sample)
+        return LifecycleProgressAccumulator(
+            output.writer_for(destination, columns, args),
+            self._bucket_starts(start_date, end_date, granularity),
+            granularity,
+            sample,
+        )
 
-        # our result comes back ordered by zaius_id, ts so we can know
-        # that we'll see all of one user before we see then next
-        current_user = None
-        current_month = None
-        purchase_count = set()
-
-        def _finish_pending(month):
-            if current_user is not None:
-                for idx in range(current_month, month):
-                    month_counts[idx][_stage(len(purchase_count))] += 1
-
-        for idx, row in enumerate(rows):
-            if idx % 100000 == 0:
-                sys.stderr.write("Read {} rows\n".format(idx))
-
-            if row["zaius_id"] != current_user:
-                _finish_pending(len(month_counts))
-                current_user = row["zaius_id"]
-                current_month = None
-                purchase_count = set()
-
-            ts_s = datetime.datetime.utcfromtimestamp(int(row["ts"]))
-            month = self._months_between(start_date, ts_s)
-            if current_month is None:
-                current_month = max(0, month)
-            if row["event_type"] == "order":
-                # record the purchase
-                _finish_pending(month)
-                current_month = max(0, month)
-                purchase_count.add(row["order_id"])
-
-        _finish_pending(len(month_counts))
-        sys.stderr.write("Read {} rows\n".format(idx))
-
-        for month_count in month_counts:
-            writer.writerow(month_count)
+    def _parse_bucket_date(self, date_str):
+        """Parse YYYY-MM or YYYY-MM-DD"""
+        try:
+            return datetime.datetime.strptime(date_str, "%Y-%m-%d").replace(
+                tzinfo=datetime.timezone.utc
+            )
+        except ValueError:
+            return self._parse_month(date_str)
+
+    def _bucket_starts(self, start_date, end_date, granularity):
+        """Start of every bucket between start_date and end_date"""
+        if granularity == "month":
+            return [
+                self._month_add(start_date, idx)
+                for idx in range(self._months_between(start_date, end_date))
+            ]
+        step = datetime.timedelta(seconds=BUCKET_SECONDS[granularity])
+        starts = []
+        current = start_date
+        while current < end_date:
+            starts.append(current)
+            current += step
+        return starts
 
     # pylint: disable=R0201
     def _parse_month(self, date_str):
@@ -140,4 +124,126 @@ class LifecycleProgress(ReportSpec):
         )
 
 
+class LifecycleProgressAccumulator(Accumulator):
+    """Counts users per lifecycle stage for each time bucket
+
+    Rather than walking every bucket of every user, only the buckets in
+    which a user enters or leaves a stage are recorded (+1/-1). A prefix
+    sum over the buckets turns those transitions into counts at the end,
+    so the cost grows with the number of events, not users x buckets.
+    """
+
+    stages = ["no_purchase", "one_purchase", "repeat_purchase", "loyal"]
+
+    def __init__(self, writer, bucket_starts, granularity="month", sample=None):
+        """
+        Args:
+            writer (output.RowWriter): destination for the report rows
+            bucket_starts (list): datetime at which each bucket starts
+            granularity (str): month, week or day
+            sample (float): fraction of users the rows were sampled to, the
+                counts are then scaled up and reported with their confidence
+                intervals
+        """
+        self.writer = writer
+        self.granularity = granularity
+        self.sample = sample
+        self.labels = [str(start) for start in bucket_starts]
+        self.starts_s = [int(start.timestamp()) for start in bucket_starts]
+        self.width_s = BUCKET_SECONDS.get(granularity)
+
+        # per stage, the change in user count at the start of each bucket
+        self.deltas = {stage: [0] * (len(self.starts_s) + 1) for stage in self.stages}
+
+        # our result comes back ordered by zaius_id, ts so we can know
+        # that we'll see all of one user before we see then next
+        self.current_user = None
+        self.current_stage = None
+        self.purchases = set()
+
+    @classmethod
+    def columns(cls, granularity, sample=None):
+        """Output columns, with a confidence interval per stage if sampled"""
+        if sample is None:
+            return [granularity] + cls.stages
+        columns = [granularity]
+        for stage in cls.stages:
+            columns += [stage, margin_column(stage)]
+        return columns
+
+    @staticmethod
+    def _stage(count):
+        if count == 0:
+            return "no_purchase"
+        if count == 1:
+            return "one_purchase"
+        if count == 2:
+            return "repeat_purchase"
+        return "loyal"
+
+    def _bucket(self, ts_s):
+        """Index of the bucket holding ts_s, clamped to the report range"""
+        if ts_s < self.starts_s[0]:
+            return 0
+        if self.width_s is not None:
+            bucket = (ts_s - self.starts_s[0]) // self.width_s
+        else:
+            bucket = bisect.bisect_right(self.starts_s, ts_s) - 1
+        return min(bucket, len(self.starts_s))
+
+    def add(self, row):
+        if not self.starts_s:
+            return
+        if row["zaius_id"] != self.current_user:
+            self.current_user = row["zaius_id"]
+            self.current_stage = None
+            self.purchases = set()
+
+        if self.current_stage is None:
+            # first event: the user counts from this bucket onwards
+            self.current_stage = self._stage(0)
+            self.deltas[self.current_stage][self._bucket(int(row["ts"]))] += 1
+
+        if row["event_type"] == "order" and row["order_id"] not in self.purchases:
+            # record the purchase
+            self.purchases.add(row["order_id"])
+            stage = self._stage(len(self.purchases))
+            if stage != self.current_stage:
+                bucket = self._bucket(int(row["ts"]))
+                self.deltas[self.current_stage][bucket] -= 1
+                self.deltas[stage][bucket] += 1
+                self.current_stage = stage
+
+    def state(self):
+        return self.deltas
+
+    def merge(self, state):
+        for stage, deltas in state.items():
+            own = self.deltas[stage]
+            for idx, delta in enumerate(deltas):
+                own[idx] += delta
+
+    def finish(self):
+        counts = []
+        running = dict.fromkeys(self.stages, 0)
+        for idx, label in enumerate(self.labels):
+            bucket_count = {self.granularity: label}
+            for stage in self.stages:
+                running[stage] += self.deltas[stage][idx]
+                if self.sample is None:
+                    bucket_count[stage] = running[stage]
+                else:
+                    # each user is in exactly one stage per bucket
+                    count, margin = estimate(
+                        running[stage], running[stage], self.sample
+                    )
+                    bucket_count[stage] = count
+                    bucket_count[margin_column(stage)] = margin
+            counts.append(bucket_count)
+
+        self.writer.writeheader()
+        self.writer.writerows(counts)
+        self.writer.close()
+
+
 ReportSpec.register(LifecycleProgress())
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""Report output
+
+Writers that reports use to emit rows. Rows are collected into batches
+and written in bulk, optionally compressed, as csv, json lines or
+parquet. Parquet needs pyarrow and zstd compression needs zstandard;
+both are optional dependencies.
+
+    Example:
+        writer = output.writer(sys.stdout, ["month", "count"], fmt="jsonl")
+        writer.writeheader()
+        writer.writerow({"month": "2019-01", "count": 10})
+        writer.close()
+"""
+
+import csv
+import gzip
+import io
+import json
+import operator
+
+FORMATS = ("csv", "jsonl", "parquet")
+COMPRESSIONS = ("gzip", "zstd")
+EXTENSIONS = {"csv": ".csv", "jsonl": ".jsonl", "parquet": ".parquet"}
+COMPRESSION_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+# size of the io buffers between the writers and the destination
+BUFFER_BYTES = 1024 * 1024
+# rows collected before they are handed to the underlying writer
+BATCH_ROWS = 10000
+
+
+def writer(destination, fieldnames, fmt="csv", compression=None):
+    """
+    Build a row writer
+
+    Args:
+        destination (file): text stream to write into. Binary output
+            (compressed or parquet) goes to its underlying buffer.
+        fieldnames (list): column names, in order
+        fmt (str): one of FORMATS
+        compression (str): None or one of COMPRESSIONS
+
+    Returns:
+        RowWriter: the writer
+    """
+    if fmt not in FORMATS:
+        raise ValueError("unknown output format {}".format(fmt))
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError("unknown compression {}".format(compression))
+
+    if fmt == "parquet":
+        return ParquetWriter(destination, fieldnames, compression)
+    if fmt == "jsonl":
+        return JsonLinesWriter(destination, fieldnames, compression)
+    return CsvWriter(destination, fieldnames, compression)
+
+
+def writer_for(destination, fieldnames, args):
+    """
+    Build a row writer using the --format and --compression options in
+    args (when present). Without a destination the rows are collected in
+    memory, which is how parallel report workers hand their output back.
+    """
+    if destination is None:
+        return ListWriter(fieldnames)
+    return writer(
+        destination,
+        fieldnames,
+        fmt=getattr(args, "format", None) or "csv",
+        compression=getattr(args, "compression", None),
+    )
+
+
+def extension(fmt="csv", compression=None):
+    """
+    File extension for a format and compression
+    """
+    ext = EXTENSIONS[fmt]
+    if compression is not None and fmt != "parquet":
+        ext += COMPRESSION_EXTENSIONS[compression]
+    return ext
+
+
+class RowWriter:
+    """
+    Base for the batched writers. Mirrors the parts of csv.DictWriter that
+    reports use.
+    """
+
+    def __init__(self, destination, fieldnames, compression=None):
+        self.destination = destination
+        self.fieldnames = list(fieldnames)
+        self.compression = compression
+        self.pending = []
+
+    def writeheader(self):
+        """Write the column names, for formats that have a header"""
+
+    def writerow(self, row):
+        """Queue a row (dict) for writing"""
+        self.pending.append(row)
+        if len(self.pending) >= BATCH_ROWS:
+            self.flush()
+
+    def writerows(self, rows):
+        """Queue several rows for writing"""
+        for row in rows:
+            self.writerow(row)
+
+    def flush(self):
+        """Write any queued rows"""
+        if self.pending:
+            self._write_batch(self.pending)
+            self.pending = []
+
+    def close(self):
+        """Write any queued rows and finish the output. The destination
+        itself is flushed but left open."""
+        self.flush()
+        self._finish()
+        self.destination.flush()
+
+    def _write_batch(self, rows):
+        raise ValueError("not implemented")
+
+    def _finish(self):
+        pass
+
+
+class ListWriter(RowWriter):
+    """Collects rows in memory"""
+
+    def __init__(self, fieldnames):
+        super().__init__(None, fieldnames)
+        self.rows = []
+
+    def flush(self):
+        self.rows.extend(self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+
+    def take(self):
+        """Return the rows collected so far and forget them"""
+        self.flush()
+        rows, self.rows = self.rows, []
+        return rows
+
+
+class _TextRowWriter(RowWriter):
+    """
+    Writer for text formats. Uncompressed output goes straight to the
+    destination, compressed output goes through a compressor on its
+    underlying binary buffer.
+    """
+
+    def __init__(self, destination, fieldnames, compression=None):
+        super().__init__(destination, fieldnames, compression)
+        self.compressor = None
+        if compression is None:
+            self.stream = destination
+        else:
+            destination.flush()
+            self.compressor = _compressor(destination.buffer, compression)
+            self.stream = io.TextIOWrapper(
+                io.BufferedWriter(self.compressor, BUFFER_BYTES),
+                encoding="utf-8",
+                newline="",
+            )
+
+    def _finish(self):
+        if self.compressor is not None:
+            # closes the compressor too, which writes the trailer but
+            # leaves the destination open
+            self.stream.close()
+            self.destination.buffer.flush()
+
+
+class CsvWriter(_TextRowWriter):
+    """Batched csv writer"""
+
+    def __init__(self, destination, fieldnames, compression=None):
+        super().__init__(destination, fieldnames, compression)
+        self.csv = csv.writer(self.stream)
+        if len(self.fieldnames) == 1:
+            field = self.fieldnames[0]
+            self.values = lambda row: (row.get(field, ""),)
+        else:
+            self.values = operator.itemgetter(*self.fieldnames)
+
+    def writeheader(self):
+        self.csv.writerow(self.fieldnames)
+
+    def _write_batch(self, rows):
+        # the values are all taken before anything is written, so a row
+        # missing a column cannot leave part of the batch written already
+        try:
+            values = list(map(self.values, rows))
+        except KeyError:
+            # some rows are missing columns, fill them like DictWriter does
+            fieldnames = self.fieldnames
+            values = [[row.get(field, "") for field in fieldnames] for row in rows]
+        self.csv.writerows(values)
+
+
+class JsonLinesWriter(_TextRowWriter):
+    """Batched json lines writer"""
+
+    def _write_batch(self, rows):
+        fieldnames = self.fieldnames
+        self.stream.write(
+            "".join(
+                json.dumps({field: row.get(field) for field in fieldnames}) + "\n"
+                for row in rows
+            )
+        )
+
+
+class ParquetWriter(RowWriter):
+    """
+    Parquet writer. The schema is inferred from the first batch, with
+    columns that are empty in it written as nullable strings; values of
+    later batches that do not fit a string column are written as text. Each
+    batch becomes a row group. Compression is applied by parquet itself.
+    """
+
+    def __init__(self, destination, fieldnames, compression=None):
+        super().__init__(destination, fieldnames, compression)
+        try:
+            import pyarrow  # pylint: disable=C0415
+            import pyarrow.parquet  # pylint: disable=C0415
+        except ImportError:
+            raise ValueError("parquet output requires pyarrow to be installed")
+        self.pyarrow = pyarrow
+        self.writer = None
+
+    def _write_batch(self, rows):
+        pyarrow = self.pyarrow
+        columns = {field: [row.get(field) for row in rows] for field in self.fieldnames}
+        if self.writer is None:
+            schema = pyarrow.schema(
+                pyarrow.field(field.name, pyarrow.string())
+                if pyarrow.types.is_null(field.type)
+                else field
+                for field in pyarrow.table(columns).schema
+            )
+            self.destination.flush()
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.destination.buffer,
+                schema,
+                compression=self.compression or "snappy",
+            )
+        schema = self.writer.schema
+        arrays = [self._array(columns[field.name], field.type) for field in schema]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+    def _array(self, values, type_):
+        """Column of the schema's type, as text if that is a string"""
+        pyarrow = self.pyarrow
+        try:
+            return pyarrow.array(values, type=type_)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+            if not pyarrow.types.is_string(type_):
+                raise
+        return pyarrow.array(
+            [None if value is None else str(value) for value in values], type=type_
+        )
+
+    def _finish(self):
+        if self.writer is None:
+            # no rows, still produce a valid (empty) file
+            self._write_batch([])
+        self.writer.close()
+        self.destination.buffer.flush()
+
+
+def _compressor(raw, compression):
+    """
+    Compressing binary stream that writes into raw without closing it
+    """
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6)
+    try:
+        import zstandard  # pylint: disable=C0415
+    except ImportError:
+        raise ValueError("zstd compression requires zstandard to be installed")
+    return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
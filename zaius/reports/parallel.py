@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""Hash-partitioned report execution
+
+Reports that only look at one user at a time can split their rows by user.
+A worker process sees every row of its users, in order, and runs the
+report's accumulator unchanged. The partial aggregates of the workers are
+merged into a single accumulator that writes the output.
+
+When the api can hand over the files of its export (API.query_shards), the
+workers decode the files themselves. An export is ordered by user, so every
+user but the first and the last of a file is wholly inside it; those two are
+sent back to the parent, which runs them once the files are done. Otherwise
+the parent decodes the rows and splits them by a hash of the user id.
+
+Reports whose output is made of independent rows drain it from the workers
+as they go, so it is written while they run instead of held until the end.
+"""
+
+import multiprocessing
+import queue
+import sys
+import zlib
+
+from zaius.export import decode, parser
+
+from .spec import progress
+
+# rows sent to a worker in one message
+BATCH_ROWS = 5000
+# batches a worker's queue may hold before the reader waits
+QUEUE_BATCHES = 8
+
+
+def partition(key, partitions):
+    """
+    Stable partition for a key. Python's hash() is salted per process so
+    a crc is used instead.
+    """
+    return zlib.crc32(key.encode("utf-8")) % partitions
+
+
+def execute_partitioned(spec, api, destination, args, processes, log=sys.stderr):
+    """
+    Evaluate a report across a pool of worker processes
+
+    Args:
+        spec (ReportSpec): the report, must set partition_key
+        api (zaius.export.API): api used to run the export
+        destination (file): where the report is written
+        args (argparse.Namespace): report arguments
+        processes (int): number of worker processes
+        log (file): destination for progress information
+    """
+    if hasattr(api, "query_shards"):
+        _execute_shards(spec, api, destination, args, processes, log)
+    else:
+        _execute_rows(spec, api, destination, args, processes, log)
+
+
+def _execute_shards(spec, api, destination, args, processes, log):
+    """Hand the files of the export to the workers, see the module docstring"""
+
+    stmt = spec.query(args)
+    fields = parser.parse(stmt)["select"]["fields"]
+    results = multiprocessing.Queue()
+    tasks = multiprocessing.Queue()
+    workers = _start(
+        processes, _shard_worker, spec, args, api.export_format, fields, tasks, results
+    )
+
+    try:
+        accumulator = spec.accumulator(destination, args)
+        edges = {}
+        finished = 0
+        with api.query_shards(stmt) as shards:
+            idx = -1
+            for idx, path in enumerate(shards):
+                tasks.put((idx, path))
+                log.write("Read {} files\n".format(idx + 1))
+                finished += _receive(results, accumulator, edges, block=False)
+            for _ in workers:
+                tasks.put(None)
+            # the files are removed on leaving the block, once no worker reads
+            while finished < processes:
+                finished += _receive(results, accumulator, edges, block=True)
+
+        # the users cut by the file boundaries, rejoined in export order
+        edge = spec.accumulator(None, args)
+        for shard in range(idx + 1):
+            for rows in edges.get(shard, ()):
+                for row in rows:
+                    edge.add(row)
+        accumulator.merge(edge.state())
+        accumulator.finish()
+    finally:
+        _stop(workers)
+
+
+def _execute_rows(spec, api, destination, args, processes, log):
+    """Decode the rows here and split them by a hash of the user"""
+
+    results = multiprocessing.Queue()
+    inboxes = [multiprocessing.Queue(QUEUE_BATCHES) for _ in range(processes)]
+    workers = []
+    for inbox in inboxes:
+        workers.extend(_start(1, _row_worker, spec, args, inbox, results))
+
+    try:
+        accumulator = spec.accumulator(destination, args)
+        finished = 0
+        fields = None
+        batches = [[] for _ in range(processes)]
+        key = spec.partition_key
+        rows = spec.sampled(progress(api.query(spec.query(args)), log), args)
+        for row in rows:
+            if fields is None:
+                fields = list(row.keys())
+            part = partition(row[key], processes)
+            batch = batches[part]
+            # rows travel as value lists to keep pickling cheap
+            batch.append(list(row.values()))
+            if len(batch) >= BATCH_ROWS:
+                inboxes[part].put((fields, batch))
+                batches[part] = []
+                finished += _receive(results, accumulator, None, block=False)
+        for part, batch in enumerate(batches):
+            if batch:
+                inboxes[part].put((fields, batch))
+        for inbox in inboxes:
+            inbox.put(None)
+
+        while finished < processes:
+            finished += _receive(results, accumulator, None, block=True)
+        accumulator.finish()
+    finally:
+        _stop(workers)
+
+
+def _start(count, target, *args):
+    workers = [multiprocessing.Process(target=target, args=args) for _ in range(count)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    return workers
+
+
+def _stop(workers):
+    for worker in workers:
+        worker.join(timeout=1)
+        if worker.is_alive():
+            worker.terminate()
+
+
+def _receive(results, accumulator, edges, block):
+    """
+    Fold the messages of the workers into accumulator, all those waiting or
+    the next one when block is set. Returns how many workers finished.
+    """
+    finished = 0
+    while True:
+        try:
+            kind, payload = results.get(block)
+        except queue.Empty:
+            return finished
+        if kind == "failed":
+            raise RuntimeError("report worker failed: {}".format(payload))
+        if kind == "edges":
+            idx, groups = payload
+            edges[idx] = groups
+        else:
+            accumulator.merge(payload)
+        if kind == "done":
+            finished += 1
+        if block:
+            return finished
+
+
+def _drain(accumulator, results):
+    rows = accumulator.drain()
+    if rows is not None:
+        results.put(("partial", rows))
+
+
+def _finish(accumulator, error, results):
+    if error is None:
+        try:
+            results.put(("done", accumulator.state()))
+            return
+        except Exception as err:  # pylint: disable=W0703
+            error = repr(err)
+    results.put(("failed", error))
+
+
+def _shard_worker(spec, args, export_format, fields, tasks, results):
+    """
+    Decode the files handed over by the parent, run the report's accumulator
+    over the users inside each file and send back the first and last user
+    of every file. After a failure the remaining files are skipped.
+    """
+    error = None
+    try:
+        accumulator = spec.accumulator(None, args)
+        decoder = decode.decoder(export_format, fields)
+    except Exception as err:  # pylint: disable=W0703
+        error = repr(err)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if error is not None:
+            continue
+        idx, path = task
+        try:
+            rows = spec.sampled(decoder.rows(path), args)
+            groups = decode.group_rows(rows, spec.partition_key)
+            edges = []
+            first = next(groups, None)
+            if first is not None:
+                edges.append(first[1])
+            last = None
+            for group in groups:
+                if last is not None:
+                    for row in last[1]:
+                        accumulator.add(row)
+                last = group
+            if last is not None:
+                edges.append(last[1])
+            results.put(("edges", (idx, edges)))
+            _drain(accumulator, results)
+        except Exception as err:  # pylint: disable=W0703
+            error = repr(err)
+    _finish(accumulator, error, results)
+
+
+def _row_worker(spec, args, inbox, results):
+    """
+    Run the report's accumulator over one partition and send back its state.
+    After a failure the inbox is still drained so the reader never blocks on
+    a full queue.
+    """
+    error = None
+    try:
+        accumulator = spec.accumulator(None, args)
+    except Exception as err:  # pylint: disable=W0703
+        error = repr(err)
+
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        if error is not None:
+            continue
+        fields, batch = message
+        try:
+            for values in batch:
+                accumulator.add(dict(zip(fields, values)))
+            _drain(accumulator, results)
+        except Exception as err:  # pylint: disable=W0703
+            error = repr(err)
+    _finish(accumulator, error, results)
@@ -2,19 +2,23 @@
 """Product Purchase Attribution Report
 
 Attribute product purchases to the last email engagement (open or click)
-that happened within a 3-day window of the purchase.
+that happened within a 3-day window of the purchase. Other attribution
+models and windows can be evaluated in the same pass, see attribution.
 """
 
-import csv
-import sys
+import argparse
 import datetime
 
-from .spec import ReportSpec
+from . import output
+from .attribution import MODELS, AttributionEngine
+from .spec import Accumulator, ReportSpec
 
 
 class ProductAttribution(ReportSpec):
     """Product Attribution Report"""
 
+    partition_key = "zaius_id"
+
     def register_args(self, parser):
         parser = parser.add_parser(
             "product-attribution",
@@ -25,39 +29,48 @@ class ProductAttribution(ReportSpec):
         parser.add_argument("end_date", help="latest date, YYYY-MM-DD, exclusive")
         parser.add_argument(
             "--attribution-days",
-            help="maximum number of days after an engagement that a purchase can be attributed",
-            default=3,
+            help="maximum number of days after an engagement that a purchase can be attributed"
+            ", comma separated to evaluate several windows",
+            default="3",
+        )
+        parser.add_argument(
+            "--models",
+            default="last",
+            help="comma separated attribution models out of {}".format(
+                ", ".join(MODELS)
+            ),
+        )
+        parser.add_argument(
+            "--click-weight",
+            type=float,
+            default=1,
+            help="weight of a click compared to other engagements",
+        )
+        parser.add_argument(
+            "--open-weight",
+            type=float,
+            default=1,
+            help="weight of an open compared to other engagements",
+        )
+        parser.add_argument(
+            "--half-life-days",
+            type=_half_life,
+            default=7,
+            help="half life of the time-decay model",
         )
 
         parser.set_defaults(func=self.execute)
 
-    # pylint: disable=R0914
-    def execute(self, api, destination, args):
-        columns = [
-            "campaign",
-            "campaign_send_ts",
-            "last_engagement",
-            "last_engagement_ts",
-            "product_id",
-            "order_id",
-            "purchase_ts",
-            "email",
-            "quantity",
-            "subtotal",
-        ]
-        writer = csv.DictWriter(destination, columns)
-        writer.writeheader()
-
+    def query(self, args):
         start_date = self._parse_date(args.start_date)
         end_date = self._parse_date(args.end_date)
-        attribution_days = int(args.attribution_days)
 
         # build our query
         params = {
             "start_date_s": int(start_date.timestamp()),
             "end_date_s": int(end_date.timestamp()),
         }
-        stmt = """
+        return """
         select
             ts,
             zaius_id,
@@ -91,50 +104,23 @@ class ProductAttribution(ReportSpec):
             **params
         )
 
-        # issue the query
-        rows = api.query(stmt)
-
-        # our result comes back ordered by zaius_id, ts so we can know
-        # that we'll see all of one user before we see then next
-        current_user = None
-        last_engagement = None
-
-        def is_attributed(conv):
-            if last_engagement is None:
-                return False
-
-            dt_s = int(conv["ts"]) - int(last_engagement["ts"])
-
-            after_engagement = dt_s > 0
-            within_window = dt_s < (attribution_days * 24 * 3600)
-            return after_engagement and within_window
-
-        idx = 0
-        for idx, row in enumerate(rows):
-            if idx % 100000 == 0:
-                sys.stderr.write("Read {} rows\n".format(idx))
-
-            if row["zaius_id"] != current_user:
-                current_user = row["zaius_id"]
-                last_engagement = None
-            if row["action"] in ("open", "click"):
-                last_engagement = row
-            elif row["action"] == "purchase" and is_attributed(row):
-                writer.writerow(
-                    {
-                        "campaign": last_engagement["campaign"],
-                        "campaign_send_ts": last_engagement["campaign_schedule_run_ts"],
-                        "last_engagement": last_engagement["action"],
-                        "last_engagement_ts": last_engagement["ts"],
-                        "product_id": row["product_id"],
-                        "order_id": row["order_id"],
-                        "purchase_ts": row["ts"],
-                        "email": row["customer.email"],
-                        "quantity": row["order_item_quantity"],
-                        "subtotal": row["order_item_subtotal"],
-                    }
-                )
-        sys.stderr.write("Read {} rows\n".format(idx))
+    def accumulator(self, destination, args):
+        # several windows can be given comma separated, e.g. 1,3,7
+        windows_days = [int(days) for days in str(args.attribution_days).split(",")]
+        models = getattr(args, "models", "last").split(",")
+        engine = AttributionEngine(
+            models,
+            windows_days,
+            action_weights={
+                "click": getattr(args, "click_weight", 1),
+                "open": getattr(args, "open_weight", 1),
+            },
+            half_life_days=getattr(args, "half_life_days", 7),
+        )
+        writer = output.writer_for(
+            destination, ProductAttributionAccumulator.output_columns(engine), args
+        )
+        return ProductAttributionAccumulator(writer, engine)
 
     # pylint: disable=R0201
     def _parse_date(self, date_str):
@@ -143,4 +129,104 @@ class ProductAttribution(ReportSpec):
         )
 
 
+class ProductAttributionAccumulator(Accumulator):
+    """Writes each purchase that has a qualifying engagement, once per
+    credited engagement, model and window"""
+
+    columns = [
+        "campaign",
+        "campaign_send_ts",
+        "last_engagement",
+        "last_engagement_ts",
+        "product_id",
+        "order_id",
+        "purchase_ts",
+        "email",
+        "quantity",
+        "subtotal",
+    ]
+
+    # extra columns when several models or windows are evaluated
+    model_columns = ["model", "window_days"]
+    credit_column = "credit"
+
+    def __init__(self, writer, engine):
+        """
+        Args:
+            writer (output.RowWriter): destination for the attributed purchases
+            engine (attribution.AttributionEngine): models and windows to
+                attribute with
+        """
+        self.writer = writer
+        self.engine = engine
+        self.detailed = self.is_detailed(engine)
+        self.writer.writeheader()
+
+        # our result comes back ordered by zaius_id, ts so we can know
+        # that we'll see all of one user before we see then next
+        self.current_user = None
+
+    @staticmethod
+    def is_detailed(engine):
+        """True unless the engine only does the classic last-touch report"""
+        return engine.models != ["last"] or len(engine.windows_days) != 1
+
+    @classmethod
+    def output_columns(cls, engine):
+        """Output columns, naming the model, window and credit if detailed"""
+        if not cls.is_detailed(engine):
+            return cls.columns
+        return cls.model_columns + cls.columns + [cls.credit_column]
+
+    def add(self, row):
+        if row["zaius_id"] != self.current_user:
+            self.current_user = row["zaius_id"]
+            self.engine.reset()
+        if row["action"] in ("open", "click"):
+            self.engine.engage(int(row["ts"]), row["action"], row)
+        elif row["action"] == "purchase":
+            for model, window_days, engagement, credit in self.engine.convert(
+                int(row["ts"])
+            ):
+                attributed = {
+                    "campaign": engagement["campaign"],
+                    "campaign_send_ts": engagement["campaign_schedule_run_ts"],
+                    "last_engagement": engagement["action"],
+                    "last_engagement_ts": engagement["ts"],
+                    "product_id": row["product_id"],
+                    "order_id": row["order_id"],
+                    "purchase_ts": row["ts"],
+                    "email": row["customer.email"],
+                    "quantity": row["order_item_quantity"],
+                    "subtotal": row["order_item_subtotal"],
+                }
+                if self.detailed:
+                    attributed["model"] = model
+                    attributed["window_days"] = window_days
+                    attributed[self.credit_column] = credit
+                self.writer.writerow(attributed)
+
+    def finish(self):
+        self.writer.close()
+
+    def drain(self):
+        # the attributed rows so far, collected by the worker's ListWriter
+        return self.writer.take()
+
+    def state(self):
+        return self.writer.take()
+
+    def merge(self, state):
+        self.writer.writerows(state)
+
+
 ReportSpec.register(ProductAttribution())
+
+
+def _half_life(value):
+    """argparse type of --half-life-days"""
+
+    days = float(value)
+    if days <= 0:
+        raise argparse.ArgumentTypeError("the half life must be positive")
+    return days
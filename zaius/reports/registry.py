@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""Report discovery
+
+The CLI needs the name and help text of every report to build its
+command line, but only ever runs one of them. Reports are therefore
+described by lightweight metadata and only imported once they are
+selected.
+
+Built-in reports are listed below. Other packages can add reports by
+declaring an entry point in the "zaius_export.reports" group that names
+a ReportSpec subclass:
+
+    entry_points={
+        "zaius_export.reports": ["my-report = my_package.reports:MyReport"]
+    }
+"""
+
+import importlib
+
+from .spec import ReportSpec
+
+ENTRY_POINT_GROUP = "zaius_export.reports"
+
+
+class ReportInfo:
+    """Name, help text and location of a report"""
+
+    def __init__(self, name, target, help_text=None):
+        """
+        Args:
+            name (str): name of the report on the command line
+            target (str): "module:ClassName" of the ReportSpec subclass
+            help_text (str): short description for the CLI
+        """
+        self.name = name
+        self.target = target
+        self.help = help_text
+
+    def load(self):
+        """
+        Import the report and return its registered ReportSpec instance
+        """
+        module_name, class_name = self.target.split(":")
+        spec_class = getattr(importlib.import_module(module_name), class_name)
+        for spec in ReportSpec.specs:
+            if type(spec) is spec_class:  # pylint: disable=C0123
+                return spec
+        spec = spec_class()
+        ReportSpec.register(spec)
+        return spec
+
+
+BUILTIN = [
+    ReportInfo(
+        "demo",
+        "zaius.reports.demo:Demo",
+        "a demo report that ensures everything is working",
+    ),
+    ReportInfo(
+        "product-attribution",
+        "zaius.reports.product_attribution:ProductAttribution",
+        "individual purchases attributed to the 3-day last touched campaign",
+    ),
+    ReportInfo(
+        "lifecycle-progress",
+        "zaius.reports.lifecycle_progress:LifecycleProgress",
+        "track how your mix of customers by lifecycle stage has evolved over time",
+    ),
+    ReportInfo(
+        "email-metrics",
+        "zaius.reports.email_metrics:EmailMetrics",
+        "open, click, unsubscribe and spam report metrics per email campaign",
+    ),
+]
+
+
+def available():
+    """
+    Metadata for every built-in and installed report
+
+    Returns:
+        list: ReportInfo for each report, built-ins first
+    """
+    infos = list(BUILTIN)
+    names = set(info.name for info in infos)
+    for entry_point in _entry_points():
+        if entry_point.name not in names:
+            names.add(entry_point.name)
+            infos.append(ReportInfo(entry_point.name, entry_point.value))
+    return infos
+
+
+def load_all():
+    """
+    Import every report
+
+    Returns:
+        list: the ReportSpec instances
+    """
+    return [info.load() for info in available()]
+
+
+def _entry_points():
+    """
+    Entry points declared in ENTRY_POINT_GROUP by installed packages
+    """
+    try:
+        from importlib import metadata  # pylint: disable=C0415
+    except ImportError:
+        return []
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        return list(entry_points.select(group=ENTRY_POINT_GROUP))
+    return list(entry_points.get(ENTRY_POINT_GROUP, []))
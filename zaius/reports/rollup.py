@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""Daily rollups of email events
+
+email-metrics counts unique actions per (zaius_id, campaign_id,
+campaign_schedule_run_ts) from raw events. A RollupStore keeps, in
+sqlite, the number of events and a DistinctSketch of the users for each
+(campaign_id, campaign_schedule_run_ts, day, action) instead. Unique
+counts for any range of runs and any set of campaigns are then merged
+from the rollups without touching raw events.
+
+Rollups are built incrementally: update() only exports the complete UTC
+days that are not in the store yet, plus the last LATENESS_DAYS days,
+which are rolled up again to pick up events that reached the export API
+late. Consecutive days share one ranged export of at most EXPORT_DAYS
+days, so the first update of a long range is a series of bounded exports
+rather than one that spans it all. Each export's cells and the done
+markers of its days are written in one transaction, so an interrupted
+backfill resumes after the last export that completed.
+"""
+
+import datetime
+import sqlite3
+import sys
+
+from .sketch import DistinctSketch
+
+# actions kept in the rollups, as (event_type, action)
+ACTIONS = [
+    ("email", "sent"),
+    ("email", "open"),
+    ("email", "click"),
+    ("email", "spamreport"),
+    ("list", "unsubscribe"),
+]
+# actions whose window applies to the event's ts, not to the campaign run
+TS_WINDOW_ACTIONS = ("unsubscribe",)
+# days before the end of an update that are rolled up again even if done
+LATENESS_DAYS = 2
+# most days rolled up from a single export
+EXPORT_DAYS = 31
+DAY_S = 86400
+
+
+class RollupStore:
+    """Per day event counts and user sketches of email actions"""
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): sqlite database, created if missing
+        """
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "create table if not exists cells ("
+            "campaign_id text, run_ts text, day text, action text, "
+            "events integer, sketch blob, "
+            "primary key (campaign_id, run_ts, day, action))"
+        )
+        self.db.execute("create table if not exists days (day text primary key)")
+        self.db.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the database"""
+        self.db.close()
+
+    def update(
+        self,
+        api,
+        start,
+        end,
+        lateness_days=LATENESS_DAYS,
+        export_days=EXPORT_DAYS,
+        log=sys.stderr,
+    ):
+        """
+        Export and roll up the days of [start, end) that are not in the
+        store, and the last lateness_days of them again. Rolling a day up
+        replaces what the store held for it.
+
+        Args:
+            api (zaius.export.API): the export api
+            start (datetime.date): first day
+            end (datetime.date): day after the last one
+            lateness_days (int): days before end that are rolled up again
+            export_days (int): most days rolled up from one export
+            log (file): destination for progress information
+
+        Returns:
+            int: number of events rolled up
+        """
+        if export_days < 1:
+            raise ValueError("export_days must be at least 1")
+        done = set(day for (day,) in self.db.execute("select day from days"))
+        late = end - datetime.timedelta(days=lateness_days)
+        missing = []
+        day = start
+        while day < end:
+            if day >= late or day.isoformat() not in done:
+                if (
+                    missing
+                    and missing[-1][1] == day
+                    and (day - missing[-1][0]).days < export_days
+                ):
+                    missing[-1][1] = day + datetime.timedelta(days=1)
+                else:
+                    missing.append([day, day + datetime.timedelta(days=1)])
+            day += datetime.timedelta(days=1)
+
+        total = sum((after - first).days for first, after in missing)
+        rolled = 0
+        added = 0
+        for first, after in missing:
+            cells, count = _cells(api.query(self.query(first, after)))
+            days = []
+            day = first
+            while day < after:
+                days.append((day.isoformat(),))
+                day += datetime.timedelta(days=1)
+            # the days' cells and their done markers change together
+            with self.db:
+                self.db.execute(
+                    "delete from cells where day >= ? and day < ?",
+                    (first.isoformat(), after.isoformat()),
+                )
+                self._write(cells)
+                self.db.executemany("insert or ignore into days values (?)", days)
+            added += count
+            rolled += (after - first).days
+            log.write(
+                "Rolled up {} to {}, {} of {} days, {} events\n".format(
+                    first, after - datetime.timedelta(days=1), rolled, total, count
+                )
+            )
+        return added
+
+    @staticmethod
+    def query(start, end):
+        """
+        The export of the events of [start, end) that rollups are built from
+
+        Args:
+            start (datetime.date): first day
+            end (datetime.date): day after the last one
+
+        Returns:
+            str: the query
+        """
+        actions = " or ".join(
+            "(event_type = '{}' and action = '{}')".format(event_type, action)
+            for event_type, action in ACTIONS
+        )
+        return """
+        select
+            zaius_id,
+            ts,
+            action,
+            campaign_schedule_run_ts,
+            campaign_id
+        from events
+        where
+            ts >= {start_s}
+            and ts < {end_s}
+            and ({actions})
+        """.format(
+            start_s=_timestamp(start), end_s=_timestamp(end), actions=actions
+        )
+
+    def ingest(self, rows):
+        """
+        Add events to the rollups. Events are only counted once if their
+        days are marked done, see update.
+
+        Args:
+            rows (iterable): dicts with zaius_id, ts, action,
+                campaign_schedule_run_ts and campaign_id
+
+        Returns:
+            int: number of events added
+        """
+        cells, count = _cells(rows)
+        with self.db:
+            self._write(cells)
+        return count
+
+    def _write(self, cells):
+        """Merge cells into the stored ones, in the caller's transaction"""
+        for key, (events, sketch) in cells.items():
+            found = self.db.execute(
+                "select events, sketch from cells "
+                "where campaign_id = ? and run_ts = ? and day = ? and action = ?",
+                key,
+            ).fetchone()
+            if found is not None:
+                events += found[0]
+                sketch.merge(DistinctSketch.deserialize(found[1]))
+            self.db.execute(
+                "insert or replace into cells values (?, ?, ?, ?, ?, ?)",
+                key + (events, sketch.serialize()),
+            )
+
+    def unique_counts(self, start, end, campaign_ids=None):
+        """
+        Unique actions per campaign, as email-metrics counts them: per user
+        and campaign run, for the runs scheduled in [start, end), and for
+        unsubscribes that happened in [start, end)
+
+        Args:
+            start (datetime.date): first day
+            end (datetime.date): day after the last one
+            campaign_ids (list): campaigns to count, None for all of them
+
+        Returns:
+            dict: estimated count per (campaign_id, action)
+        """
+        terms = [
+            "((action in ({}) and day >= ? and day < ?) or "
+            "(action not in ({}) and run_ts != '' "
+            "and cast(run_ts as integer) >= ? and cast(run_ts as integer) < ?))".format(
+                ",".join("?" * len(TS_WINDOW_ACTIONS)),
+                ",".join("?" * len(TS_WINDOW_ACTIONS)),
+            )
+        ]
+        values = (
+            list(TS_WINDOW_ACTIONS)
+            + [start.isoformat(), end.isoformat()]
+            + list(TS_WINDOW_ACTIONS)
+            + [_timestamp(start), _timestamp(end)]
+        )
+        if campaign_ids is not None:
+            terms.append(
+                "campaign_id in ({})".format(",".join("?" * len(campaign_ids)))
+            )
+            values.extend(str(campaign_id) for campaign_id in campaign_ids)
+
+        # users are unique per campaign run, so sketches are merged across
+        # days and the runs' counts are added up
+        runs = {}
+        found = self.db.execute(
+            "select campaign_id, run_ts, action, sketch from cells where "
+            + " and ".join(terms),
+            values,
+        )
+        for campaign_id, run_ts, action, data in found:
+            sketch = DistinctSketch.deserialize(data)
+            key = (campaign_id, action, run_ts)
+            if key in runs:
+                runs[key].merge(sketch)
+            else:
+                runs[key] = sketch
+        counts = {}
+        for (campaign_id, action, _), sketch in runs.items():
+            key = (campaign_id, action)
+            counts[key] = counts.get(key, 0) + sketch.estimate()
+        return counts
+
+
+def _cells(rows):
+    """
+    Returns:
+        (dict, int): [events, DistinctSketch] per (campaign_id, run_ts, day,
+            action) of rows, and the number of rows
+    """
+    cells = {}
+    count = 0
+    for row in rows:
+        day = datetime.datetime.fromtimestamp(
+            int(float(row["ts"])) // DAY_S * DAY_S, datetime.timezone.utc
+        ).date()
+        key = (
+            str(row["campaign_id"] or ""),
+            str(row["campaign_schedule_run_ts"] or ""),
+            day.isoformat(),
+            row["action"],
+        )
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = [0, DistinctSketch()]
+        cell[0] += 1
+        cell[1].add(row["zaius_id"])
+        count += 1
+    return cells, count
+
+
+def _timestamp(day):
+    midnight = datetime.datetime.combine(day, datetime.time(), datetime.timezone.utc)
+    return int(midnight.timestamp())
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Deterministic user sampling
+
+Exploratory runs rarely need every user. A sampled report keeps only the
+users whose id hashes below the sample rate, so the same users are picked
+on every run and every row of a picked user is kept.
+
+The sample is not pushed down into the export: its filters only compare a
+field with a value, there is no hash or modulo to pick users with, and a
+range of zaius_id would not pick the same users as the hash. The whole
+export is still requested and downloaded, and the sample is applied to the
+rows as they are read, before they reach an accumulator or a worker
+process. It saves the reports' work, not the export's.
+
+Counts over the sample are scaled back up by 1 / rate. Users are picked
+independently, so the variance of a scaled count is estimated as
+(1 - rate) / rate^2 times the sum of the squared per-user contributions,
+which gives the normal approximation confidence interval reported next
+to each count.
+"""
+
+import hashlib
+import math
+
+# z score of the reported confidence intervals
+CONFIDENCE_Z = 1.96
+HASH_BYTES = 8
+
+
+class Sampler:
+    """Decides whether a user id is part of the sample"""
+
+    def __init__(self, rate):
+        """
+        Args:
+            rate (float): fraction of users to keep, in (0, 1]
+        """
+        if not 0 < rate <= 1:
+            raise ValueError("sample rate must be in (0, 1], got {}".format(rate))
+        self.rate = rate
+        self.threshold = int(rate * 2 ** (8 * HASH_BYTES))
+        # rows come grouped by user, so the last answer is usually the next
+        self.last_key = None
+        self.last_kept = False
+
+    def __call__(self, key):
+        """
+        Args:
+            key (str): user id
+
+        Returns:
+            bool: whether the user is in the sample
+        """
+        if key != self.last_key:
+            digest = hashlib.blake2b(
+                str(key).encode("utf-8"), digest_size=HASH_BYTES
+            ).digest()
+            self.last_key = key
+            self.last_kept = int.from_bytes(digest, "big") < self.threshold
+        return self.last_kept
+
+
+def sample(rows, key, rate):
+    """
+    Pass through the rows of sampled users
+
+    Args:
+        rows (iterable): rows (dicts) of the export
+        key (str): field holding the user id
+        rate (float): fraction of users to keep
+
+    Yields:
+        (dict) rows whose user is in the sample
+    """
+    sampler = Sampler(rate)
+    for row in rows:
+        if sampler(row[key]):
+            yield row
+
+
+def estimate(count, sum_squares, rate):
+    """
+    Scale a count over the sample up to the whole population
+
+    Args:
+        count (int): total over the sampled users
+        sum_squares (int): sum of the squared per-user contributions to
+            count, equal to count when each user contributes 0 or 1
+        rate (float): the sample rate
+
+    Returns:
+        tuple: (estimate, half width of the confidence interval)
+    """
+    margin = CONFIDENCE_Z * math.sqrt((1 - rate) * sum_squares) / rate
+    return int(round(count / rate)), int(round(margin))
+
+
+def margin_column(column):
+    """Name of the column holding the confidence interval of column"""
+    return "{} +/-".format(column)
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""Distinct count sketches
+
+DistinctSketch estimates the number of distinct values added to it and
+can be merged with other sketches, so counts kept per day can be added
+up over any range of days without counting a user twice.
+
+Small sketches keep the 64 bit hashes of their values and are exact up
+to hash collisions. Past SPARSE_MAX values they switch to a HyperLogLog
+of 2**PRECISION registers, whose relative error is about
+1.04 / sqrt(2**PRECISION), 0.8%.
+"""
+
+import hashlib
+import math
+import struct
+import zlib
+
+PRECISION = 14
+REGISTERS = 1 << PRECISION
+# hashes kept before switching to registers, 8 bytes each
+SPARSE_MAX = 2048
+HASH_BITS = 64
+
+_SPARSE = b"S"
+_DENSE = b"D"
+
+
+class DistinctSketch:
+    """Mergeable estimate of a number of distinct values"""
+
+    def __init__(self):
+        # hashes of the values while sparse, None once dense
+        self.hashes = set()
+        # one byte register per bucket once dense
+        self.registers = None
+
+    def add(self, value):
+        """Add a value, anything with a str()"""
+        hashed = _hash(value)
+        if self.registers is None:
+            self.hashes.add(hashed)
+            if len(self.hashes) > SPARSE_MAX:
+                self._densify()
+        else:
+            self._add_hash(hashed)
+
+    def merge(self, other):
+        """Add every value of another sketch to this one"""
+        if other.registers is None:
+            if self.registers is None:
+                self.hashes |= other.hashes
+                if len(self.hashes) > SPARSE_MAX:
+                    self._densify()
+            else:
+                for hashed in other.hashes:
+                    self._add_hash(hashed)
+            return
+        if self.registers is None:
+            self._densify()
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self):
+        """
+        Returns:
+            int: estimated number of distinct values
+        """
+        if self.registers is None:
+            return len(self.hashes)
+        total = math.fsum(2.0 ** -register for register in self.registers)
+        alpha = 0.7213 / (1 + 1.079 / REGISTERS)
+        raw = alpha * REGISTERS * REGISTERS / total
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * REGISTERS and zeros:
+            # linear counting is more accurate for small cardinalities
+            return int(round(REGISTERS * math.log(REGISTERS / zeros)))
+        return int(round(raw))
+
+    def serialize(self):
+        """
+        Returns:
+            bytes: the sketch, see deserialize
+        """
+        if self.registers is None:
+            hashes = sorted(self.hashes)
+            return _SPARSE + struct.pack("<{}Q".format(len(hashes)), *hashes)
+        return _DENSE + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def deserialize(cls, data):
+        """
+        Args:
+            data (bytes): the output of serialize
+
+        Returns:
+            DistinctSketch: the sketch
+        """
+        sketch = cls()
+        kind, payload = data[:1], data[1:]
+        if kind == _SPARSE:
+            count = len(payload) // 8
+            sketch.hashes = set(struct.unpack("<{}Q".format(count), payload))
+        elif kind == _DENSE:
+            sketch.registers = bytearray(zlib.decompress(payload))
+        else:
+            raise ValueError("not a serialized sketch")
+        return sketch
+
+    def _densify(self):
+        self.registers = bytearray(REGISTERS)
+        for hashed in self.hashes:
+            self._add_hash(hashed)
+        self.hashes = None
+
+    def _add_hash(self, hashed):
+        bucket = hashed >> (HASH_BITS - PRECISION)
+        rest = hashed & ((1 << (HASH_BITS - PRECISION)) - 1)
+        # position of the leftmost 1 bit of the remaining bits
+        rank = HASH_BITS - PRECISION - rest.bit_length() + 1
+        if rank > self.registers[bucket]:
+            self.registers[bucket] = rank
+
+
+def _hash(value):
+    data = str(value).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "big")
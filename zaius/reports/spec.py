@@ -3,14 +3,74 @@
 
 Reports inherit from this base class and register themselves
 using the register classmethod.
+
+Reports that read from the export API split their work in two: query
+returns the sql-like statement they need and accumulator returns an
+object that is fed the resulting rows one at a time. Keeping the two
+apart lets several reports share a single export (see fanout).
 """
 
+import sys
+
+from .sampling import sample
+
+# how often to report progress while reading rows
+PROGRESS_ROWS = 100000
+
+
+class Accumulator:
+    """Consumes the rows of a report's query and writes the output"""
+
+    # pylint: disable=R0201
+    def add(self, row):
+        """Implementations should fold row into the report state."""
+
+        raise ValueError("not implemented")
+
+    def finish(self):
+        """Called after the last row. Implementations should write any
+        output that has not been written yet."""
+
+    # pylint: disable=R0201
+    def state(self):
+        """Called after the last row instead of finish when the rows were
+        partitioned across processes. Implementations should return their
+        partial aggregate (picklable)."""
+
+        raise ValueError("not implemented")
+
+    # pylint: disable=R0201
+    def merge(self, state):
+        """Implementations should fold a partial aggregate returned by
+        state or drain into this accumulator."""
+
+        raise ValueError("not implemented")
+
+    # pylint: disable=R0201
+    def drain(self):
+        """Called now and then while the rows are partitioned across
+        processes. Implementations whose output is made of independent
+        rows can return those produced so far, and forget them, so they are
+        written while the workers run instead of held until the end. None
+        keeps everything for state."""
+
+        return None
+
 
 class ReportSpec:
     """Base class for reports"""
 
     specs = []
 
+    # reports whose accumulators only depend on one user at a time and
+    # implement state/merge can be partitioned across processes by this field
+    partition_key = None
+
+    # reports whose output is made of counts over users, and whose
+    # accumulators scale them by args.sample, can be run on a sample of the
+    # users picked by this field
+    sample_key = None
+
     # pylint: disable=R0201
     def register_args(self, parser):
         """Implementations should add a subparser to parser that
@@ -19,15 +79,76 @@ class ReportSpec:
         raise ValueError("not implemented")
 
     # pylint: disable=R0201
-    def execute(self, api, destination, args):
-        """Implementations should evaluate the report and write
-        the output to destination."""
+    def query(self, args):
+        """Implementations that read from the export API should return
+        the sql-like statement the report needs."""
 
         raise ValueError("not implemented")
 
+    # pylint: disable=R0201
+    def accumulator(self, destination, args):
+        """Implementations that read from the export API should return an
+        Accumulator that writes the report to destination."""
+
+        raise ValueError("not implemented")
+
+    def shares_export(self, args):
+        """True if this run of the report can be fed rows from an export
+        shared with other reports (see fanout). Reports that override
+        execute run on their own unless they override this too."""
+
+        return type(self).execute is ReportSpec.execute
+
+    def execute(self, api, destination, args):
+        """Evaluate the report and write the output to destination.
+        Reports that don't follow the query/accumulator split should
+        override this."""
+
+        processes = getattr(args, "processes", None) or 1
+        if processes > 1 and self.partition_key is not None:
+            # imported here, parallel depends on this module
+            from .parallel import execute_partitioned  # pylint: disable=C0415
+
+            execute_partitioned(self, api, destination, args, processes)
+            return
+
+        accumulator = self.accumulator(destination, args)
+        for row in self.sampled(progress(api.query(self.query(args))), args):
+            accumulator.add(row)
+        accumulator.finish()
+
+    def sample_rate(self, args):
+        """The fraction of users args asks to sample, None for all of them"""
+
+        rate = getattr(args, "sample", None)
+        if rate is not None and self.sample_key is None:
+            raise ValueError(
+                "{} does not support sampling".format(type(self).__name__)
+            )
+        return rate
+
+    def sampled(self, rows, args):
+        """Pass through the rows of the users in the sample, if any"""
+
+        rate = self.sample_rate(args)
+        if rate is None:
+            return rows
+        return sample(rows, self.sample_key, rate)
+
     @classmethod
     def register(cls, report_spec):
         """Register an instance of a report so the CLI can access
         it."""
 
         cls.specs.append(report_spec)
+
+
+def progress(rows, out=sys.stderr):
+    """Pass rows through, periodically writing how many have been read"""
+
+    idx = 0
+    for idx, row in enumerate(rows):
+        if idx % PROGRESS_ROWS == 0:
+            out.write("Read {} rows\n".format(idx))
+        yield row
+    out.write("Read {} rows\n".format(idx))
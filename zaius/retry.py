@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Retry policy shared by the export API calls and s3 transfers.
+
+Transient failures (throttling, 5xx responses, dropped connections,
+truncated transfers) are retried with exponential backoff and jitter
+until either the attempt budget or the total time budget runs out.
+"""
+
+import logging
+import random
+import time
+
+
+class TransientError(Exception):
+    """
+    Thrown for failures that are expected to succeed if retried
+    """
+
+
+class ThrottledError(TransientError):
+    """
+    Thrown when the server asks us to slow down (429/503)
+    """
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with full jitter, bounded by a number of attempts
+    and a total amount of time spent retrying.
+    """
+
+    def __init__(
+        self,
+        attempts=6,
+        base_delay_s=0.5,
+        max_delay_s=30.0,
+        max_total_s=600.0,
+        retry_on=(TransientError, ConnectionError, TimeoutError),
+    ):
+        """
+        Args:
+            attempts (int): maximum number of calls, including the first one
+            base_delay_s (float): delay before the first retry
+            max_delay_s (float): upper bound on a single delay
+            max_total_s (float): give up once this much time has been spent
+            retry_on (tuple): exception types that are considered transient
+        """
+        self.attempts = attempts
+        self.base_delay_s = base_delay_s
+        self.max_delay_s = max_delay_s
+        self.max_total_s = max_total_s
+        self.retry_on = retry_on
+
+    def delay(self, attempt):
+        """
+        Seconds to wait before retry number `attempt` (starting at 1)
+        """
+        ceiling = min(self.max_delay_s, self.base_delay_s * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+    def call(self, func, *args, log=logging, **kwargs):
+        """
+        Call func until it succeeds or the policy gives up, in which case the
+        last error is raised.
+
+        Args:
+            func (callable): the operation to attempt
+            log (logging.Logger): destination for retry messages
+
+        Returns:
+            whatever func returns
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func(*args, **kwargs)
+            except self.retry_on as err:
+                delay = self.delay(attempt)
+                elapsed = time.monotonic() - start
+                if attempt >= self.attempts or elapsed + delay > self.max_total_s:
+                    raise
+                log.warning(
+                    "{} failed ({}), retry {} in {:.1f}s".format(
+                        getattr(func, "__name__", "call"), err, attempt, delay
+                    )
+                )
+                time.sleep(delay)
+
@@ -1,43 +1,292 @@
-import boto3
+"""
+S3 transfers for export results.
+
+boto3 is imported on first use so that importing this module (and the
+export api) stays cheap for callers that never touch s3.
+"""
+
+import collections
+import hashlib
+import io
 import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from functools import partial
-from multiprocessing import Pool, cpu_count
 
 import zaius.auth as auth
+from zaius.retry import RetryPolicy, TransientError
+
+# s3 error codes worth retrying
+TRANSIENT_CODES = (
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestTimeout",
+    "InternalError",
+    "ServiceUnavailable",
+    "500",
+    "503",
+)
+
+
+# clients by (process, access key). Clients are thread safe and keep their
+# connections alive, but are slow to create and must not cross a fork.
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
 
 
 def init_s3_client(auth_struct):
     """
-    initializes a s3 client for multiprocessing workers
+    initializes a s3 client for multiprocessing workers, or returns the one
+    this process already created for the same credentials
     """
     auth_struct = auth_struct if auth_struct is not None else auth.default()
-    return boto3.client("s3",
-                        aws_access_key_id=auth_struct["aws_access_key_id"],
-                        aws_secret_access_key=auth_struct["aws_secret_access_key"]
-                        )
+    cache_key = (os.getpid(), auth_struct["aws_access_key_id"])
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(cache_key)
+        if client is None:
+            import boto3  # pylint: disable=C0415
+
+            client = boto3.client(
+                "s3",
+                aws_access_key_id=auth_struct["aws_access_key_id"],
+                aws_secret_access_key=auth_struct["aws_secret_access_key"],
+            )
+            _CLIENTS[cache_key] = client
+    return client
+
+
+class DownloadCancelled(Exception):
+    """
+    Thrown by a download that was cancelled before it completed
+    """
+
+
+# bytes of export data we'd like each download process to handle
+BYTES_PER_PROCESS = 32 * 1024 * 1024
+# bounds on the buffer used to stream a shard to disk
+MIN_CHUNK_BYTES = 64 * 1024
+MAX_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+def plan_transfer(sizes):
+    """
+    Choose the number of download processes and the per-file transfer
+    settings from the sizes of the files to download. Unknown sizes fall
+    back to the defaults.
+
+    Args:
+        sizes (list): size in bytes of each file, None if unknown
+
+    Returns:
+        (int, dict): process count and download_from_s3 transfer settings
+    """
+    cores = os.cpu_count() or 1
+    if not sizes:
+        return 1, {}
+    if any(size is None for size in sizes):
+        return min(cores, len(sizes)), {}
+
+    total = sum(sizes)
+    processes = max(1, min(cores, len(sizes), -(-total // BYTES_PER_PROCESS)))
+
+    # one buffer per shard is enough for small shards, large shards
+    # are streamed in bigger reads to cut per-call overhead
+    chunk = max(MIN_CHUNK_BYTES, min(MAX_CHUNK_BYTES, max(sizes) // 16))
+    return processes, {"chunk_bytes": chunk}
+
+
+def _as_transient(err):
+    """
+    Map connection problems and throttling/5xx responses from boto onto
+    TransientError so a RetryPolicy retries them. Other errors are returned
+    unchanged.
+    """
+    import botocore.exceptions  # pylint: disable=C0415
+    import urllib3.exceptions  # pylint: disable=C0415
+
+    if isinstance(err, botocore.exceptions.ClientError):
+        code = err.response.get("Error", {}).get("Code")
+        if code in TRANSIENT_CODES:
+            return TransientError("s3 {}: {}".format(code, err))
+        return err
+    if isinstance(
+        err,
+        (
+            botocore.exceptions.BotoCoreError,
+            urllib3.exceptions.HTTPError,
+            ConnectionError,
+            TimeoutError,
+        ),
+    ):
+        return TransientError("s3 transfer failed: {}".format(err))
+    return err
+
+
+def _md5_of(path):
+    """
+    md5 of a (partial) local file
+    """
+    digest = hashlib.md5()
+    with open(path, "rb") as local:
+        for block in iter(lambda: local.read(MAX_CHUNK_BYTES), b""):
+            digest.update(block)
+    return digest
+
+
+def _download_attempt(client, bucket, key, output, chunk_bytes, cancel=None):
+    """
+    Fetch the part of key that is not in `<output>.part` yet using a ranged
+    GET, then validate the size and (for single part uploads) the ETag
+    before moving the file into place. The transfer is dropped between
+    chunks once the cancel event, if any, is set.
+    """
+    import botocore.exceptions  # pylint: disable=C0415
+
+    partial_path = output + ".part"
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    digest = _md5_of(partial_path) if offset else hashlib.md5()
 
+    kwargs = {"Bucket": bucket, "Key": key}
+    if offset:
+        kwargs["Range"] = "bytes={}-".format(offset)
+    try:
+        resp = client.get_object(**kwargs)
+        expected = offset + resp["ContentLength"]
+    except botocore.exceptions.ClientError as err:
+        if err.response.get("Error", {}).get("Code") != "InvalidRange":
+            raise
+        # the partial file already holds every byte; validate it below
+        resp = client.head_object(Bucket=bucket, Key=key)
+        expected = resp["ContentLength"]
+    else:
+        with open(partial_path, "ab") as local:
+            for block in resp["Body"].iter_chunks(chunk_bytes):
+                if cancel is not None and cancel.is_set():
+                    # closing the body drops the connection mid transfer
+                    resp["Body"].close()
+                    raise DownloadCancelled(key)
+                local.write(block)
+                digest.update(block)
 
-def download_from_s3(auth_struct, bucket, local_path, key):
+    size = os.path.getsize(partial_path)
+    etag = resp.get("ETag", "").strip('"')
+    valid = size == expected
+    if valid and etag and "-" not in etag:
+        valid = digest.hexdigest() == etag
+    if not valid:
+        os.remove(partial_path)
+        raise TransientError(
+            "{} failed validation ({} of {} bytes)".format(key, size, expected)
+        )
+    os.replace(partial_path, output)
+
+
+def download_from_s3(
+    auth_struct,
+    bucket,
+    local_path,
+    key,
+    transfer_config=None,
+    retry=None,
+    cancel=None,
+):
     """
     downloads a file from s3, defined outside of class for general use
-    and to allow for paralellism
+    and to allow for paralellism. Failed transfers are retried according
+    to retry and resume from the bytes already on disk. Setting the
+    cancel event, if any, aborts the transfer with DownloadCancelled.
     """
     _, fname = os.path.split(key)
     output = os.path.join(local_path, fname)
     client = init_s3_client(auth_struct)
-    client.download_file(bucket, key, output)
+    chunk_bytes = (transfer_config or {}).get("chunk_bytes", MIN_CHUNK_BYTES * 16)
+    retry = retry if retry is not None else RetryPolicy()
+
+    def attempt():
+        if cancel is not None and cancel.is_set():
+            raise DownloadCancelled(key)
+        try:
+            _download_attempt(client, bucket, key, output, chunk_bytes, cancel)
+        except DownloadCancelled:
+            raise
+        except Exception as err:  # pylint: disable=W0703
+            transient = _as_transient(err)
+            if transient is err:
+                raise
+            raise transient from err
+
+    attempt.__name__ = "download {}".format(key)
+    retry.call(attempt)
+    return key
 
 
-def par_s3_download(auth_struct, bucket, keys, local_path):
+def iter_s3_download(
+    auth_struct,
+    bucket,
+    keys,
+    local_path,
+    sizes=None,
+    retry=None,
+    pool=None,
+):
     """
-    Download a list of files living under s3:<bucket>/<keys>
-    into a local folder.
+    Download a list of files living under s3:<bucket>/<keys> into a
+    local folder, lazily: yield each key, in order, once its file is
+    there. Downloads run ahead of the consumer, one shard at first and
+    twice as many each time a shard is taken, up to twice the planned
+    concurrency, so a consumer that stops after a few rows only pays for
+    a few shards.
+
+    Once the generator is closed, or dropped, pending downloads are
+    skipped and transfers in flight are aborted: an owned pool is
+    terminated, the threads of a shared ThreadPool stop at their next
+    chunk. Transfers already running in a shared process pool are left
+    to finish.
     """
-    f = partial(download_from_s3, auth_struct, bucket, local_path)
-    cores = cpu_count()
-    
-    with Pool(cores) as p:
-        p.map(f, keys)
+    if not keys:
+        return
+    processes, config = plan_transfer(
+        [sizes.get(key) for key in keys] if sizes else [None] * len(keys)
+    )
+    from multiprocessing.pool import ThreadPool  # pylint: disable=C0415
+
+    cancel = None
+    if isinstance(pool, ThreadPool):
+        cancel = threading.Event()
+    f = partial(
+        download_from_s3,
+        auth_struct,
+        bucket,
+        local_path,
+        transfer_config=config,
+        retry=retry,
+        cancel=cancel,
+    )
+
+    owned = None
+    if pool is None:
+        from multiprocessing import Pool  # pylint: disable=C0415
+
+        owned = pool = Pool(processes)
+    try:
+        pending = collections.deque()
+        ahead = 1
+        remaining = collections.deque(keys)
+        while True:
+            while remaining and len(pending) < ahead:
+                pending.append(pool.apply_async(f, (remaining.popleft(),)))
+            if not pending:
+                return
+            yield pending.popleft().get()
+            ahead = min(2 * ahead, 2 * processes)
+    finally:
+        if cancel is not None:
+            cancel.set()
+        if owned is not None:
+            # terminate rather than close, transfers in flight are dropped
+            owned.terminate()
+            owned.join()
 
 
 def upload_to_s3(auth_struct, local_path, bucket, key):
@@ -49,9 +298,215 @@ def upload_to_s3(auth_struct, local_path, bucket, key):
     client.upload_file(local_path, bucket, key)
 
 
-def list_objects(auth_struct, bucket, prefix):
+# bytes per part of a multipart upload, s3 wants at least 5MB for all but
+# the last part
+PART_BYTES = 8 * 1024 * 1024
+# the part size doubles every this many parts, s3 allows 10000 parts
+PARTS_PER_SIZE = 1000
+# parts uploaded at once, (UPLOAD_THREADS + 1) parts are held in memory
+UPLOAD_THREADS = 4
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Binary stream that uploads what is written to it to s3 as a multipart
+    upload, on a few threads while the writer keeps going. Nothing is
+    staged on disk and at most (threads + 1) parts are held in memory.
+
+    The object only appears in s3 once the stream is closed; abort(), or
+    dropping the stream without closing it, discards the upload. Outputs
+    smaller than a part are sent with a single put.
+    """
+
+    def __init__(
+        self,
+        auth_struct,
+        bucket,
+        key,
+        part_bytes=PART_BYTES,
+        threads=UPLOAD_THREADS,
+        retry=None,
+        client=None,
+    ):
+        """
+        Args:
+            auth_struct (dict): credentials, see zaius.auth
+            bucket (str): destination bucket
+            key (str): destination key
+            part_bytes (int): size of the first parts
+            threads (int): parts uploaded at once
+            retry (zaius.retry.RetryPolicy): policy for each s3 request
+            client (botocore client): s3 client, by default the one of
+                init_s3_client
+        """
+        super().__init__()
+        self.client = client if client is not None else init_s3_client(auth_struct)
+        self.bucket = bucket
+        self.key = key
+        self.part_bytes = part_bytes
+        self.threads = threads
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.pending = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.pool = None
+        self.aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to a closed s3 upload")
+        self.pending += data
+        while len(self.pending) >= self._part_size():
+            size = self._part_size()
+            part = bytes(self.pending[:size])
+            del self.pending[:size]
+            self._submit(part)
+        return len(data)
+
+    def close(self):
+        """Upload what is left and complete the upload"""
+        if self.closed:
+            return
+        try:
+            if not self.aborted:
+                self._complete()
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+            super().close()
+
+    def abort(self):
+        """Discard the upload, nothing is written to s3"""
+        if self.closed or self.aborted:
+            return
+        self.aborted = True
+        for _, future in self.parts:
+            future.cancel()
+        if self.upload_id is not None:
+            self._call(
+                "abort",
+                self.client.abort_multipart_upload,
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+            )
+        self.close()
+
+    def __del__(self):
+        # unlike files, an unclosed upload is discarded rather than committed
+        if not self.closed:
+            try:
+                self.abort()
+            except Exception:  # pylint: disable=W0703
+                pass
+
+    def _part_size(self):
+        return self.part_bytes * 2 ** (len(self.parts) // PARTS_PER_SIZE)
+
+    def _submit(self, part):
+        """Upload a part in the background, waiting for a free thread"""
+        if self.upload_id is None:
+            self.upload_id = self._call(
+                "create",
+                self.client.create_multipart_upload,
+                Bucket=self.bucket,
+                Key=self.key,
+            )["UploadId"]
+            self.pool = ThreadPoolExecutor(self.threads)
+        running = [future for _, future in self.parts if not future.done()]
+        if len(running) >= self.threads:
+            wait(running, return_when=FIRST_COMPLETED)
+        for _, future in self.parts:
+            if future.done():
+                # raises the error of a failed part
+                future.result()
+        number = len(self.parts) + 1
+        future = self.pool.submit(
+            self._call,
+            "part {}".format(number),
+            self.client.upload_part,
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=number,
+            Body=part,
+        )
+        self.parts.append((number, future))
+
+    def _complete(self):
+        if self.upload_id is None:
+            self._call(
+                "put",
+                self.client.put_object,
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=bytes(self.pending),
+            )
+            return
+        if self.pending:
+            self._submit(bytes(self.pending))
+            self.pending = bytearray()
+        parts = [
+            {"ETag": future.result()["ETag"], "PartNumber": number}
+            for number, future in self.parts
+        ]
+        self._call(
+            "complete",
+            self.client.complete_multipart_upload,
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+
+    def _call(self, name, method, **kwargs):
+        """Make an s3 request, retrying transient failures"""
+
+        def attempt():
+            try:
+                return method(**kwargs)
+            except Exception as err:  # pylint: disable=W0703
+                transient = _as_transient(err)
+                if transient is err:
+                    raise
+                raise transient from err
+
+        attempt.__name__ = "{} s3://{}/{}".format(name, self.bucket, self.key)
+        return self.retry.call(attempt)
+
+
+def list_objects(auth_struct, bucket, prefix, continuation_token=None):
     """
     lists objects found at an s3_url
     """
     client = init_s3_client(auth_struct)
-    return client.list_objects_v2(Bucket=bucket, Prefix=prefix)
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if continuation_token is not None:
+        kwargs["ContinuationToken"] = continuation_token
+    return client.list_objects_v2(**kwargs)
+
+
+def read_object(auth_struct, bucket, key):
+    """
+    reads a (small) object into memory, returns None if it does not exist
+    """
+    import botocore.exceptions  # pylint: disable=C0415
+
+    client = init_s3_client(auth_struct)
+    try:
+        return client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except botocore.exceptions.ClientError as err:
+        if err.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None
+        transient = _as_transient(err)
+        if transient is err:
+            raise
+        raise transient from err
+    except (botocore.exceptions.BotoCoreError, ConnectionError) as err:
+        raise _as_transient(err) from err
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the command line interface
+
+Startup time matters because the CLI is invoked from schedulers many
+times a day; see benchmarks/startup.py for the timing side of this.
+"""
+
+import contextlib
+import http.client
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urllib.request
+
+import zaius.cli.main as cli
+import zaius.cli.serve as serve
+import zaius.profiling as profiling
+import zaius.reports.registry as registry
+
+HEAVY_MODULES = ["boto3", "botocore", "requests", "parsy", "multiprocessing"]
+
+PROBE = """
+import sys
+from zaius.cli.main import main
+try:
+    main(sys.argv[1:])
+except SystemExit:
+    pass
+print(",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+
+class TestCLI(unittest.TestCase):
+    """CLI tests"""
+
+    def setUp(self):
+        self.auth_file = tempfile.NamedTemporaryFile("wt", suffix=".ini")
+        self.auth_file.write(
+            "[auth]\naws_access_key_id: x\naws_secret_access_key: x\nzaius_secret_key: x\n"
+        )
+        self.auth_file.flush()
+
+    def tearDown(self):
+        self.auth_file.close()
+
+    def probe(self, *argv):
+        """Run the cli in a fresh interpreter, return its stdout lines"""
+
+        root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+        proc = subprocess.run(
+            [sys.executable, "-c", PROBE.format(heavy=HEAVY_MODULES)] + list(argv),
+            env=dict(os.environ, PYTHONPATH=os.path.abspath(root)),
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        return proc.stdout.splitlines()
+
+    def test_lazy_startup(self):
+        """--help and demo don't import heavy dependencies"""
+
+        self.assertEqual(self.probe("--help")[-1], "")
+        lines = self.probe("--auth", self.auth_file.name, "demo")
+        self.assertEqual(lines, ["it worked!", ""])
+
+    def test_registry(self):
+        """Every built-in report loads and registers under its name"""
+
+        for info in registry.BUILTIN:
+            spec = info.load()
+            self.assertIs(info.load(), spec)
+
+    def test_serve(self):
+        """The service runs reports and queries and caches their results"""
+
+        class FakeAPI:
+            """Serves fixed rows and counts the queries"""
+
+            def __init__(self):
+                self.queries = []
+
+            def query(self, stmt):
+                self.queries.append(stmt)
+                if "fail" in stmt:
+                    # enough rows for the response to have started
+                    yield from ({"zaius_id": str(idx)} for idx in range(10000))
+                    raise ValueError("export failed")
+                yield {"zaius_id": "1"}
+                yield {"zaius_id": "2"}
+
+        infos = registry.available()
+        parser = cli._build_parser(  # pylint: disable=W0212
+            infos, {info.name: info.load() for info in infos}
+        )
+        api = FakeAPI()
+        server = serve.make_server(api, parser, "127.0.0.1", 0, 2, 60)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+
+        def post(path, body):
+            request = urllib.request.Request(
+                "http://127.0.0.1:{}{}".format(server.server_address[1], path),
+                data=json.dumps(body).encode("utf-8"),
+            )
+            try:
+                with urllib.request.urlopen(request) as resp:
+                    return resp.status, resp.read().decode("utf-8")
+            except urllib.error.HTTPError as err:
+                return err.code, err.read().decode("utf-8")
+
+        try:
+            self.assertEqual(post("/report", {"args": ["demo"]}), (200, "it worked!\n"))
+            query = {"query": "select zaius_id from events"}
+            for _ in range(2):
+                status, body = post("/query", query)
+                self.assertEqual(status, 200)
+                self.assertEqual(
+                    [json.loads(line) for line in body.splitlines()],
+                    [{"zaius_id": "1"}, {"zaius_id": "2"}],
+                )
+            self.assertEqual(len(api.queries), 1)
+            post("/query", dict(query, cache=False))
+            self.assertEqual(len(api.queries), 2)
+
+            self.assertEqual(post("/report", {"args": ["--output", "x", "demo"]})[0], 400)
+            self.assertEqual(post("/report", {"args": ["no-such-report"]})[0], 400)
+
+            # a job failing part way through does not look like a whole result
+            with contextlib.redirect_stderr(io.StringIO()):
+                with self.assertRaises(http.client.IncompleteRead):
+                    post("/query", {"query": "select zaius_id from events fail"})
+            # every job gets its own http session
+            job_api = server.service.api_for(0)
+            self.assertIsNot(job_api, api)
+            self.assertIsNone(job_api._session)  # pylint: disable=W0212
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_profile(self):
+        """--profile times the stages and writes the profile files"""
+
+        with tempfile.TemporaryDirectory() as tmp:
+            prefix = os.path.join(tmp, "run")
+            profiler = profiling.Profiler(prefix, sample_interval_s=0.001)
+            profiler.start()
+            with profiling.stage("report"):
+                rows = profiling.iterate("decode", (time.sleep(0.002) for _ in range(5)))
+                for _ in rows:
+                    time.sleep(0.002)
+            paths = profiler.stop(summary=io.StringIO())
+            self.assertIsNone(profiling._ACTIVE)  # pylint: disable=W0212
+
+            decode, report = profiler.stats["decode"], profiler.stats["report"]
+            self.assertEqual((decode.calls, report.calls), (6, 1))
+            self.assertGreaterEqual(decode.self_s, 0.01)
+            self.assertGreaterEqual(report.total_s, decode.total_s + 0.01)
+            self.assertAlmostEqual(
+                report.self_s, report.total_s - decode.total_s, places=3
+            )
+            self.assertTrue(all(os.path.getsize(path) for path in paths))
+            with open(paths[1]) as folded:
+                self.assertTrue(folded.readline().startswith("stage:"))
+
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr), contextlib.redirect_stdout(
+                io.StringIO()
+            ):
+                cli.main(
+                    [
+                        "--auth",
+                        self.auth_file.name,
+                        "--profile",
+                        "--profile-output",
+                        prefix,
+                        "demo",
+                    ]
+                )
+            self.assertRegex(stderr.getvalue(), r"\nreport +1 ")
+            self.assertTrue(os.path.exists(prefix + ".pstats"))
+
+    def test_several_reports(self):
+        """Reports that run on their own can be combined with +"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            with contextlib.redirect_stderr(io.StringIO()):
+                cli.main(
+                    ["--auth", self.auth_file.name, "--output-dir", directory]
+                    + ["demo", "+", "demo"]
+                )
+            for name in ("demo.csv", "demo-2.csv"):
+                with open(os.path.join(directory, name)) as output:
+                    self.assertEqual(output.read(), "it worked!\n")
+
+            # the shared export is not split across processes
+            errors = io.StringIO()
+            with contextlib.redirect_stderr(errors):
+                with self.assertRaises(SystemExit):
+                    cli.main(
+                        ["--auth", self.auth_file.name, "--output-dir", directory]
+                        + ["demo", "+", "--processes", "2", "demo"]
+                    )
+            self.assertIn("--processes cannot be combined", errors.getvalue())
@@ -0,0 +1,1051 @@
+# -*- coding: utf-8 -*-
+"""Unit tests for the Export API wrapper
+
+These exercise the client side of the export flow with the network
+calls replaced by canned responses.
+"""
+
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from zaius import s3
+from zaius.export import API, ExecutionError, cohort, decode, decompress
+from zaius.export import parser
+from zaius.export.bitmap import Bitmap
+from zaius.export.cohort import CohortStore
+from zaius.export.dimensions import DimensionCache, LocalJoinAPI, Relation
+from zaius.export.filters import compile_filter
+from zaius.export.manifest import Manifest, ManifestError
+from zaius.export.scheduler import Scheduler
+from zaius.export.store import EventStore
+from zaius.retry import RetryPolicy, ThrottledError, TransientError
+from zaius.s3 import (
+    DownloadCancelled,
+    S3MultipartWriter,
+    _download_attempt,
+    plan_transfer,
+)
+
+
+class FakeAPI(API):
+    """API whose server and s3 calls are served from memory"""
+
+    POLL_INTERVAL_S = 0
+
+    def __init__(self, shards, states=("completed",)):
+        super().__init__(auth_struct={"zaius_secret_key": "fake"})
+        self.shards = shards
+        self.states = list(states)
+        self.requests = []
+        self.downloads = []
+
+    def _api_request(self, query_dict):
+        self.requests.append(query_dict)
+        return {"id": "export-1", "state": "pending"}
+
+    def _api_status(self, req):
+        state = self.states.pop(0) if len(self.states) > 1 else self.states[0]
+        return {"id": req["id"], "state": state, "path": "s3://bucket/prefix"}
+
+    def _s3_download(self, s3_url, local_path, skip=(), on_complete=None):
+        for key in sorted(self.shards):
+            if key in skip:
+                continue
+            with gzip.open(os.path.join(local_path, key), "wt") as shard:
+                writer = csv.DictWriter(shard, ["zaius_id"])
+                writer.writeheader()
+                writer.writerows(self.shards[key])
+            self.downloads.append(key)
+            if on_complete is not None:
+                on_complete(key)
+        return [os.path.join(local_path, key) for key in sorted(self.shards)]
+
+
+class FakeParquetAPI(FakeAPI):
+    """FakeAPI that serves parquet shards"""
+
+    def __init__(self, shards, states=("completed",)):
+        super().__init__(shards, states)
+        self.export_format = "parquet"
+
+    def _s3_download(self, s3_url, local_path, skip=(), on_complete=None):
+        import pyarrow  # pylint: disable=C0415
+        import pyarrow.parquet  # pylint: disable=C0415
+
+        for key in sorted(self.shards):
+            table = pyarrow.Table.from_pylist(self.shards[key])
+            pyarrow.parquet.write_table(table, os.path.join(local_path, key))
+            self.downloads.append(key)
+        return [os.path.join(local_path, key) for key in sorted(self.shards)]
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow  # pylint: disable=C0415,W0611
+    except ImportError:
+        return False
+    return True
+
+
+class FeedAPI(FakeAPI):
+    """FakeAPI whose exports return the events matching each query"""
+
+    def __init__(self, events):
+        super().__init__({})
+        self.events = events
+
+    def _api_request(self, query_dict):
+        self.requests.append(query_dict)
+        return {"id": str(len(self.requests) - 1), "state": "pending"}
+
+    def _api_status(self, req):
+        return {"id": req["id"], "state": "completed", "path": "s3://b/" + req["id"]}
+
+    def _s3_download(self, s3_url, local_path, skip=(), on_complete=None):
+        select = self.requests[int(s3_url.split("/")[-1])]["select"]
+        predicate = compile_filter(select.get("filter"))
+        path = os.path.join(local_path, "shard.csv.gz")
+        with gzip.open(path, "wt") as shard:
+            writer = csv.DictWriter(shard, select["fields"], extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(event for event in self.events if predicate(event))
+        return [path]
+
+
+class ObjectFeedAPI(FeedAPI):
+    """FeedAPI serving the rows of several objects"""
+
+    def __init__(self, objects):
+        super().__init__([])
+        self.objects = objects
+
+    def _s3_download(self, s3_url, local_path, skip=(), on_complete=None):
+        select = self.requests[int(s3_url.split("/")[-1])]["select"]
+        self.events = self.objects[select["object"]]
+        return super()._s3_download(s3_url, local_path, skip, on_complete)
+
+
+class ShardServerAPI(FakeAPI):
+    """FakeAPI that downloads its shards through the real download path"""
+
+    _s3_download = API._s3_download
+
+    def __init__(self, blobs, pool):
+        super().__init__({})
+        self.auth["aws_access_key_id"] = "shard-server"
+        self.blobs = blobs
+        self.pool = pool
+
+    def _manifest(self, bucket, prefix):
+        return Manifest([(key, len(data)) for key, data in self.blobs.items()])
+
+
+class FakeSession:
+    """requests.Session stand-in that answers with a list of statuses, or
+    of (status, body) pairs"""
+
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):  # pylint: disable=W0613
+        """Answer with the next status"""
+        self.calls.append(method)
+        status = self.statuses.pop(0)
+        if isinstance(status, tuple):
+            status, body = status
+        else:
+            body = {"id": "1", "state": "pending", "status": status}
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(body).encode("utf-8")
+        return response
+
+
+class FakeS3Shards:
+    """Minimal s3 client serving whole objects, records what was fetched"""
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.fetched = []
+
+    def get_object(self, Bucket, Key):  # pylint: disable=C0103,W0613
+        """Return an object"""
+        self.fetched.append(Key)
+        data = self.blobs[Key]
+        return {
+            "Body": FakeBody(data),
+            "ContentLength": len(data),
+            "ETag": '"{}"'.format(hashlib.md5(data).hexdigest()),
+        }
+
+
+class FakeS3Uploads:
+    """Minimal s3 client for uploads, fails the first attempt at part 2"""
+
+    # pylint: disable=C0103,W0613
+    def __init__(self):
+        self.parts = {}
+        self.objects = {}
+        self.aborted = []
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        """Start an upload"""
+        return {"UploadId": "{}/{}".format(Bucket, Key)}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        """Keep a part"""
+        with self.lock:
+            if PartNumber == 2 and not self.failed:
+                self.failed = True
+                raise ConnectionError("connection reset")
+            self.parts[(UploadId, PartNumber)] = Body
+        return {"ETag": hashlib.md5(Body).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        """Assemble the object from its parts"""
+        self.objects[(Bucket, Key)] = b"".join(
+            self.parts[(UploadId, part["PartNumber"])]
+            for part in MultipartUpload["Parts"]
+        )
+
+    def put_object(self, Bucket, Key, Body):
+        """Store a whole object"""
+        self.objects[(Bucket, Key)] = Body
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        """Drop an upload"""
+        self.aborted.append(UploadId)
+
+
+class FakeBody:
+    """Streaming body that can fail part way through"""
+
+    def __init__(self, data, fail_after=None):
+        self.data = data
+        self.fail_after = fail_after
+        self.closed = False
+
+    def close(self):
+        """Drop the connection"""
+        self.closed = True
+
+    def iter_chunks(self, chunk_bytes):
+        """Yield data in chunks, failing once fail_after bytes were sent"""
+        for idx in range(0, len(self.data), chunk_bytes):
+            if self.fail_after is not None and idx >= self.fail_after:
+                raise ConnectionError("connection reset")
+            yield self.data[idx : idx + chunk_bytes]
+
+
+class FakeS3:
+    """Minimal s3 client that honours Range requests"""
+
+    def __init__(self, data, fail_after=None):
+        self.data = data
+        self.fail_after = fail_after
+        self.ranges = []
+
+    def get_object(self, Bucket, Key, Range=None):  # pylint: disable=C0103,W0613
+        """Return the object, or the tail of it for a ranged request"""
+        self.ranges.append(Range)
+        start = int(Range[len("bytes=") : -1]) if Range else 0
+        body = FakeBody(self.data[start:], self.fail_after)
+        self.fail_after = None
+        return {
+            "Body": body,
+            "ContentLength": len(self.data) - start,
+            "ETag": '"{}"'.format(hashlib.md5(self.data).hexdigest()),
+        }
+
+
+# pylint: disable=W0212
+class TestExport(unittest.TestCase):
+    """Export API tests"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.job_file = os.path.join(self.tmp, "job.json")
+        self.shards = {
+            "a.csv.gz": [{"zaius_id": "1"}, {"zaius_id": "2"}],
+            "b.csv.gz": [{"zaius_id": "3"}],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_query_resumes_from_job_file(self):
+        """A rerun with the same job file reattaches to the export and only
+        downloads shards that are missing"""
+
+        api = FakeAPI(self.shards, states=("running", "completed"))
+        rows = api.query_raw({"select": {"fields": ["zaius_id"]}}, job_file=self.job_file)
+        next(rows)
+        self.assertEqual(len(api.requests), 1)
+        self.assertEqual(api.downloads, ["a.csv.gz", "b.csv.gz"])
+
+        # simulate a crash: drop a shard and lose the generator
+        rows.close()
+        os.remove(os.path.join(self.job_file + ".shards", "b.csv.gz"))
+
+        api = FakeAPI(self.shards)
+        rows = list(
+            api.query_raw({"select": {"fields": ["zaius_id"]}}, job_file=self.job_file)
+        )
+        self.assertEqual(api.requests, [])
+        self.assertEqual(api.downloads, ["b.csv.gz"])
+        self.assertEqual([r["zaius_id"] for r in rows], ["1", "2", "3"])
+
+        # a fully consumed job cleans up after itself
+        self.assertFalse(os.path.exists(self.job_file))
+
+    def test_resume_by_id(self):
+        """An export can be reattached to by id"""
+
+        api = FakeAPI(self.shards, states=("running", "completed"))
+        rows = list(api.resume("export-1"))
+        self.assertEqual(api.requests, [])
+        self.assertEqual(len(rows), 3)
+
+    def test_job_file_query_mismatch(self):
+        """A job file cannot be reused for a different query"""
+
+        api = FakeAPI(self.shards)
+        rows = api.query_raw({"select": {"fields": ["zaius_id"]}}, job_file=self.job_file)
+        next(rows)
+        rows.close()
+        with self.assertRaises(ValueError):
+            list(api.query_raw({"select": {"fields": ["ts"]}}, job_file=self.job_file))
+
+    def test_manifest(self):
+        """The manifest lists shards relative to the export prefix and catches
+        truncated downloads"""
+
+        manifest = Manifest.parse(
+            {
+                "files": [
+                    {"key": "b.csv.gz", "size": 3},
+                    {"path": "s3://bucket/exports/1/a.csv.gz", "bytes": 5},
+                ]
+            },
+            "bucket",
+            "exports/1/",
+        )
+        self.assertEqual(manifest.keys, ["exports/1/a.csv.gz", "exports/1/b.csv.gz"])
+        self.assertEqual(manifest.total_bytes, 8)
+        self.assertIsNone(Manifest.parse({"state": "done"}, "bucket", "exports/1/"))
+
+        with open(os.path.join(self.tmp, "a.csv.gz"), "wb") as shard:
+            shard.write(b"12345")
+        with open(os.path.join(self.tmp, "b.csv.gz"), "wb") as shard:
+            shard.write(b"12")
+        with self.assertRaises(ManifestError):
+            manifest.verify(self.tmp)
+
+    def test_plan_transfer(self):
+        """Download concurrency follows the amount of data"""
+
+        processes, config = plan_transfer([1024] * 8)
+        self.assertEqual(processes, 1)
+        self.assertGreaterEqual(config["chunk_bytes"], 64 * 1024)
+        processes, _ = plan_transfer([None, None])
+        self.assertLessEqual(processes, 2)
+
+    def test_retry_policy(self):
+        """Transient errors are retried, others are raised immediately"""
+
+        calls = []
+
+        def flaky():
+            calls.append(1)
+            if len(calls) < 3:
+                raise TransientError("try again")
+            return "ok"
+
+        policy = RetryPolicy(attempts=5, base_delay_s=0)
+        self.assertEqual(policy.call(flaky), "ok")
+        self.assertEqual(len(calls), 3)
+
+        calls.clear()
+        with self.assertRaises(TransientError):
+            RetryPolicy(attempts=2, base_delay_s=0).call(flaky)
+        self.assertEqual(len(calls), 2)
+
+        def broken():
+            calls.append(1)
+            raise ValueError("bad")
+
+        calls.clear()
+        with self.assertRaises(ValueError):
+            policy.call(broken)
+        self.assertEqual(len(calls), 1)
+
+    def test_submit_not_retried(self):
+        """Polls are retried on server errors, submissions only when they
+        were throttled, as a lost response may hide a started export. Any
+        2xx response succeeds unless its body says otherwise."""
+
+        api = API(
+            auth_struct={"zaius_secret_key": "fake"},
+            retry=RetryPolicy(base_delay_s=0),
+        )
+        api._session = FakeSession([502, 200])
+        self.assertEqual(api._api_status({"id": "1"})["id"], "1")
+        self.assertEqual(len(api._session.calls), 2)
+
+        api._session = FakeSession([502, 200])
+        with self.assertRaises(ExecutionError):
+            api._api_request({"select": {}})
+        self.assertEqual(api._session.calls, ["post"])
+
+        api._session = FakeSession([429, 200])
+        self.assertEqual(api._api_request({"select": {}})["id"], "1")
+        self.assertEqual(api._session.calls, ["post", "post"])
+
+        # any 2xx is a success, the body's status is only checked if it has one
+        api._session = FakeSession([(202, {"id": "2", "state": "pending"})])
+        self.assertEqual(api._api_request({"select": {}})["id"], "2")
+        api._session = FakeSession(
+            [(200, {"status": 400, "detail": {"message": "bad query"}})]
+        )
+        with self.assertRaisesRegex(ExecutionError, "bad query"):
+            api._api_request({"select": {}})
+
+    def test_follow(self):
+        """Overlapping rounds yield every event once, also late arrivals and
+        across restarts"""
+
+        now = int(time.time())
+        events = [
+            {"zaius_id": "1", "ts": str(now - 100)},
+            {"zaius_id": "2", "ts": str(now - 50)},
+        ]
+        api = FeedAPI(events)
+        state_file = os.path.join(self.tmp, "follow.json")
+        stmt = "select zaius_id, ts from events"
+        rows = api.follow(
+            stmt, now - 200, state_file=state_file, interval_s=0, overlap_s=300, rounds=2
+        )
+        self.assertEqual([next(rows)["zaius_id"], next(rows)["zaius_id"]], ["1", "2"])
+        # the second round is submitted before the first is read
+        self.assertEqual(len(api.requests), 2)
+        # an event that arrives late, behind the first round's watermark
+        events.append({"zaius_id": "3", "ts": str(now - 30)})
+        self.assertEqual([row["zaius_id"] for row in rows], ["3"])
+
+        events.append({"zaius_id": "4", "ts": str(now - 10)})
+        api = FeedAPI(events)
+        rows = api.follow(stmt, 0, state_file=state_file, overlap_s=300, rounds=1)
+        self.assertEqual([row["zaius_id"] for row in rows], ["4"])
+        with self.assertRaises(ValueError):
+            next(api.follow("select zaius_id from events", 0))
+
+    def test_follow_resume(self):
+        """Identical events are each yielded once and a stopped follower's
+        pending exports are read by the next one"""
+
+        now = int(time.time())
+        events = [
+            {"zaius_id": "1", "ts": str(now - 100)},
+            {"zaius_id": "2", "ts": str(now - 90)},
+            {"zaius_id": "2", "ts": str(now - 90)},
+        ]
+        api = FeedAPI(events)
+        state_file = os.path.join(self.tmp, "follow.json")
+        stmt = "select zaius_id, ts from events"
+        rows = api.follow(
+            stmt, now - 200, state_file=state_file, interval_s=0, overlap_s=300
+        )
+        self.assertEqual(next(rows)["zaius_id"], "1")
+        rows.close()
+        self.assertEqual(len(api.requests), 2)
+
+        rows = api.follow(
+            stmt, 0, state_file=state_file, interval_s=0, overlap_s=300, rounds=2
+        )
+        self.assertEqual([row["zaius_id"] for row in rows], ["2", "2"])
+        # both exports were reattached, none submitted again
+        self.assertEqual(len(api.requests), 2)
+        with open(state_file) as state:
+            self.assertEqual(json.load(state)["pending"], [])
+
+    def test_decompress(self):
+        """Single and multi member shards inflate to the same bytes as gzip,
+        also when compressed data looks like a gzip header"""
+
+        data = "".join(
+            "{},{}\n".format(idx, "\x1f\x8b\x08" if idx % 7 == 0 else "x" * (idx % 50))
+            for idx in range(20000)
+        ).encode("utf-8")
+        single = gzip.compress(data)
+        multi = b"".join(
+            gzip.compress(data[start:start + 30000], compresslevel=start % 7)
+            for start in range(0, len(data), 30000)
+        )
+        segment_bytes = decompress.SEGMENT_BYTES
+        decompress.SEGMENT_BYTES = 4096
+        try:
+            for content in (single, multi, multi + b"\0" * 8):
+                path = os.path.join(self.tmp, "shard.gz")
+                with open(path, "wb") as shard:
+                    shard.write(content)
+                for threads in (1, 4):
+                    self.assertEqual(b"".join(decompress.chunks(path, threads)), data)
+            with open(path, "wb") as shard:
+                shard.write(single[:-100])
+            with self.assertRaises(EOFError):
+                list(decompress.chunks(path, 4))
+            # a corrupt member raises the zlib error, not a BufferError from
+            # closing the memory map under it
+            corrupt = bytearray(multi)
+            corrupt[-6] ^= 0xFF
+            with open(path, "wb") as shard:
+                shard.write(corrupt)
+            for threads in (1, 4):
+                with self.assertRaises(decompress.backend().error):
+                    list(decompress.chunks(path, threads))
+        finally:
+            decompress.SEGMENT_BYTES = segment_bytes
+
+    def test_scheduler(self):
+        """Exports get window slots by priority, then fairly across callers,
+        polls are not held up by the window and throttling halves the rate
+        and window"""
+
+        scheduler = Scheduler(rate_per_s=1000, burst=100, concurrency=1)
+        order = []
+        scheduler.begin_export(caller="x")
+        # the window is full, calls for the running export still go through
+        self.assertEqual(scheduler.call(len, "poll"), 4)
+
+        def export(caller, priority):
+            scheduler.begin_export(priority=priority, caller=caller)
+            order.append(caller)
+            scheduler.end_export()
+
+        # the thread holding the slot gets another one right away
+        scheduler.begin_export(caller="x")
+        scheduler.end_export(completed=False)
+        self.assertEqual(scheduler.in_flight, 1)
+
+        threads = []
+        for caller, priority in [("a", 0), ("a", 0), ("a", 0), ("b", 0), ("c", 1)]:
+            queued = len(scheduler.exports)
+            thread = threading.Thread(target=export, args=(caller, priority))
+            thread.start()
+            threads.append(thread)
+            while len(scheduler.exports) == queued:
+                time.sleep(0.001)
+        self.assertEqual(order, [])
+        scheduler.end_export()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ["c", "a", "b", "a", "a"])
+        self.assertEqual(scheduler.in_flight, 0)
+
+        def throttled():
+            raise ThrottledError("slow down")
+
+        scheduler = Scheduler(rate_per_s=8, concurrency=8)
+        with self.assertRaises(ThrottledError):
+            scheduler.call(throttled)
+        self.assertEqual((scheduler.rate_per_s, scheduler.window), (4, 4))
+        scheduler.call(len, "")
+        self.assertEqual((scheduler.rate_per_s, scheduler.window), (4.25, 4))
+        scheduler.begin_export()
+        scheduler.end_export()
+        self.assertEqual(scheduler.window, 4.25)
+
+        # an export api holds its slot from the submission to the completion
+        api = FakeAPI(
+            {"a.csv.gz": [{"zaius_id": "1"}]}, states=("running", "completed")
+        )
+        api.scheduler = Scheduler(concurrency=1)
+        in_flight = []
+        status = api._api_status
+
+        def polled(req):
+            in_flight.append(api.scheduler.in_flight)
+            return status(req)
+
+        api._api_status = polled
+        self.assertEqual(len(list(api.query("select zaius_id from events"))), 1)
+        self.assertEqual(in_flight, [1, 1])
+
+        # a follower with a window of 1 that exports the gaps left by a
+        # stopped one, while a query runs between its rows
+        now = int(time.time())
+        events = [
+            {"zaius_id": str(idx), "ts": str(now - 100 + idx)} for idx in range(3)
+        ]
+        api = FeedAPI(events)
+        api.scheduler = Scheduler(concurrency=1)
+        state_file = os.path.join(self.tmp, "gaps.json")
+        stmt = "select zaius_id, ts from events"
+        rows = api.follow(stmt, now - 200, state_file, interval_s=0, overlap_s=300)
+        next(rows)
+        rows.close()
+        with open(state_file) as state:
+            saved = json.load(state)
+        for entry in saved["pending"]:
+            entry[1] += 10
+        with open(state_file, "w") as state:
+            json.dump(saved, state)
+
+        found = []
+
+        def follow():
+            for row in api.follow(stmt, 0, state_file, overlap_s=300, rounds=4):
+                found.append(row["zaius_id"])
+                found.append(len(list(api.query("select zaius_id from events"))))
+
+        thread = threading.Thread(target=follow, daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(found, ["1", 3, "2", 3])
+        self.assertEqual(api.scheduler.in_flight, 0)
+        self.assertEqual(api.scheduler.in_flight, 0)
+
+    def test_download_resumes(self):
+        """An interrupted shard download resumes with a ranged GET and is
+        checked against the ETag"""
+
+        data = os.urandom(1000)
+        client = FakeS3(data, fail_after=400)
+        output = os.path.join(self.tmp, "shard.csv.gz")
+        with self.assertRaises(ConnectionError):
+            _download_attempt(client, "bucket", "shard.csv.gz", output, 100)
+        self.assertEqual(os.path.getsize(output + ".part"), 400)
+
+        _download_attempt(client, "bucket", "shard.csv.gz", output, 100)
+        self.assertEqual(client.ranges, [None, "bytes=400-"])
+        with open(output, "rb") as shard:
+            self.assertEqual(shard.read(), data)
+
+    @unittest.skipUnless(_has_pyarrow(), "pyarrow is not installed")
+    def test_parquet_export(self):
+        """Parquet exports are requested as such and decode to typed rows or
+        record batches of just the selected columns"""
+
+        shards = {
+            "a.parquet": [
+                {"zaius_id": "1", "ts": 5, "action": "open"},
+                {"zaius_id": "2", "ts": 6, "action": "click"},
+            ],
+            "b.parquet": [{"zaius_id": "3", "ts": 7, "action": "click"}],
+        }
+        api = FakeParquetAPI(shards)
+        rows = list(api.query("select zaius_id, ts from events"))
+        self.assertEqual(api.requests[0]["format"], "parquet")
+        self.assertEqual(
+            rows,
+            [
+                {"zaius_id": "1", "ts": 5},
+                {"zaius_id": "2", "ts": 6},
+                {"zaius_id": "3", "ts": 7},
+            ],
+        )
+
+        batches = list(api.query_batches("select ts from events"))
+        self.assertEqual([batch.schema.names for batch in batches], [["ts"], ["ts"]])
+        self.assertEqual(sum(batch.num_rows for batch in batches), 3)
+
+        with self.assertRaises(ValueError):
+            list(FakeAPI(self.shards).query_batches("select ts from events"))
+        with self.assertRaises(ValueError):
+            decode.decoder("xml")
+
+    def test_query_grouped(self):
+        """Rows ordered by a key come back one group per key, also across
+        record batch and shard boundaries"""
+
+        stmt = "select zaius_id from events order by zaius_id"
+        api = FakeAPI(self.shards)
+        self.assertEqual(
+            [(key, len(rows)) for key, rows in api.query_grouped(stmt)],
+            [("1", 1), ("2", 1), ("3", 1)],
+        )
+        with self.assertRaises(ValueError):
+            list(api.query_grouped("select zaius_id from events"))
+
+        # the files are kept until the with block exits
+        with api.query_shards("select zaius_id from events") as shards:
+            paths = list(shards)
+            self.assertEqual(len(paths), len(self.shards))
+            self.assertTrue(all(os.path.exists(path) for path in paths))
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+        if not _has_pyarrow():
+            return
+        ids = ["a", "a", "a", "b", "c", "c", "d"]
+        rows = [{"zaius_id": key, "ts": ts} for ts, key in enumerate(ids)]
+        shards = {"a.parquet": rows[:5], "b.parquet": rows[5:]}
+        batch_rows = decode.ParquetDecoder.BATCH_ROWS
+        decode.ParquetDecoder.BATCH_ROWS = 2
+        try:
+            groups = list(
+                FakeParquetAPI(shards).query_grouped(
+                    "select zaius_id, ts from events order by zaius_id"
+                )
+            )
+        finally:
+            decode.ParquetDecoder.BATCH_ROWS = batch_rows
+        self.assertEqual(
+            [(key, batch.column("ts").to_pylist()) for key, batch in groups],
+            [("a", [0, 1, 2]), ("b", [3]), ("c", [4, 5]), ("d", [6])],
+        )
+
+    def test_batch(self):
+        """Batched queries share one export and each sees only its rows"""
+
+        class RowsAPI(API):
+            """API that serves fixed rows"""
+
+            def __init__(self, rows):
+                super().__init__(auth_struct={"zaius_secret_key": "fake"})
+                self.rows = rows
+                self.queries = []
+
+            def query_raw(self, query_dict, job_file=None):
+                self.queries.append(query_dict)
+                return iter(self.rows)
+
+        api = RowsAPI(
+            [
+                {"zaius_id": "1", "action": "open", "ts": "5"},
+                {"zaius_id": "2", "action": "click", "ts": "6"},
+                {"zaius_id": "3", "action": "click", "ts": "7"},
+            ]
+        )
+        with api.batch() as batch:
+            clicks = batch.query("select zaius_id from events where action = 'click'")
+            late = batch.query("select ts from events where ts > 5 limit 1")
+        self.assertEqual(len(api.queries), 1)
+        merged = api.queries[0]["select"]
+        self.assertEqual(merged["fields"], ["zaius_id", "action", "ts"])
+        self.assertIn("or", merged["filter"])
+        self.assertEqual(list(clicks), [{"zaius_id": "2"}, {"zaius_id": "3"}])
+        self.assertEqual(list(late), [{"ts": "6"}])
+
+    def test_bitmap(self):
+        """Bitmaps agree with sets and read the portable roaring format"""
+
+        rng = random.Random(7)
+        for size, span in [(10, 2 ** 32), (3000, 70000), (30000, 200000)]:
+            left = set(rng.randrange(span) for _ in range(size))
+            right = set(rng.randrange(200000) for _ in range(20000))
+            left_map, right_map = Bitmap(left), Bitmap(right)
+            self.assertEqual(list(left_map), sorted(left))
+            self.assertEqual(list(left_map & right_map), sorted(left & right))
+            self.assertEqual(list(left_map | right_map), sorted(left | right))
+            self.assertEqual(list(left_map - right_map), sorted(left - right))
+            self.assertEqual(list(left_map ^ right_map), sorted(left ^ right))
+            self.assertEqual(len(left_map | right_map), len(left | right))
+            self.assertEqual(Bitmap.deserialize(left_map.serialize()), left_map)
+            value = next(iter(left))
+            self.assertIn(value, left_map)
+            self.assertEqual(value + 1 in left_map, value + 1 in left)
+
+        # one run container holding 5..14, as written by other roaring libraries
+        runs = struct.pack("<IBHHHHH", 12347, 1, 0, 9, 1, 5, 9)
+        self.assertEqual(list(Bitmap.deserialize(runs)), list(range(5, 15)))
+        with self.assertRaises(ValueError):
+            Bitmap([2 ** 32])
+
+    def test_cohort(self):
+        """Cohorts combine per campaign and day bitmaps and filter queries"""
+
+        day = 86400
+        events = [
+            dict(zip(cohort.FIELDS, values))
+            for values in [
+                ("a", str(day), "email", "open", "1"),
+                ("b", str(day), "email", "open", "1"),
+                ("b", str(2 * day), "email", "open", "2"),
+                ("c", str(3 * day), "order", "purchase", ""),
+                ("a", str(3 * day + 5), "order", "purchase", ""),
+            ]
+        ]
+        api = FeedAPI(events)
+        path = os.path.join(self.tmp, "cohorts.db")
+        with CohortStore(path, bitmap_class=Bitmap) as store:
+            self.assertEqual(store.ingest_export(api, 0, 4 * day), 5)
+            self.assertEqual(len(store.keys()), 3)
+            opened_1 = store.cohort(action="open", campaign_id="1")
+            opened_2 = store.cohort(action="open", campaign_id=2)
+            bought = store.cohort(
+                action="purchase", start_day="1970-01-04", end_day="1970-01-04"
+            )
+            self.assertEqual(store.members(opened_1 - opened_2), ["a"])
+            self.assertEqual(len(opened_1 & bought), 1)
+            self.assertEqual(len(store.cohort(start_day="1970-01-03")), 3)
+
+        # ids and bitmaps persist, a second ingest extends them
+        with CohortStore(path, bitmap_class=Bitmap) as store:
+            late = ("d", str(day), "email", "open", 1)
+            store.ingest([dict(zip(cohort.FIELDS, late))])
+            opened_1 = store.cohort(action="open", campaign_id="1")
+            self.assertEqual(store.members(opened_1), ["a", "b", "d"])
+            self.assertEqual(store.ids.ids(["a", "d", "x"], assign=False), [1, 4, None])
+
+            users = opened_1 & bought
+            rows = list(store.query(api, "select zaius_id, action from events", users))
+            self.assertEqual(
+                [(row["zaius_id"], row["action"]) for row in rows],
+                [("a", "open"), ("a", "purchase")],
+            )
+            # the small cohort was sent to the api as a filter
+            self.assertIn("zaius_id", str(api.requests[-1]["select"]["filter"]))
+            with self.assertRaises(ValueError):
+                next(store.query(api, "select ts from events", users))
+
+    def test_event_store(self):
+        """The store dedups events, prunes segments and answers queries"""
+
+        day = 86400
+        events = [
+            {
+                "zaius_id": str(idx % 7),
+                "ts": str(day * (idx % 3) + idx),
+                "event_type": "email",
+                "action": "open" if idx % 2 else "click",
+                "campaign_id": str(idx % 3),
+            }
+            for idx in range(60)
+        ]
+        identity = (
+            "zaius_id, ts, event_type, action, product_id, order_id, campaign_id, "
+            "campaign_schedule_run_ts"
+        )
+        stmt = "select {} from events".format(identity)
+        store = EventStore(os.path.join(self.tmp, "store"))
+        self.assertEqual(store.ingest_query(FeedAPI(events), parser.parse(stmt)), 60)
+        # the same events through another select list are not stored again
+        stmt = "select {}, customer.email from events".format(identity)
+        self.assertEqual(store.ingest_query(FeedAPI(events), parser.parse(stmt)), 0)
+        with self.assertRaises(ValueError):
+            store.ingest_query(FeedAPI(events), parser.parse("select ts from events"))
+        # overlapping exports only add what is new
+        more = events[30:] + [dict(events[0], action="sent")]
+        self.assertEqual(store.ingest(more), 1)
+        events.append(more[-1])
+
+        store = EventStore(os.path.join(self.tmp, "store"))
+        self.assertEqual(len(store.catalog["segments"]), 4)
+        queries = [
+            ("select zaius_id, ts from events where ts >= {}".format(2 * day), 1),
+            ("select ts from events where ts < 100 and action = 'open'", 2),
+            ("select ts from events where campaign_id = '1' or ts > 1000000", 1),
+            ("select ts from events where missing = 1", 0),
+            ("select zaius_id, ts, action from events", 4),
+        ]
+        for query, scanned in queries:
+            query_dict = parser.parse(query)
+            select = query_dict["select"]
+            predicate = compile_filter(select.get("filter"))
+            expected = sorted(
+                tuple(event[field] for field in select["fields"])
+                for event in events
+                if predicate(event)
+            )
+            rows = store.query(query)
+            self.assertEqual(
+                sorted(tuple(row.values()) for row in rows), expected, query
+            )
+            self.assertEqual(store.last_scan, (4, scanned), query)
+
+        stmt = "select zaius_id, ts from events order by zaius_id, ts desc limit 3"
+        self.assertEqual(
+            [int(row["ts"]) - 2 * day for row in store.query(stmt)], [56, 35, 14]
+        )
+        # sorted segments are merged into one order
+        stmt = "select action, ts from events order by action desc, ts"
+        expected = sorted(events, key=lambda event: int(event["ts"]))
+        expected.sort(key=lambda event: event["action"], reverse=True)
+        self.assertEqual(
+            [(row["action"], row["ts"]) for row in store.query(stmt)],
+            [(event["action"], event["ts"]) for event in expected],
+        )
+        with self.assertRaises(ValueError):
+            next(store.query("select name from customers"))
+
+        # the line items of an order and opens of two campaigns in the same
+        # second are distinct events
+        same_second = [
+            {"zaius_id": "1", "ts": "5", "event_type": "order", "action": "purchase"},
+            {"zaius_id": "1", "ts": "5", "event_type": "email", "action": "open"},
+        ]
+        rows = [
+            dict(same_second[0], order_id="o1", product_id=product)
+            for product in ("p1", "p2", "p3")
+        ] + [dict(same_second[1], campaign_id=campaign) for campaign in ("1", "2")]
+        store = EventStore(os.path.join(self.tmp, "orders"))
+        self.assertEqual(store.ingest(rows), 5)
+        self.assertEqual(store.ingest(rows), 0)
+        self.assertEqual(len(list(store.query("select ts from events"))), 5)
+
+    def test_multipart_upload(self):
+        """Output is uploaded in parts as it is written, failures abort it"""
+
+        client = FakeS3Uploads()
+        retry = RetryPolicy(base_delay_s=0)
+        data = os.urandom(1000)
+        upload = S3MultipartWriter(
+            None, "b", "big", part_bytes=64, threads=2, retry=retry, client=client
+        )
+        for start in range(0, len(data), 100):
+            upload.write(data[start:start + 100])
+        # bounded buffering: less than a part is held back
+        self.assertLess(len(upload.pending), 64)
+        upload.close()
+        self.assertEqual(client.objects[("b", "big")], data)
+        self.assertEqual(len(upload.parts), 16)
+        self.assertTrue(client.failed)
+
+        with S3MultipartWriter(None, "b", "small", client=client) as upload:
+            upload.write(b"tiny")
+        self.assertEqual(client.objects[("b", "small")], b"tiny")
+
+        upload = S3MultipartWriter(None, "b", "partial", part_bytes=64, client=client)
+        upload.write(data)
+        upload.abort()
+        upload.close()
+        self.assertEqual(client.aborted, ["b/partial"])
+        self.assertNotIn(("b", "partial"), client.objects)
+
+    def test_dimensions(self):
+        """Dimension fields are cached, joined locally and refreshed"""
+
+        customers = [
+            {"zaius_id": str(idx), "email": "{}@x.com".format(idx), "updated": "10"}
+            for idx in range(5)
+        ]
+        events = [
+            {"zaius_id": str(idx % 6), "ts": str(idx), "action": "open"}
+            for idx in range(12)
+        ]
+        api = ObjectFeedAPI({"events": events, "customers": customers})
+        relations = [
+            Relation("customer", "customers", "zaius_id", "zaius_id", "updated")
+        ]
+        path = os.path.join(self.tmp, "dimensions.db")
+        stmt = "select ts, customer.email from events where ts < 8 order by ts"
+        with DimensionCache(path, relations) as cache:
+            rows = list(LocalJoinAPI(api, cache).query(stmt))
+            self.assertEqual(
+                [(row["ts"], row["customer.email"]) for row in rows],
+                [(str(idx), "{}@x.com".format(idx)) for idx in range(5)]
+                + [("5", ""), ("6", "0@x.com"), ("7", "1@x.com")],
+            )
+            self.assertEqual(
+                [request["select"]["fields"] for request in api.requests],
+                [["zaius_id", "email", "updated"], ["ts", "zaius_id"]],
+            )
+            # the filter still runs on the server
+            self.assertIn("ts", str(api.requests[-1]["select"]["filter"]))
+
+        customers[0]["email"] = "new@x.com"
+        customers[0]["updated"] = "20"
+        customers.append({"zaius_id": "5", "email": "5@x.com", "updated": "20"})
+        with DimensionCache(path, relations, max_age_s=0) as cache:
+            joined = LocalJoinAPI(api, cache)
+            rows = list(joined.query("select customer.email from events limit 6"))
+            self.assertEqual(rows[0], {"customer.email": "new@x.com"})
+            self.assertEqual(rows[5], {"customer.email": "5@x.com"})
+            # only the changed customers were exported again
+            self.assertEqual(
+                api.requests[-2]["select"]["filter"],
+                {"field": "updated", "operator": ">=", "value": 10.0},
+            )
+            # sorted on dimension fields stay in the export
+            stmt = "select customer.email from events order by customer.email"
+            exported, joins = cache.plan(parser.parse(stmt))
+            self.assertEqual(exported["select"]["fields"], ["customer.email"])
+            self.assertEqual(joins, {})
+            # so are filtered on fields, rows keep the values the server saw
+            stmt = (
+                "select ts, customer.email from events "
+                "where customer.email = '9@x.com'"
+            )
+            exported, joins = cache.plan(parser.parse(stmt))
+            self.assertEqual(exported["select"]["fields"], ["ts", "customer.email"])
+            self.assertEqual(joins, {})
+
+    def test_star_import(self):
+        """A star import brings in the api despite the lazy module"""
+
+        namespace = {}
+        exec("from zaius.export import *", namespace)  # pylint: disable=W0122
+        self.assertIs(namespace["API"], API)
+        self.assertIs(namespace["ExecutionError"], ExecutionError)
+
+    def test_lazy_shards(self):
+        """Shards are fetched as rows are read and stopping early skips the
+        rest, removing the downloads"""
+
+        blobs = {}
+        for idx in range(10):
+            buf = io.BytesIO()
+            with gzip.open(buf, "wt") as shard:
+                shard.write("zaius_id\n{}\n{}\n".format(2 * idx, 2 * idx + 1))
+            blobs["prefix/{:02d}.csv.gz".format(idx)] = buf.getvalue()
+        client = FakeS3Shards(blobs)
+        cache_key = (os.getpid(), "shard-server")
+        s3._CLIENTS[cache_key] = client
+        downloads = os.path.join(self.tmp, "downloads")
+        os.makedirs(downloads)
+        tempdir, tempfile.tempdir = tempfile.tempdir, downloads
+        stmt = "select zaius_id from events"
+        try:
+            with ThreadPool(2) as pool:
+                api = ShardServerAPI(blobs, pool)
+                rows = api.query(stmt)
+                self.assertEqual(next(rows), {"zaius_id": "0"})
+                rows.close()
+                self.assertEqual(client.fetched, ["prefix/00.csv.gz"])
+                self.assertEqual(os.listdir(downloads), [])
+
+                client.fetched = []
+                rows = list(api.query(stmt, limit=3))
+                self.assertEqual([row["zaius_id"] for row in rows], ["0", "1", "2"])
+                self.assertLessEqual(len(client.fetched), 3)
+                self.assertEqual(os.listdir(downloads), [])
+
+                client.fetched = []
+                rows = list(api.query(stmt))
+                self.assertEqual(
+                    [row["zaius_id"] for row in rows], [str(idx) for idx in range(20)]
+                )
+                self.assertEqual(sorted(client.fetched), sorted(blobs))
+        finally:
+            tempfile.tempdir = tempdir
+            del s3._CLIENTS[cache_key]
+
+        # a cancelled transfer drops its connection between chunks
+        cancel = threading.Event()
+        cancel.set()
+        body = FakeBody(os.urandom(1000))
+        client = FakeS3(body.data)
+        client.get_object = lambda **kwargs: {"Body": body, "ContentLength": 1000}
+        output = os.path.join(self.tmp, "cancelled.csv.gz")
+        with self.assertRaises(DownloadCancelled):
+            _download_attempt(client, "bucket", "cancelled.csv.gz", output, 100, cancel)
+        self.assertTrue(body.closed)
+        self.assertFalse(os.path.exists(output))
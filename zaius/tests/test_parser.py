@@ -9,6 +9,7 @@ import unittest
 import datetime
 
 import parsy
+from zaius.export.filters import compile_filter, filter_fields
 from zaius.export.parser import QUERY_PARSER
 
 
@@ -209,6 +210,29 @@ class TestParser(unittest.TestCase):
             [False, True, True, False],
         )
 
+    def test_compile_filter(self):
+        """Verify that parsed filters evaluate against csv rows the way
+        the export api would"""
+
+        parsed = self.assert_valid(
+            """
+            select zaius_id
+            from events
+            where
+                (event_type = 'order' and order.status <> 'canceled')
+                or ts >= 100
+            """
+        )["select"]["filter"]
+        predicate = compile_filter(parsed)
+        rows = [
+            {"event_type": "order", "order.status": "purchased", "ts": "1"},
+            {"event_type": "order", "order.status": "canceled", "ts": "1"},
+            {"event_type": "email", "order.status": "", "ts": "100"},
+            {"event_type": "email", "order.status": "", "ts": ""},
+        ]
+        self.assertEqual(list(map(predicate, rows)), [True, False, True, False])
+        self.assertEqual(filter_fields(parsed), ["event_type", "order.status", "ts"])
+
     # pylint: disable=R0201
     def assert_valid(self, stmt):
         """Ensure that a query is parseable"""
@@ -5,10 +5,79 @@ This pokes helper methods found on reports to make sure they work
 as expected.
 """
 
+import argparse
+import contextlib
+import csv
+import gzip
+import io
+import json
+import os
+import random
+import tempfile
 import unittest
 import datetime
 
-from zaius.reports.lifecycle_progress import LifecycleProgress
+from zaius.export.filters import compile_filter
+from zaius.export.parser import QUERY_PARSER
+from zaius.reports import execute_many, output
+from zaius.reports.attribution import AttributionEngine
+from zaius.reports.email_metrics import EmailMetrics
+from zaius.reports.lifecycle_progress import (
+    LifecycleProgress,
+    LifecycleProgressAccumulator,
+)
+from zaius.reports.product_attribution import ProductAttribution, _half_life
+from zaius.reports.rollup import RollupStore
+from zaius.reports.sampling import Sampler
+from zaius.reports.sketch import DistinctSketch
+
+
+try:
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class FakeAPI:
+    """Serves a fixed set of rows, filtered by the query"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def query_raw(self, query_dict):
+        """Return the rows that match the query's filter"""
+        self.queries.append(query_dict)
+        predicate = compile_filter(query_dict["select"].get("filter"))
+        fields = query_dict["select"]["fields"]
+        return [
+            {field: row.get(field, "") for field in fields}
+            for row in self.rows
+            if predicate(row)
+        ]
+
+class ShardAPI:
+    """Hands over fixed rows as gzipped csv files, like API.query_shards"""
+
+    export_format = "csv"
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    @contextlib.contextmanager
+    def query_shards(self, stmt):  # pylint: disable=W0613
+        """Write every shard to a file and yield their paths"""
+        with tempfile.TemporaryDirectory() as local:
+            paths = []
+            for idx, rows in enumerate(self.shards):
+                path = os.path.join(local, "{}.csv.gz".format(idx))
+                with gzip.open(path, "wt", newline="") as shard:
+                    writer = csv.DictWriter(shard, list(rows[0].keys()))
+                    writer.writeheader()
+                    writer.writerows(rows)
+                paths.append(path)
+            yield iter(paths)
+
 
 # pylint: disable=W0212
 class TestReports(unittest.TestCase):
@@ -27,3 +96,582 @@ class TestReports(unittest.TestCase):
         self.assertEqual(report._months_between(jan2019, jan2018), -12)
         self.assertEqual(report._month_add(jan2019, 1), feb2019)
         self.assertEqual(report._month_add(jan2018, 13), feb2019)
+
+    def test_fanout(self):
+        """Several reports share one export and see only their rows"""
+
+        jan2019_s = int(
+            datetime.datetime(2019, 1, 5, tzinfo=datetime.timezone.utc).timestamp()
+        )
+        rows = [
+            {"zaius_id": "a", "ts": jan2019_s, "event_type": "customer_discovered"},
+            {"zaius_id": "a", "ts": jan2019_s + 1, "event_type": "email",
+             "action": "sent", "campaign_id": "7", "campaign_schedule_run_ts": "1546300800"},
+            {"zaius_id": "a", "ts": jan2019_s + 2, "event_type": "email",
+             "action": "open", "campaign_id": "7", "campaign_schedule_run_ts": "1546300800"},
+            {"zaius_id": "a", "ts": jan2019_s + 3, "event_type": "order",
+             "action": "purchase", "order_id": "1", "order.status": "purchased"},
+            {"zaius_id": "b", "ts": jan2019_s, "event_type": "email",
+             "action": "sent", "campaign_id": "7", "campaign_schedule_run_ts": "1546300800"},
+            {"zaius_id": "b", "ts": jan2019_s, "event_type": "list",
+             "action": "unsubscribe", "campaign_id": "7"},
+            {"zaius_id": "b", "ts": jan2019_s, "event_type": "email",
+             "action": "spamreport", "campaign_id": "7", "campaign_schedule_run_ts": "1546300800"},
+            {"zaius_id": "b", "ts": jan2019_s, "event_type": "email",
+             "action": "click", "campaign_id": "7", "campaign_schedule_run_ts": "1546300800"},
+        ]
+        api = FakeAPI(rows)
+        lifecycle = io.StringIO()
+        metrics = io.StringIO()
+        execute_many(
+            api,
+            [
+                (
+                    LifecycleProgress(),
+                    lifecycle,
+                    argparse.Namespace(start_month="2019-1", end_month="2019-2"),
+                ),
+                (
+                    EmailMetrics(),
+                    metrics,
+                    argparse.Namespace(
+                        campaign_id="7", start_date="2019-1-1", end_date="2019-2-1"
+                    ),
+                ),
+            ],
+            log=io.StringIO(),
+        )
+
+        self.assertEqual(len(api.queries), 1)
+        self.assertIn("2019-01-01 00:00:00+00:00,0,1,0,0", lifecycle.getvalue())
+        self.assertIn("2,1,1,1,1,50.0,50.0,50.0", metrics.getvalue())
+
+    def test_output_writers(self):
+        """Writers produce the same rows in every format"""
+
+        rows = [{"month": "2019-01", "count": 1}, {"month": "2019-02", "count": 2}]
+
+        def render(fmt, compression=None):
+            raw = io.BytesIO()
+            destination = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            writer = output.writer(destination, ["month", "count"], fmt, compression)
+            writer.writeheader()
+            writer.writerows(rows)
+            writer.close()
+            return raw.getvalue()
+
+        plain = render("csv")
+        self.assertEqual(plain, b"month,count\r\n2019-01,1\r\n2019-02,2\r\n")
+        self.assertEqual(gzip.decompress(render("csv", "gzip")), plain)
+        self.assertEqual(
+            [json.loads(line) for line in render("jsonl").splitlines()], rows
+        )
+        if pyarrow is not None:
+            table = pyarrow.parquet.read_table(io.BytesIO(render("parquet")))
+            self.assertEqual(table.to_pylist(), rows)
+
+            # a column that is empty in the first batch becomes a string
+            rows = [
+                {"month": "2019-01", "count": None},
+                {"month": "2019-02", "count": 2},
+            ]
+            batch_rows = output.BATCH_ROWS
+            output.BATCH_ROWS = 1
+            try:
+                table = pyarrow.parquet.read_table(io.BytesIO(render("parquet")))
+            finally:
+                output.BATCH_ROWS = batch_rows
+            self.assertEqual(str(table.schema.field("count").type), "string")
+            self.assertEqual(
+                table.column("count").to_pylist(), [None, "2"]
+            )
+
+        # a row missing a column is filled in, no row is written twice
+        rows = [{"month": "2019-01", "count": 1}, {"month": "2019-02"}]
+        self.assertEqual(
+            render("csv"), b"month,count\r\n2019-01,1\r\n2019-02,\r\n"
+        )
+
+    def test_lifecycle_buckets(self):
+        """Transition counting matches walking every bucket of every user"""
+
+        report = LifecycleProgress()
+        start = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+        end = datetime.datetime(2018, 3, 1, tzinfo=datetime.timezone.utc)
+        start_s = int(start.timestamp())
+        end_s = int(end.timestamp())
+
+        stages = LifecycleProgressAccumulator.stages
+        rng = random.Random(7)
+        rows = []
+        for user in range(50):
+            times = sorted(rng.randrange(start_s - 90 * 86400, end_s) for _ in range(4))
+            for ts_s in times:
+                event_type = rng.choice(["order", "customer_discovered"])
+                rows.append(
+                    {
+                        "zaius_id": str(user),
+                        "ts": str(ts_s),
+                        "event_type": event_type,
+                        "order_id": str(rng.randrange(3)),
+                    }
+                )
+
+        for granularity in ("month", "week", "day"):
+            starts = report._bucket_starts(start, end, granularity)
+            starts_s = [int(b.timestamp()) for b in starts]
+
+            # walk every bucket of every user
+            expected = [dict.fromkeys(stages, 0) for _ in starts]
+            users = {}
+            for row in rows:
+                users.setdefault(row["zaius_id"], []).append(row)
+            for events in users.values():
+                for idx, bucket_start in enumerate(starts_s):
+                    bucket_end = starts_s[idx + 1] if idx + 1 < len(starts_s) else end_s
+                    if int(events[0]["ts"]) >= bucket_end:
+                        continue
+                    # the stage is set by purchases up to the end of the bucket
+                    orders = set(
+                        r["order_id"]
+                        for r in events
+                        if r["event_type"] == "order" and int(r["ts"]) < bucket_end
+                    )
+                    stage = LifecycleProgressAccumulator._stage(len(orders))
+                    expected[idx][stage] += 1
+
+            destination = io.StringIO()
+            accumulator = LifecycleProgressAccumulator(
+                output.writer(destination, [granularity] + stages),
+                starts,
+                granularity,
+            )
+            for row in rows:
+                accumulator.add(row)
+            accumulator.finish()
+            lines = destination.getvalue().splitlines()[1:]
+            self.assertEqual(len(lines), len(starts))
+            for line, counts in zip(lines, expected):
+                self.assertEqual(
+                    line.split(",")[1:], [str(counts[stage]) for stage in stages]
+                )
+
+    def test_partitioned(self):
+        """Partitioned execution produces the same output as a single pass"""
+
+        rng = random.Random(3)
+        rows = []
+        for user in range(40):
+            for idx in range(5):
+                rows.append(
+                    {
+                        "zaius_id": "user{}".format(user),
+                        "ts": str(1546300800 + idx * 86400),
+                        "event_type": "order" if idx % 2 else "customer_discovered",
+                        "order_id": str(rng.randrange(4)),
+                        "order.status": "purchased",
+                        "action": "purchase",
+                    }
+                )
+        api = FakeAPI(rows)
+        api.query = lambda stmt: api.query_raw(QUERY_PARSER.parse(stmt))
+
+        outputs = []
+        for processes in (1, 3):
+            destination = io.StringIO()
+            args = argparse.Namespace(
+                start_month="2019-1", end_month="2019-2", processes=processes
+            )
+            LifecycleProgress().execute(api, destination, args)
+            outputs.append(destination.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_partitioned_shards(self):
+        """Workers decoding the files themselves produce the same rows as a
+        single pass, users cut by the file boundaries included"""
+
+        rows = []
+        for user in range(30):
+            fields = {
+                "zaius_id": "user{:02}".format(user),
+                "product_id": "p",
+                "customer.email": "",
+                "order_item_quantity": "1",
+                "order_item_subtotal": "10",
+                "campaign_schedule_run_ts": "",
+            }
+            for idx in range(1 + user % 4):
+                rows.append(
+                    dict(
+                        fields,
+                        ts=str(1000 + idx),
+                        order_id="",
+                        action="click",
+                        campaign="c{}".format(idx),
+                    )
+                )
+            rows.append(
+                dict(fields, ts="2000", order_id="o", action="purchase", campaign="")
+            )
+        cuts = [0, 7, 8, 40, 41, 42, len(rows)]
+        api = ShardAPI([rows[low:high] for low, high in zip(cuts, cuts[1:])])
+
+        args = argparse.Namespace(
+            start_date="2019-1-1", end_date="2019-2-1", attribution_days="1"
+        )
+        destination = io.StringIO()
+        accumulator = ProductAttribution().accumulator(destination, args)
+        for row in rows:
+            accumulator.add(row)
+        accumulator.finish()
+        expected = destination.getvalue().splitlines()
+        self.assertEqual(len(expected), 31)
+
+        for processes in (2, 3):
+            destination = io.StringIO()
+            args.processes = processes
+            ProductAttribution().execute(api, destination, args)
+            lines = destination.getvalue().splitlines()
+            self.assertEqual(lines[0], expected[0])
+            self.assertEqual(sorted(lines[1:]), sorted(expected[1:]))
+
+    def test_sampling(self):
+        """Sampled reports keep whole users, scale the counts and report
+        confidence intervals that cover the full counts"""
+
+        sampler = Sampler(0.1)
+        kept = [user for user in range(5000) if sampler("user{}".format(user))]
+        again = Sampler(0.1)
+        self.assertEqual(
+            kept, [user for user in range(5000) if again("user{}".format(user))]
+        )
+        self.assertTrue(400 < len(kept) < 600)
+
+        rows = []
+        for user in range(3000):
+            rows.append(
+                {
+                    "zaius_id": "user{}".format(user),
+                    "ts": "1546300800",
+                    "event_type": "customer_discovered",
+                }
+            )
+            for order in range(user % 3):
+                rows.append(
+                    {
+                        "zaius_id": "user{}".format(user),
+                        "ts": "1546300800",
+                        "event_type": "order",
+                        "order_id": str(order),
+                        "order.status": "purchased",
+                        "action": "purchase",
+                    }
+                )
+        api = FakeAPI(rows)
+        api.query = lambda stmt: api.query_raw(QUERY_PARSER.parse(stmt))
+
+        outputs = []
+        for processes in (1, 2):
+            destination = io.StringIO()
+            args = argparse.Namespace(
+                start_month="2019-1",
+                end_month="2019-2",
+                processes=processes,
+                sample=0.2,
+            )
+            LifecycleProgress().execute(api, destination, args)
+            outputs.append(destination.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+
+        header, line = outputs[0].splitlines()
+        self.assertEqual(header.split(",")[1:3], ["no_purchase", "no_purchase +/-"])
+        values = [int(value) for value in line.split(",")[1:]]
+        for stage in range(3):
+            count, margin = values[2 * stage], values[2 * stage + 1]
+            self.assertLessEqual(abs(count - 1000), margin)
+
+        with self.assertRaises(ValueError):
+            ProductAttribution().sample_rate(argparse.Namespace(sample=0.2))
+
+    def test_attribution_models(self):
+        """Every model and window is credited in one pass"""
+
+        day_s = 24 * 3600
+        engine = AttributionEngine(
+            ["last", "first", "linear", "time-decay", "position"],
+            [1, 5],
+            action_weights={"open": 0},
+            half_life_days=1,
+        )
+        engine.engage(0, "click", "a")
+        engine.engage(1 * day_s, "open", "ignored")
+        engine.engage(2 * day_s, "click", "b")
+        engine.engage(3 * day_s, "click", "c")
+        engine.engage(4 * day_s - 1, "click", "d")
+        credits = {}
+        for model, window, touch, credit in engine.convert(4 * day_s):
+            credits.setdefault((model, window), {})[touch] = round(credit, 3)
+
+        self.assertEqual(credits[("last", 1)], {"d": 1})
+        self.assertEqual(credits[("first", 1)], {"d": 1})
+        self.assertEqual(credits[("last", 5)], {"d": 1})
+        self.assertEqual(credits[("first", 5)], {"a": 1})
+        self.assertEqual(credits[("linear", 5)], dict.fromkeys("abcd", 0.25))
+        self.assertEqual(
+            credits[("position", 5)], {"a": 0.4, "b": 0.1, "c": 0.1, "d": 0.4}
+        )
+        decay = credits[("time-decay", 5)]
+        self.assertAlmostEqual(decay["c"] / decay["b"], 2, places=1)
+
+        # touches past the largest window are dropped
+        self.assertEqual(engine.convert(20 * day_s), [])
+        self.assertEqual(len(engine.touches), 0)
+
+        # a touch at the time of the purchase leaves it unattributed under
+        # the last model, as in the classic report
+        engine = AttributionEngine(["last", "first"], [5])
+        engine.engage(0, "click", "a")
+        engine.engage(day_s, "click", "b")
+        self.assertEqual(engine.convert(day_s), [("first", 5, "a", 1.0)])
+        with self.assertRaises(ValueError):
+            AttributionEngine(["time-decay"], [5], half_life_days=0)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            _half_life("0")
+
+    def test_product_attribution_windows(self):
+        """The classic report keeps its columns, extra models and windows
+        add model, window and credit columns"""
+
+        rows = [
+            {"zaius_id": "a", "ts": "100", "action": "open", "campaign": "c1",
+             "campaign_schedule_run_ts": "50"},
+            {"zaius_id": "a", "ts": str(100 + 2 * 86400), "action": "click",
+             "campaign": "c2", "campaign_schedule_run_ts": "60"},
+            {"zaius_id": "a", "ts": str(3700 + 2 * 86400), "action": "purchase",
+             "product_id": "p", "order_id": "o", "customer.email": "a@b.c",
+             "order_item_quantity": "1", "order_item_subtotal": "10"},
+        ]
+
+        def run(attribution_days="3", **options):
+            destination = io.StringIO()
+            args = argparse.Namespace(attribution_days=attribution_days, **options)
+            accumulator = ProductAttribution().accumulator(destination, args)
+            for row in rows:
+                accumulator.add(row)
+            accumulator.finish()
+            return destination.getvalue().splitlines()
+
+        lines = run()
+        self.assertEqual(lines[0].split(",")[0], "campaign")
+        self.assertEqual([line.split(",")[0] for line in lines[1:]], ["c2"])
+
+        lines = run(models="first,linear", attribution_days="1,4")
+        self.assertEqual(lines[0].split(",")[:3], ["model", "window_days", "campaign"])
+        self.assertEqual(
+            [tuple(line.split(",")[:3]) + (line.split(",")[-1],) for line in lines[1:]],
+            [
+                ("first", "1", "c2", "1.0"),
+                ("linear", "1", "c2", "1.0"),
+                ("first", "4", "c1", "1.0"),
+                ("linear", "4", "c1", "0.5"),
+                ("linear", "4", "c2", "0.5"),
+            ],
+        )
+
+    def test_email_metrics_campaigns(self):
+        """Every campaign's metrics come from one pass, missing actions
+        count as 0"""
+
+        def event(user, campaign, action, run="1546300800"):
+            return {
+                "zaius_id": user,
+                "event_type": "email",
+                "action": action,
+                "campaign_id": campaign,
+                "campaign_schedule_run_ts": run,
+            }
+
+        rows = [
+            event("a", "7", "sent"),
+            event("a", "7", "open"),
+            event("a", "7", "open"),
+            event("a", "12", "sent"),
+            event("b", "7", "sent"),
+            event("b", "7", "sent", run="1546400000"),
+            event("b", "7", "click", run="1546400000"),
+            event("b", "9", "open"),
+        ]
+        destination = io.StringIO()
+        accumulator = EmailMetrics().accumulator(
+            destination, argparse.Namespace(campaign_id="all")
+        )
+        for row in rows:
+            accumulator.add(row)
+        accumulator.finish()
+        lines = destination.getvalue().splitlines()
+        self.assertEqual(
+            lines[1:],
+            [
+                "7,3,1,1,0,0,33.33333333333333,33.33333333333333,0.0",
+                "9,0,1,0,0,0,,,",
+                "12,1,0,0,0,0,0.0,0.0,0.0",
+            ],
+        )
+
+        destination = io.StringIO()
+        accumulator = EmailMetrics().accumulator(
+            destination, argparse.Namespace(campaign_id="12,13")
+        )
+        for row in rows:
+            accumulator.add(row)
+        accumulator.finish()
+        self.assertEqual(
+            destination.getvalue().splitlines()[1:],
+            ["12,1,0,0,0,0,0.0,0.0,0.0", "13,0,0,0,0,0,,,"],
+        )
+
+    def test_distinct_sketch(self):
+        """Sketches are exact while small, close once dense, and merge"""
+
+        small = DistinctSketch()
+        for user in range(1000):
+            small.add("user{}".format(user % 500))
+        self.assertEqual(small.estimate(), 500)
+
+        large = DistinctSketch()
+        for user in range(100000):
+            large.add("user{}".format(user))
+        self.assertLess(abs(large.estimate() - 100000), 3000)
+
+        restored = DistinctSketch.deserialize(large.serialize())
+        self.assertEqual(restored.estimate(), large.estimate())
+        restored = DistinctSketch.deserialize(small.serialize())
+        self.assertEqual(restored.estimate(), 500)
+
+        # small's users are all in large
+        restored.merge(large)
+        self.assertEqual(restored.estimate(), large.estimate())
+        other = DistinctSketch()
+        for user in range(1500):
+            other.add("other{}".format(user))
+        small.merge(other)
+        self.assertEqual(small.estimate(), 2000)
+
+    def test_email_metrics_rollups(self):
+        """Rollups give the counts of raw events and only export missing days"""
+
+        day_s = 86400
+        runs = [1546300800, 1546300800 + day_s, 1546300800 + 5 * day_s]
+        rows = []
+        for user in range(200):
+            for campaign in ("7", "9"):
+                for run in runs:
+                    if (user + run // day_s) % 3 == 0:
+                        continue
+                    base = {
+                        "zaius_id": "user{}".format(user),
+                        "event_type": "email",
+                        "campaign_id": campaign,
+                        "campaign_schedule_run_ts": str(run),
+                    }
+                    rows.append({**base, "action": "sent", "ts": run + user})
+                    # opens and clicks come in over the following days
+                    for action, share in (("open", 2), ("click", 5)):
+                        for repeat in range(user % share == 0 and 2 or 0):
+                            rows.append(
+                                {
+                                    **base,
+                                    "action": action,
+                                    "ts": run + (user + repeat) % 3 * day_s,
+                                }
+                            )
+                    if user % 17 == 0:
+                        rows.append(
+                            {
+                                **base,
+                                "event_type": "list",
+                                "action": "unsubscribe",
+                                "ts": run + day_s + user,
+                            }
+                        )
+        api = FakeAPI(rows)
+        api.query = lambda stmt: api.query_raw(QUERY_PARSER.parse(stmt))
+
+        def run_report(**kwargs):
+            args = argparse.Namespace(
+                campaign_id="all",
+                start_date="2019-1-1",
+                end_date="2019-1-3",
+                rollups=None,
+                exact=False,
+            )
+            vars(args).update(kwargs)
+            destination = io.StringIO()
+            EmailMetrics().execute(api, destination, args)
+            return destination.getvalue()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "rollups.db")
+            exact = run_report()
+            self.assertEqual(run_report(rollups=path), exact)
+            exports = len(api.queries)
+            # complete days are not exported again, past the lateness window
+            self.assertEqual(run_report(rollups=path, rollup_lateness=0), exact)
+            self.assertEqual(len(api.queries), exports)
+            self.assertEqual(run_report(rollups=path, exact=True), exact)
+            self.assertEqual(len(api.queries), exports + 1)
+            self.assertEqual(
+                run_report(rollups=path, campaign_id="9,12"),
+                run_report(campaign_id="9,12"),
+            )
+            with self.assertRaises(ValueError):
+                run_report(rollups=path, sample=0.5)
+            # rollups run on their own when reports are combined
+            report = EmailMetrics()
+            self.assertFalse(
+                report.shares_export(argparse.Namespace(rollups=path, exact=False))
+            )
+            self.assertTrue(
+                report.shares_export(argparse.Namespace(rollups=path, exact=True))
+            )
+
+            # late events are picked up by rolling the last days up again,
+            # which replaces what those days held
+            start = datetime.date(2019, 1, 1)
+            end = start + datetime.timedelta(days=9)
+            rows.append(
+                {
+                    "zaius_id": "late",
+                    "event_type": "email",
+                    "action": "open",
+                    "campaign_id": "7",
+                    "campaign_schedule_run_ts": str(runs[0]),
+                    "ts": runs[0] + 3 * day_s,
+                }
+            )
+            with RollupStore(path) as store:
+                self.assertEqual(store.update(api, start, end, lateness_days=0), 0)
+                self.assertGreater(store.update(api, start, end, lateness_days=6), 0)
+            self.assertNotEqual(run_report(), exact)
+            self.assertEqual(run_report(rollups=path, rollup_lateness=0), run_report())
+
+            # a backfill is split into bounded exports, each reported
+            path = os.path.join(directory, "backfill.db")
+            exports = len(api.queries)
+            log = io.StringIO()
+            with RollupStore(path) as store:
+                store.update(api, start, end, export_days=4, log=log)
+                with self.assertRaises(ValueError):
+                    store.update(api, start, end, export_days=0)
+            self.assertEqual(len(api.queries), exports + 3)
+            self.assertEqual(
+                [line.split(",")[:2] for line in log.getvalue().splitlines()],
+                [
+                    ["Rolled up 2019-01-01 to 2019-01-04", " 4 of 9 days"],
+                    ["Rolled up 2019-01-05 to 2019-01-08", " 8 of 9 days"],
+                    ["Rolled up 2019-01-09 to 2019-01-09", " 9 of 9 days"],
+                ],
+            )
+            self.assertEqual(
+                run_report(rollups=path, rollup_lateness=0), run_report()
+            )